@@ -1,7 +1,9 @@
 import click
+from mantis.artifacts import build_artifacts
 from mantis.consume import consume
 from mantis.load_gen import load_gen
 from mantis.runner import run_controller
+from mantis.simulator import simulate
 
 
 @click.group()
@@ -9,9 +11,11 @@ def cli():
     pass
 
 
+cli.add_command(build_artifacts)
 cli.add_command(consume)
 cli.add_command(load_gen)
 cli.add_command(run_controller)
+cli.add_command(simulate)
 
 
 def wrapper():
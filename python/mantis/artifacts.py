@@ -0,0 +1,45 @@
+import os
+import time
+
+import click
+from structlog import get_logger
+
+from mantis.models import catalogs
+
+logger = get_logger()
+logger = logger.bind(role="artifacts")
+
+
+@click.command()
+@click.option(
+    "--output-dir", required=True, type=click.Path(), envvar="MANTIS_ARTIFACT_DIR"
+)
+@click.option(
+    "--workload",
+    "workloads",
+    multiple=True,
+    type=click.Choice(list(catalogs.keys())),
+    help="Defaults to every workload that has an artifact.",
+)
+def build_artifacts(output_dir, workloads):
+    """Serialize the workload models so that consumers can load them quickly."""
+    os.makedirs(output_dir, exist_ok=True)
+    for workload in workloads or catalogs.keys():
+        model_class = catalogs[workload]
+        if model_class.artifact_name is None:
+            continue
+        path = os.path.join(output_dir, model_class.artifact_name)
+
+        start = time.time()
+        model = model_class()
+        constructed = time.time()
+        model.save_artifact(path)
+        saved = time.time()
+        model_class.from_artifact(path)
+        logger.msg(
+            f"Built {path}",
+            workload=workload,
+            construct_s=f"{constructed - start:.2f}",
+            save_s=f"{saved - constructed:.2f}",
+            load_s=f"{time.time() - saved:.2f}",
+        )
@@ -6,23 +6,34 @@ import time
 import uuid
 import threading
 import os
+import multiprocessing
+from functools import lru_cache
 
 import click
 import redis
-import pykube
 from structlog import get_logger
+from mantis.envelope import pack_query, unpack_query
 from mantis.models import catalogs
-from mantis.util import parse_custom_args
+from mantis.pod_monitor import DRAIN, pod_channel
+from mantis.util import PhaseTimer, parse_custom_args
 
 logger = get_logger()
 logger = logger.bind(role="consumer")
 
 
 RESULT_KEY = "completion_queue"
+# See STREAM_GROUP and STREAM_QUERY_FIELD in mantis.cc
+STREAM_GROUP = "mantis"
+STREAM_QUERY_FIELD = b"query"
 
 FRACTIONAL_SLEEP = 0.0
 FRACTIONAL_PROB = 0.0
 CHECK_DURATION = 2
+# Idle consumers send a heartbeat each time the blocking pop times out, which
+# has to be well within heartbeat_slack_ms of mantis.config.
+POP_TIMEOUT_S = 1
+BATCH_POLL_INTERVAL_S = 1 / 1e3
+PAYLOAD_CACHE_SIZE = 16
 
 thread_should_stop = threading.Event()
 
@@ -65,101 +76,166 @@ class FractionalValueMonitor(threading.Thread):
         return False
 
 
-HEALTH_CHECK_DURATION_S = 20 / 1e3
+class PodSignalListener(threading.Thread):
+    """Sends SIGTERM to this process once the runner sees the pod terminating.
 
+    The drain then runs in the main thread, exactly as for the SIGTERM from the
+    kubelet. Pub/sub messages are not stored, so a drain published before this
+    subscribed is missed and the kubelet's SIGTERM stops the worker instead.
+    """
 
-class HealthCheckSender(threading.Thread):
-    def __init__(self, redis_ip, redis_port, my_uuid):
-        self.r = redis.Redis(redis_ip, port=redis_port, decode_responses=True)
-        self.my_id = my_uuid
-        super().__init__()
-
-    def run(self):
-        while not thread_should_stop.is_set():
-            time.sleep(HEALTH_CHECK_DURATION_S)
-            self.run_once()
-
-    def run_once(self):
-        self.r.execute_command("mantis.health", self.my_id)
-
-
-class PodStatusChecker(threading.Thread):
-    def __init__(self, on_terminating_status):
-        self.api = pykube.HTTPClient(pykube.KubeConfig.from_env())
-        self.my_name = os.environ["MY_POD_NAME"]
-        self.callback = on_terminating_status
-        super().__init__()
+    def __init__(self, redis_ip, redis_port):
+        r = redis.Redis(redis_ip, port=redis_port, decode_responses=True)
+        self.pubsub = r.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(pod_channel(os.environ["MY_POD_NAME"]))
+        super().__init__(daemon=True)
 
     def run(self):
         while not thread_should_stop.is_set():
-            time.sleep(5)
-            self.run_once()
-
-    def run_once(self):
-        query = pykube.Pod.objects(self.api).filter(
-            field_selector={"metadata.name": self.my_name}
-        )
-        result = list(query)[0]
-        phase = result.obj["status"]["phase"]
-        if phase == "Terminating":
-            logger.msg("Current status is Terminating, shutting down...")
-            self.callback()
-
-
-@click.command()
-@click.option("--redis-ip", default="0.0.0.0", envvar="MANTIS_REDIS_IP")
-@click.option("--redis-port", default=7000, type=int)
-@click.option("--is-fractional", is_flag=True)
-@click.option(
-    "--workload",
-    required=True,
-    type=click.Choice(list(catalogs.keys())),
-    envvar="MANTIS_WORKLOAD",
-)
-@click.option("--custom-args", envvar="MANTIS_CUSTOM_ARGS")
-def consume(redis_ip, redis_port, is_fractional, workload, custom_args):
-    init_args = dict()
-    if custom_args:
-        init_args.update(parse_custom_args(custom_args))
-    r = redis.Redis(redis_ip, port=redis_port, decode_responses=True)
+            message = self.pubsub.get_message(timeout=1)
+            if message and message["data"] == DRAIN:
+                logger.msg("Pod is terminating, shutting down...")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+
+def serve(
+    worker,
+    redis_ip,
+    redis_port,
+    is_fractional,
+    max_batch_size,
+    max_batch_wait_ms,
+    listen_for_drain=True,
+    startup_timer=None,
+    standby=False,
+):
+    """Register a queue and serve queries from it with `worker` until stopped.
+
+    The durations of startup_timer are reported to the module with add_queue.
+    A standby consumer registers with add_standby instead and only gets queries
+    once the runner moves its queue to the active ones with mantis.activate.
+    """
     queue_name = uuid.uuid4().hex
     logger.msg(f"My queue uuid is {queue_name}")
-    worker = None
-
-    while not r.get("worker_should_go"):
-        logger.msg("Waiting for worker_should_go signal")
-        time.sleep(1)
+    # Completions double as heartbeats while busy. The module also treats the
+    # queue as dead as soon as the connection named after it closes.
+    r = redis.Redis(redis_ip, port=redis_port, client_name=queue_name)
+    # The module makes the queue a stream when registering it with this backend.
+    streams = json.loads(r.execute_command("mantis.config"))["backend"] == "stream"
+    startup_timer = startup_timer or PhaseTimer()
+
+    # The first forward pass is much slower than the following ones. It runs
+    # here rather than before forking so no thread pool is started in the parent.
+    payload = worker.generate_workload()
+    if isinstance(payload, str):
+        payload = payload.encode()
+    worker.batch([payload])
+    startup_timer.end_phase("warm_up")
 
     sleeper_thread = None
     if is_fractional:
         sleeper_thread = FractionalValueMonitor(redis_ip, redis_port)
         sleeper_thread.start()
 
-    next_query = None
-
-    def work_on_single_query(next_query):
-        query = json.loads(next_query)
-        query["_3_dequeue_time"] = time.time()
-        query["result"] = worker(query.pop("payload"))
-        r.execute_command("mantis.complete", json.dumps(query))
+    # Queries popped from the queue but not completed yet, and with the stream
+    # backend their entry ids, acknowledged by mantis.complete. Entries left
+    # unacknowledged are moved to other workers by mantis.reclaim.
+    next_queries = []
+    popped_ids = []
+
+    def pop_more_queries(num_queries, block_ms=None):
+        if streams:
+            reply = r.xreadgroup(
+                STREAM_GROUP,
+                queue_name,
+                {queue_name: ">"},
+                count=num_queries,
+                block=block_ms,
+            )
+            entries = reply[0][1] if reply else []
+            popped_ids.extend(entry_id for entry_id, _ in entries)
+            return [fields[STREAM_QUERY_FIELD] for _, fields in entries]
+        if block_ms is not None:
+            popped = r.blpop(queue_name, timeout=block_ms // 1000)
+            return [] if popped is None else [popped[1]]
+        # LPOP with a count is not available on the redis version we deploy.
+        pipe = r.pipeline(transaction=True)
+        pipe.lrange(queue_name, 0, num_queries - 1)
+        pipe.ltrim(queue_name, num_queries, -1)
+        popped, _ = pipe.execute()
+        return popped
+
+    def fill_batch(batch):
+        # Extend in place so the signal handler sees every popped query.
+        deadline = time.time() + max_batch_wait_ms / 1000
+        while len(batch) < max_batch_size:
+            batch.extend(pop_more_queries(max_batch_size - len(batch)))
+            if len(batch) == max_batch_size or time.time() >= deadline:
+                break
+            time.sleep(BATCH_POLL_INTERVAL_S)
+
+    @lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+    def fetch_payload(handle):
+        payload = r.execute_command("mantis.get_payload", handle)
+        if payload is None:
+            raise KeyError(f"Payload {handle} is no longer stored")
+        return payload
+
+    def work_on_queries(raw_queries):
+        dequeue_time = time.time()
+        pipe = r.pipeline(transaction=False)
+        # The module acknowledges the stream entries, and drops the completions
+        # of queries reclaimed in the meantime.
+        entry_ids = [[entry_id] for entry_id in popped_ids] or [[]] * len(raw_queries)
+        popped_ids.clear()
+        queries = []
+        for raw_query, entry_id in zip(raw_queries, entry_ids):
+            header, payload = unpack_query(raw_query)
+            if 0 < header["deadline"] < dequeue_time:
+                # Too late to be of use, skip it rather than delay the others.
+                pipe.execute_command("mantis.expire", raw_query, *entry_id)
+                continue
+            header["_3_dequeue_time"] = dequeue_time
+            queries.append((header, payload, entry_id))
+
+        if queries:
+            headers, payloads, query_entry_ids = zip(*queries)
+            payloads = [
+                fetch_payload(bytes(payload)) if header["payload_digest"] else payload
+                for header, payload in zip(headers, payloads)
+            ]
+            results = worker.batch(payloads)
+            for header, result, entry_id in zip(headers, results, query_entry_ids):
+                pipe.execute_command(
+                    "mantis.complete", pack_query(header, result), *entry_id
+                )
+        pipe.execute()
 
     def signal_handler(*args):
-        nonlocal next_query
+        nonlocal next_queries
         logger.msg("SIGNAL received, Draining the queue...")
         try:
-            r.execute_command("mantis.drop_queue", queue_name)
+            # The queries still queued go to the other workers, whatever is
+            # left when no other worker is healthy is drained below.
+            moved = r.execute_command("mantis.drop_queue", queue_name, "REDISTRIBUTE")
+            logger.msg(f"Moved {moved} queued queries to other workers")
             thread_should_stop.set()
 
-            if next_query:
-                work_on_single_query(next_query)
+            if next_queries:
+                work_on_queries(next_queries)
 
-            items_left = r.llen(queue_name)
+            items_left = r.xlen(queue_name) if streams else r.llen(queue_name)
             logger.msg("{} item left, processing...".format(items_left))
-            for _ in range(items_left):
+            while items_left > 0:
                 if sleeper_thread:
                     sleeper_thread.try_sleep()
-                next_query = r.lpop(queue_name)
-                work_on_single_query(next_query)
+                next_queries = pop_more_queries(min(max_batch_size, items_left))
+                if not next_queries:
+                    # Moved to other workers in the meantime.
+                    break
+                work_on_queries(next_queries)
+                items_left -= len(next_queries)
             logger.msg("All done!")
         except Exception as e:
             logger.msg(f"Exception happened while handling draining signal {e}")
@@ -167,13 +243,20 @@ def consume(redis_ip, redis_port, is_fractional, workload, custom_args):
             thread_should_stop.set()
             if sleeper_thread:
                 sleeper_thread.join()
-            health_checker.join()
-            status_checker.join()
+            if signal_listener:
+                signal_listener.join()
             sys.exit(0)
 
     # Handle SIGTERM
+    draining = False
+
     def sigterm_wrapper(*args):
+        nonlocal draining
         logger.msg("SIGTERM caught")
+        # Both the drain signal and the kubelet's SIGTERM arrive on scale down.
+        if draining:
+            return
+        draining = True
         signal_handler()
 
     signal.signal(signal.SIGTERM, sigterm_wrapper)
@@ -181,33 +264,166 @@ def consume(redis_ip, redis_port, is_fractional, workload, custom_args):
 
     logger.msg("Signal handler installed")
 
-    # Delaying instantation of worker since it might take time
-    worker = catalogs[workload](**init_args)
+    signal_listener = None
+    if listen_for_drain:
+        signal_listener = PodSignalListener(redis_ip, redis_port)
+        signal_listener.start()
+        logger.msg("Pod signal listener started")
 
-    health_checker = HealthCheckSender(redis_ip, redis_port, queue_name)
-    health_checker.start()
-    logger.msg("Health checker started")
-
-    status_checker = PodStatusChecker(signal_handler)
-    status_checker.start()
-    logger.msg("K8s pod status checker started")
-
-    r.execute_command("mantis.add_queue", queue_name)
-    logger.msg("Queue added to redis")
+    startup_timer.end_phase("start_threads")
+    r.execute_command(
+        "mantis.add_standby" if standby else "mantis.add_queue",
+        queue_name,
+        json.dumps(startup_timer.durations_s),
+    )
+    logger.msg("Queue added to redis", **startup_timer.durations_s)
 
     try:
         while True:
             if is_fractional and sleeper_thread.try_sleep():
                 continue
-            next_query = r.blpop(queue_name, timeout=1)
-            if next_query is None:
-                # logger.msg("Timeout, retrying...")
+            popped = pop_more_queries(1, block_ms=POP_TIMEOUT_S * 1000)
+            if not popped:
+                # Idle, completions double as heartbeats otherwise.
+                r.execute_command("mantis.health", queue_name)
                 continue
-            # if not None, next_query is format (key, value)
-            _, next_query = next_query
-            work_on_single_query(next_query)
-            next_query = None
+            next_queries = popped
+            if max_batch_size > 1:
+                fill_batch(next_queries)
+            work_on_queries(next_queries)
+            next_queries = []
     # Handle SIGINT
     except KeyboardInterrupt:
         logger.msg("SIGINT caught")
         signal_handler()
+
+
+def serve_forked(worker, num_procs, **serve_args):
+    """Fork num_procs consumers sharing the weights of the already loaded worker.
+
+    Every child registers its own queue. Only the parent listens for the drain
+    signal; SIGTERM is forwarded so that every child drains its queue before
+    exiting.
+    """
+    worker.share_memory()
+    ctx = multiprocessing.get_context("fork")
+    children = [
+        ctx.Process(
+            target=serve,
+            args=(worker,),
+            kwargs=dict(serve_args, listen_for_drain=False),
+        )
+        for _ in range(num_procs)
+    ]
+    for child in children:
+        child.start()
+    logger.msg(f"Started {num_procs} consumer processes")
+
+    def terminate_children(*args):
+        logger.msg("Stopping consumer processes")
+        thread_should_stop.set()
+        for child in children:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, lambda *args: terminate_children())
+    signal_listener = PodSignalListener(
+        serve_args["redis_ip"], serve_args["redis_port"]
+    )
+    signal_listener.start()
+
+    try:
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        # The children got the SIGINT as well and drain on their own.
+        for child in children:
+            child.join()
+    thread_should_stop.set()
+    signal_listener.join()
+
+
+@click.command()
+@click.option("--redis-ip", default="0.0.0.0", envvar="MANTIS_REDIS_IP")
+@click.option("--redis-port", default=7000, type=int)
+@click.option("--is-fractional", is_flag=True)
+@click.option(
+    "--workload",
+    required=True,
+    type=click.Choice(list(catalogs.keys())),
+    envvar="MANTIS_WORKLOAD",
+)
+@click.option("--custom-args", envvar="MANTIS_CUSTOM_ARGS")
+@click.option(
+    "--max-batch-size",
+    default=1,
+    type=int,
+    envvar="MANTIS_MAX_BATCH_SIZE",
+    help="Run up to this many queued queries in a single forward pass.",
+)
+@click.option(
+    "--max-batch-wait-ms",
+    default=0.0,
+    type=float,
+    envvar="MANTIS_MAX_BATCH_WAIT_MS",
+    help="How long to wait for a batch to fill up after the first query arrives.",
+)
+@click.option(
+    "--artifact-dir",
+    type=click.Path(),
+    envvar="MANTIS_ARTIFACT_DIR",
+    help="Load models from the artifacts built by `mantis build-artifacts`.",
+)
+@click.option(
+    "--standby",
+    is_flag=True,
+    envvar="MANTIS_STANDBY",
+    help="Load the model and wait in the standby pool until activated.",
+)
+@click.option(
+    "--procs",
+    default=1,
+    type=int,
+    envvar="MANTIS_CONSUMER_PROCS",
+    help="Fork this many consumers, each with its own queue, sharing one model.",
+)
+def consume(
+    redis_ip,
+    redis_port,
+    is_fractional,
+    workload,
+    custom_args,
+    max_batch_size,
+    max_batch_wait_ms,
+    artifact_dir,
+    standby,
+    procs,
+):
+    startup_timer = PhaseTimer()
+    init_args = dict()
+    if custom_args:
+        init_args.update(parse_custom_args(custom_args))
+    r = redis.Redis(redis_ip, port=redis_port)
+
+    while not r.get("worker_should_go"):
+        logger.msg("Waiting for worker_should_go signal")
+        time.sleep(1)
+    startup_timer.end_phase("wait_for_signal")
+
+    # Load the model once, forked consumers share its weights.
+    worker = catalogs[workload].load(artifact_dir, **init_args)
+    startup_timer.end_phase("load_model")
+
+    serve_args = dict(
+        redis_ip=redis_ip,
+        redis_port=redis_port,
+        is_fractional=is_fractional,
+        max_batch_size=max_batch_size,
+        max_batch_wait_ms=max_batch_wait_ms,
+        startup_timer=startup_timer,
+        standby=standby,
+    )
+    if procs == 1:
+        serve(worker, **serve_args)
+    else:
+        serve_forked(worker, procs, **serve_args)
@@ -6,6 +6,8 @@ from mantis.controllers.debug import (
     Scheduled,
 )
 from mantis.controllers.pid import PIDController
+from mantis.controllers.forecast import ForecastController
+from mantis.controllers.erlang import ErlangCController
 from mantis.controllers.k8s import K8sNative, DONT_SCALE
 
 registry = {
@@ -16,4 +18,6 @@ registry = {
     "add_delete_fixed": AddDeleteFixed,
     "k8s_native": K8sNative,
     "scheduled": Scheduled,
+    "forecast": ForecastController,
+    "erlang_c": ErlangCController,
 }
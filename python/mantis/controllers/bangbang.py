@@ -1,17 +1,32 @@
 import numpy as np
 
 from mantis.controllers.base import BaseController
+from mantis.sketch import LatencyWindow
 
 
-class BangBang:
+class BangBang(BaseController):
     slo = 150  # ms
     low = 0.5 * slo
     high = 0.8 * slo
 
+    def __init__(self, p99_over="interval"):
+        # "window" reacts to the p99 of the runner's sliding latency window.
+        assert p99_over in ("interval", "window")
+        self.p99_over = p99_over
+
     def get_action_from_state(self, lats, deltas, num_replicas, qlen):
-        if len(lats) == 0:
-            return 0
-        p99 = np.percentile(lats, 99)
+        if self.p99_over == "window":
+            sketch = self.window_latency_ms
+        else:
+            sketch = self.interval_latency_ms
+        if sketch is not None:
+            if sketch.count == 0:
+                return 0
+            p99 = sketch.quantile(0.99)
+        else:
+            if len(lats) == 0:
+                return 0
+            p99 = np.percentile(lats, 99)
         if p99 < self.low:
             return -0.8
         if p99 > self.high:
@@ -36,3 +51,14 @@ def test_bang_bang():
         lats=[low_watermark * 0.5 for _ in range(10)], deltas=[], num_replicas=0, qlen=0
     )
     assert should_decrease == -0.8
+
+
+def test_bang_bang_window():
+    b = BangBang(p99_over="window")
+    window = LatencyWindow(num_intervals=12)
+    b.observe_latency_sketches(*window.observe([b.high * 10] * 10))
+    assert b.get_action_from_state([], [], 0, 0) == 0.8
+
+    # A quiet interval does not hide the slow queries still in the window.
+    b.observe_latency_sketches(*window.observe([b.low * 0.5] * 10))
+    assert b.get_action_from_state([b.low * 0.5] * 10, [], 0, 0) == 0.8
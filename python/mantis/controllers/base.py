@@ -2,6 +2,27 @@ from typing import List
 
 
 class BaseController:
+    # mantis.sketch.DDSketch of the e2e latencies (ms) in the last interval and
+    # in the sliding window, set by the runner before get_action_from_state.
+    interval_latency_ms = None
+    window_latency_ms = None
+    # Seconds from asking for a replica until it registered, last measured by
+    # the runner, None before the first scale up.
+    startup_delay_s = None
+    # Service times (ms) of the queries completed in the last interval, set by
+    # the runner before get_action_from_state.
+    service_times_ms = None
+
+    def observe_latency_sketches(self, interval, window):
+        self.interval_latency_ms = interval
+        self.window_latency_ms = window
+
+    def observe_startup_delay(self, delay_s):
+        self.startup_delay_s = delay_s
+
+    def observe_service_times(self, service_times_ms):
+        self.service_times_ms = service_times_ms
+
     def get_action_from_state(
         self,
         e2e_latency_since_last_call: List[float],  # List[float] in ms
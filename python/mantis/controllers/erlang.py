@@ -0,0 +1,153 @@
+import math
+from collections import deque
+
+import numpy as np
+
+from mantis.controllers.base import AbsoluteValueBaseController
+
+
+def erlang_c(offered_load, max_servers):
+    """Probability that a query waits in an M/M/c queue, for c = 1..max_servers.
+
+    offered_load is arrival rate times mean service time, in erlangs. Uses the
+    Erlang B recursion, which is stable for any number of servers. Unstable
+    queues, with offered_load >= c, always wait.
+    """
+    servers = np.arange(1, max_servers + 1)
+    erlang_b = np.empty(max_servers)
+    b = 1.0
+    for c in servers:
+        b = offered_load * b / (c + offered_load * b)
+        erlang_b[c - 1] = b
+    utilization = offered_load / servers
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wait_prob = erlang_b / (1 - utilization * (1 - erlang_b))
+    return np.where(utilization < 1, wait_prob, 1.0)
+
+
+def waiting_time_tail(arrival_rate, service_times_s, t_s, max_servers):
+    """P(waiting time > t_s) in an M/G/c queue, for c = 1..max_servers.
+
+    t_s may be an array of shape (samples,), the result then has the shape
+    (max_servers, samples). The waiting time is that of M/M/c with the same
+    mean service time, its exponential tail stretched by (1 + cs^2) / 2 for the
+    squared coefficient of variation cs^2 of the service time, as in the
+    Allen-Cunneen approximation.
+    """
+    mean_s = service_times_s.mean()
+    scv = service_times_s.var() / mean_s**2
+    servers = np.arange(1, max_servers + 1)
+    wait_prob = erlang_c(arrival_rate * mean_s, max_servers)
+    decay = np.maximum(servers / mean_s - arrival_rate, 0) * 2 / (1 + scv)
+    t_s = np.asarray(t_s, dtype=float)
+    expand = (slice(None),) + (np.newaxis,) * t_s.ndim
+    return wait_prob[expand] * np.exp(-decay[expand] * np.maximum(t_s, 0))
+
+
+def response_time_tail(arrival_rate, service_times_s, t_s, max_servers):
+    """P(response time > t_s) in an M/G/c queue, for c = 1..max_servers.
+
+    The service time of a query is independent of its waiting time and taken
+    from the samples, all candidate c are evaluated at once.
+    """
+    service_times_s = np.asarray(service_times_s, dtype=float)
+    slack_s = t_s - service_times_s
+    tail = waiting_time_tail(arrival_rate, service_times_s, slack_s, max_servers)
+    return np.where(slack_s > 0, tail, 1.0).mean(axis=1)
+
+
+class ErlangCController(AbsoluteValueBaseController):
+    """Provisions the fewest replicas that meet a latency SLO in an M/G/c model.
+
+    The arrival rate is that of the last control interval, the service times
+    are those of the queries completed in the last window_intervals intervals.
+    Until queries complete, model_processing_time_s is the service time if
+    given, otherwise the replica count is left as is. Every candidate replica
+    count up to max_replicas is evaluated at once.
+    """
+
+    def __init__(
+        self,
+        curr_replicas,
+        slo_ms=150,
+        quantile=0.99,
+        max_replicas=72,
+        control_interval_s=5,
+        window_intervals=12,
+        model_processing_time_s=None,
+    ):
+        self.curr_replicas = int(curr_replicas)
+        self.slo_s = float(slo_ms) / 1000
+        self.quantile = float(quantile)
+        self.max_replicas = int(max_replicas)
+        self.control_interval_s = float(control_interval_s)
+        self.service_time_window = deque(maxlen=int(window_intervals))
+        if model_processing_time_s is not None:
+            self.service_time_window.append([float(model_processing_time_s)])
+
+    def get_action_from_state(self, lats, arrival_ts_us, num_replicas, queue_length):
+        if self.service_times_ms is not None and len(self.service_times_ms):
+            self.service_time_window.append(np.asarray(self.service_times_ms) / 1000)
+            self.service_times_ms = None
+        if not self.service_time_window:
+            return self.curr_replicas
+
+        arrival_rate = len(arrival_ts_us) / self.control_interval_s
+        service_times_s = np.concatenate(self.service_time_window)
+        tail = response_time_tail(
+            arrival_rate, service_times_s, self.slo_s, self.max_replicas
+        )
+        if tail[-1] > 1 - self.quantile:
+            # Even max_replicas miss the SLO, e.g. because the service time
+            # alone does. Hold only the waiting time to the SLO then.
+            tail = waiting_time_tail(
+                arrival_rate, service_times_s, self.slo_s, self.max_replicas
+            )
+        meets_slo = np.flatnonzero(tail <= 1 - self.quantile)
+        self.curr_replicas = (
+            int(meets_slo[0]) + 1 if len(meets_slo) else self.max_replicas
+        )
+        return self.curr_replicas
+
+
+def test_erlang_c():
+    # 2 erlangs on 3 servers, from the Erlang C table.
+    assert np.isclose(erlang_c(2, 3)[2], 4 / 9)
+    assert np.all(erlang_c(2, 3)[:2] == 1)
+    assert np.all(np.diff(erlang_c(20, 40)) <= 0)
+
+
+def test_response_time_tail():
+    # M/M/1 response times are exponential with rate mu - lambda.
+    rng = np.random.RandomState(0)
+    service_times = rng.exponential(0.1, 200000)
+    tail = response_time_tail(5, service_times, 0.3, 1)
+    assert np.isclose(tail[0], math.exp(-(10 - 5) * 0.3), atol=0.01)
+
+    # Deterministic service times wait less than exponential ones.
+    constant = response_time_tail(40, np.full(100, 0.1), 0.15, 10)
+    assert np.all(constant <= response_time_tail(40, service_times, 0.15, 10) + 1e-9)
+
+
+def test_erlang_c_controller():
+    ctl = ErlangCController(curr_replicas=3, slo_ms=150)
+    assert ctl.get_action_from_state([], np.zeros(500), 3, 0) == 3
+
+    # 100 qps of 50ms queries are 5 erlangs, the 99th percentile needs slack.
+    ctl.observe_service_times(np.full(1000, 50.0))
+    replicas = ctl.get_action_from_state([], np.zeros(500), 3, 0)
+    tail = response_time_tail(100, np.full(1000, 0.05), 0.15, 72)
+    assert tail[replicas - 1] <= 0.01 < tail[replicas - 2]
+    assert replicas > 5
+
+    # A tighter SLO needs more replicas.
+    tight = ErlangCController(3, slo_ms=60, model_processing_time_s=0.05)
+    assert tight.get_action_from_state([], np.zeros(500), 3, 0) > replicas
+
+    # Replicas cannot make up for a service time over the SLO, only the waiting
+    # time is held to it then.
+    slow = ErlangCController(3, slo_ms=40, model_processing_time_s=0.05)
+    replicas = slow.get_action_from_state([], np.zeros(500), 3, 0)
+    wait_tail = waiting_time_tail(100, np.array([0.05]), 0.04, 72)
+    assert wait_tail[replicas - 1] <= 0.01 < wait_tail[replicas - 2]
+    assert replicas < 72
@@ -0,0 +1,211 @@
+import math
+
+import numpy as np
+
+from mantis.controllers.base import AbsoluteValueBaseController
+
+
+class HoltWinters:
+    """Online additive Holt-Winters forecast of a series of equally spaced bins.
+
+    With beta=0 and season_length=0 it is an EWMA with weight alpha for the
+    newest bin, which is updated for a whole interval of bins at once.
+    """
+
+    def __init__(self, alpha, beta=0.0, gamma=0.0, season_length=0):
+        assert 0 < alpha <= 1 and 0 <= beta <= 1 and 0 <= gamma <= 1
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.season = np.zeros(season_length)
+        self.level = None
+        self.trend = 0.0
+        self.num_observed = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        if self.level is None:
+            self.level, values = values[0], values[1:]
+            self.num_observed += 1
+
+        if self.beta == 0 and len(self.season) == 0:
+            weights = (1 - self.alpha) ** np.arange(len(values) - 1, -1, -1)
+            self.level = (1 - self.alpha) ** len(values) * self.level
+            self.level += self.alpha * weights @ values
+            self.num_observed += len(values)
+            return
+
+        # The level and trend recurrences are sequential, but there are only
+        # a handful of bins per control interval.
+        m = len(self.season)
+        for value in values:
+            season = self.season[self.num_observed % m] if m else 0.0
+            last_level = self.level
+            self.level = self.alpha * (value - season) + (1 - self.alpha) * (
+                self.level + self.trend
+            )
+            self.trend = (
+                self.beta * (self.level - last_level) + (1 - self.beta) * self.trend
+            )
+            if m:
+                self.season[self.num_observed % m] = (
+                    self.gamma * (value - self.level) + (1 - self.gamma) * season
+                )
+            self.num_observed += 1
+
+    def forecast(self, num_steps):
+        """Forecasts for the next 1 to num_steps bins."""
+        steps = np.arange(1, num_steps + 1)
+        forecast = self.level + self.trend * steps
+        m = len(self.season)
+        if m:
+            forecast = forecast + self.season[(self.num_observed + steps - 1) % m]
+        return np.maximum(forecast, 0)
+
+
+class ForecastController(AbsoluteValueBaseController):
+    """Provisions replicas for the forecast arrival rate instead of the last one.
+
+    Arrivals are counted in bins of bin_s and fed to a HoltWinters forecast. A
+    replica asked for now only serves after it started up, so the controller
+    provisions for the peak rate forecast up to horizon_s ahead, at target_sigma
+    utilization. horizon_s is replaced by the start up delay measured by the
+    runner as soon as there is one.
+
+    Set beta for a trend, and season_s with gamma for e.g. a diurnal pattern.
+    """
+
+    def __init__(
+        self,
+        model_processing_time_s,
+        curr_replicas,
+        target_sigma=0.7,
+        horizon_s=60,
+        bin_s=1,
+        control_interval_s=5,
+        alpha=0.3,
+        beta=0,
+        gamma=0,
+        season_s=0,
+    ):
+        self.model_processing_time_s = float(model_processing_time_s)
+        self.curr_replicas = int(curr_replicas)
+        self.target_sigma = float(target_sigma)
+        self.horizon_s = float(horizon_s)
+        self.bin_s = float(bin_s)
+        self.control_interval_s = float(control_interval_s)
+        self.forecaster = HoltWinters(
+            float(alpha),
+            float(beta),
+            float(gamma),
+            season_length=round(float(season_s) / self.bin_s),
+        )
+        self.window_start_us = None
+
+    def bin_arrivals(self, arrival_ts_us):
+        """Arrival rate in qps in each bin of the last control interval.
+
+        Arrivals outside of the interval are not counted.
+        """
+        bin_us = self.bin_s * 1e6
+        num_bins = max(round(self.control_interval_s / self.bin_s), 1)
+        if self.window_start_us is None:
+            # The first window ends right after the latest arrival.
+            self.window_start_us = arrival_ts_us.max() + 1 - num_bins * bin_us
+        bins = ((arrival_ts_us - self.window_start_us) // bin_us).astype(np.int64)
+        counts = np.bincount(bins[(bins >= 0) & (bins < num_bins)], minlength=num_bins)
+        # Arrivals past the window mean the calls drifted, resume after them.
+        self.window_start_us = max(
+            self.window_start_us + num_bins * bin_us,
+            arrival_ts_us.max() + 1 if len(arrival_ts_us) else 0,
+        )
+        return counts / self.bin_s
+
+    def get_action_from_state(self, lats, arrival_ts_us, num_replicas, queue_length):
+        arrival_ts_us = np.asarray(arrival_ts_us, dtype=float)
+        if self.window_start_us is None and len(arrival_ts_us) == 0:
+            return self.curr_replicas
+        self.forecaster.update(self.bin_arrivals(arrival_ts_us))
+
+        horizon_s = self.horizon_s
+        if self.startup_delay_s is not None:
+            horizon_s = self.startup_delay_s
+        num_steps = max(math.ceil(horizon_s / self.bin_s), 1)
+        peak_qps = self.forecaster.forecast(num_steps).max()
+
+        self.curr_replicas = max(
+            math.ceil(peak_qps * self.model_processing_time_s / self.target_sigma), 1
+        )
+        return self.curr_replicas
+
+
+def arrivals_at(rates_qps, bin_s, start_s=0):
+    """Evenly spaced arrival timestamps in us with the given rate in each bin."""
+    return np.concatenate(
+        [
+            (start_s + (i + np.arange(int(rate * bin_s)) / (rate * bin_s)) * bin_s)
+            * 1e6
+            for i, rate in enumerate(rates_qps)
+            if rate > 0
+        ]
+        or [np.zeros(0)]
+    )
+
+
+def test_holt_winters_ewma():
+    ewma = HoltWinters(alpha=0.5)
+    ewma.update([4, 8])
+    ewma.update([0, 4, 4])
+    level = 4
+    for value in [8, 0, 4, 4]:
+        level += 0.5 * (value - level)
+    assert np.isclose(ewma.level, level)
+    assert np.allclose(ewma.forecast(3), level)
+
+
+def test_holt_winters_trend_and_season():
+    holt = HoltWinters(alpha=0.5, beta=0.5)
+    holt.update(np.arange(0, 100, 2.0))
+    assert np.allclose(holt.forecast(5), np.arange(100, 110, 2.0), atol=0.1)
+
+    season = np.array([0, 0, 10, 10.0])
+    seasonal = HoltWinters(alpha=0.1, gamma=0.5, season_length=4)
+    seasonal.update(np.tile(season, 20))
+    assert np.allclose(seasonal.forecast(4), season, atol=0.5)
+
+
+def test_bin_arrivals():
+    ctl = ForecastController(0.1, 1, bin_s=1, control_interval_s=2)
+    assert list(ctl.bin_arrivals(np.array([0.1, 1.1, 1.2]) * 1e6)) == [1, 2]
+    # A late arrival of the last interval and one past this one are dropped.
+    arrivals = np.array([1.0, 1.5, 2.5, 4.0]) * 1e6
+    assert list(ctl.bin_arrivals(arrivals)) == [1, 1]
+    assert ctl.window_start_us == 4.0e6 + 1
+
+
+def test_forecast_controller():
+    ctl = ForecastController(
+        model_processing_time_s=0.1, curr_replicas=3, target_sigma=0.5, horizon_s=5
+    )
+    assert ctl.get_action_from_state([], [], 3, 0) == 3
+
+    # 20 qps at 0.1s per query and 50% utilization needs 4 replicas.
+    for i in range(10):
+        ctl.get_action_from_state([], arrivals_at([20] * 5, 1, start_s=5 * i), 3, 0)
+    assert ctl.curr_replicas == 4
+
+    # A ramp is provisioned for the rate it reaches by the time replicas are up,
+    # the measured start up delay replaces horizon_s.
+    rates = np.arange(10, 60, 0.5)
+    slow, fast = [
+        ForecastController(0.1, 1, target_sigma=0.5, horizon_s=10, beta=0.3)
+        for _ in range(2)
+    ]
+    fast.observe_startup_delay(1)
+    for i in range(len(rates) // 5):
+        arrivals = arrivals_at(rates[5 * i : 5 * i + 5], 1, start_s=5 * i)
+        slow.get_action_from_state([], arrivals, 1, 0)
+        fast.get_action_from_state([], arrivals, 1, 0)
+    assert slow.curr_replicas > fast.curr_replicas >= math.ceil(rates[-1] * 0.1 / 0.5)
@@ -0,0 +1,90 @@
+import struct
+
+import numpy as np
+
+# Binary envelope for queries and completions, see QueryHeader in src/mantis.cc.
+# A fixed size header is followed by the raw payload bytes of the query, or by
+# the raw result bytes once the worker completes it.
+HEADER = struct.Struct("<q32sQddddd")
+HEADER_FIELDS = [
+    "query_id",
+    "worker_id",
+    "payload_digest",  # Non zero if the body is a handle from mantis.put_payload
+    "deadline",  # Done by time, 0 if the query has no deadline
+    "_1_lg_sent",
+    "_2_enqueue_time",
+    "_3_dequeue_time",
+    "_4_done_time",
+]
+
+# The same header as a numpy record, for the packed mantis.drain_completions reply.
+HEADER_DTYPE = np.dtype(
+    [
+        ("query_id", "<i8"),
+        ("worker_id", "S32"),
+        ("payload_digest", "<u8"),
+        ("deadline", "<f8"),
+        ("_1_lg_sent", "<f8"),
+        ("_2_enqueue_time", "<f8"),
+        ("_3_dequeue_time", "<f8"),
+        ("_4_done_time", "<f8"),
+    ]
+)
+assert HEADER_DTYPE.itemsize == HEADER.size
+
+
+def unpack_query(buf):
+    """Split an envelope into its header dict and a zero copy view of the body."""
+    header = dict(zip(HEADER_FIELDS, HEADER.unpack_from(buf)))
+    header["worker_id"] = header["worker_id"].rstrip(b"\0").decode()
+    return header, memoryview(buf)[HEADER.size :]
+
+
+def pack_query(header, body):
+    return HEADER.pack(
+        header["query_id"],
+        header["worker_id"].encode(),
+        *(header[field] for field in HEADER_FIELDS[2:]),
+    ) + to_bytes(body)
+
+
+def to_bytes(result):
+    if result is None:
+        return b""
+    if isinstance(result, str):
+        return result.encode()
+    return bytes(result)
+
+
+def test_envelope_roundtrip():
+    header = {
+        "query_id": 42,
+        "worker_id": "a" * 32,
+        "payload_digest": 0,
+        "deadline": 0.0,
+        "_1_lg_sent": 1.0,
+        "_2_enqueue_time": 2.0,
+        "_3_dequeue_time": 3.0,
+        "_4_done_time": 0.0,
+    }
+    unpacked, body = unpack_query(pack_query(header, "result"))
+    assert unpacked == header
+    assert bytes(body) == b"result"
+
+
+def test_header_dtype():
+    header = {
+        "query_id": 1,
+        "worker_id": "worker",
+        "payload_digest": 0,
+        "deadline": 0.0,
+        "_1_lg_sent": 1.0,
+        "_2_enqueue_time": 2.0,
+        "_3_dequeue_time": 3.0,
+        "_4_done_time": 4.0,
+    }
+    packed = pack_query(header, b"")
+    records = np.frombuffer(packed * 2, dtype=HEADER_DTYPE)
+    assert len(records) == 2
+    assert records["worker_id"][1] == b"worker"
+    assert records["_4_done_time"][0] == 4.0
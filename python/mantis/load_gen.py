@@ -1,5 +1,6 @@
-import json
 import time
+from collections import OrderedDict
+from multiprocessing import Pool
 
 import click
 import numpy as np
@@ -11,6 +12,84 @@ logger = get_logger()
 logger = logger.bind(role="load_generator")
 
 
+def make_schedule(deltas):
+    """Convert inter-arrival deltas (ms) into absolute send offsets (ms).
+
+    Query i is sent at sum(deltas[:i]) so the first query is sent right away.
+    """
+    deltas = np.asarray(deltas, dtype=float)
+    return np.cumsum(deltas) - deltas
+
+
+def batch_by_time_slot(send_offsets_ms, batch_window_ms):
+    """Group queries whose send offset falls in the same batch_window_ms slot.
+
+    Returns a list of arrays of query indices. A window of 0 disables batching.
+    """
+    indices = np.arange(len(send_offsets_ms))
+    if batch_window_ms <= 0:
+        return np.split(indices, indices[1:])
+    slots = np.floor(send_offsets_ms / batch_window_ms).astype(np.int64)
+    boundaries = np.flatnonzero(np.diff(slots)) + 1
+    return np.split(indices, boundaries)
+
+
+def send_schedule(
+    redis_ip, redis_port, payload, send_offsets_ms, query_ids, batch_window_ms, start
+):
+    """Send the queries at start + send_offsets_ms against the monotonic clock.
+
+    A query that is already late is sent right away so the generator catches up
+    instead of accumulating the lag. Returns the send error of every query in ms.
+    """
+    r = redis.Redis(redis_ip, redis_port, decode_responses=True)
+    batches = batch_by_time_slot(send_offsets_ms, batch_window_ms)
+    errors_ms = np.zeros(len(send_offsets_ms))
+
+    log_every = max(len(batches) // 100, 1)
+    for batch_i, group in enumerate(batches):
+        if batch_i % log_every == 0:
+            # Query ids are the indices in the whole schedule, across shards.
+            logger.msg(
+                f"Sent {query_ids[group[0]]} queries",
+                percent=f"{group[0] / len(send_offsets_ms):.2f}",
+            )
+
+        target = start + send_offsets_ms[group[0]] / 1000
+        wait = target - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        errors_ms[group] = (time.monotonic() - start) * 1000 - send_offsets_ms[group]
+        sent_time = time.time()
+        if len(group) == 1:
+            r.execute_command("mantis.enqueue", payload, sent_time, query_ids[group[0]])
+        else:
+            args = []
+            for i in group:
+                args.extend([payload, sent_time, query_ids[i]])
+            r.execute_command("mantis.enqueue_batch", *args)
+
+    return errors_ms
+
+
+def _send_shard(args):
+    return send_schedule(*args)
+
+
+def test_make_schedule():
+    assert np.allclose(make_schedule([1.0, 2.0, 0.5]), [0.0, 1.0, 3.0])
+
+
+def test_batch_by_time_slot():
+    offsets = make_schedule([0.2, 0.3, 0.6, 2.0, 0.1, 0.0])
+    batches = batch_by_time_slot(offsets, batch_window_ms=1)
+    assert [list(group) for group in batches] == [[0, 1, 2], [3], [4, 5]]
+    assert [list(group) for group in batch_by_time_slot(offsets, 0)] == [
+        [i] for i in range(6)
+    ]
+
+
 @click.command()
 @click.option(
     "--load", required=True, type=click.Path(exists=True), envvar="MANTIS_LOAD_FILE"
@@ -23,22 +102,80 @@ logger = logger.bind(role="load_generator")
 )
 @click.option("--redis-ip", default="0.0.0.0", envvar="MANTIS_REDIS_IP")
 @click.option("--redis-port", default=7000, type=int)
-def load_gen(load, workload, redis_ip, redis_port):
+@click.option(
+    "--batch-window-ms",
+    default=0.0,
+    type=float,
+    envvar="MANTIS_BATCH_WINDOW_MS",
+    help="Send queries falling in the same window with one mantis.enqueue_batch. "
+    "0 sends every query individually.",
+)
+@click.option(
+    "--num-procs",
+    default=1,
+    type=int,
+    envvar="MANTIS_LOAD_GEN_PROCS",
+    help="Shard the schedule round robin across this many sender processes.",
+)
+@click.option(
+    "--payload-by-reference",
+    is_flag=True,
+    envvar="MANTIS_PAYLOAD_BY_REFERENCE",
+    help="Store the payload once with mantis.put_payload and enqueue its handle.",
+)
+def load_gen(
+    load,
+    workload,
+    redis_ip,
+    redis_port,
+    batch_window_ms,
+    num_procs,
+    payload_by_reference,
+):
     deltas = np.load(load)
     payload = catalogs[workload].generate_workload()
     r = redis.Redis(redis_ip, redis_port, decode_responses=True)
+    if payload_by_reference:
+        payload = r.execute_command("mantis.put_payload", payload)
+        logger.msg(f"Enqueueing payload by reference {payload}")
+
+    send_offsets_ms = make_schedule(deltas)
+    query_ids = np.arange(len(deltas))
 
     while not r.get("load_gen_should_go"):
         logger.msg("Waiting for load_gen_should_go signal")
         time.sleep(1)
 
-    total_load = len(deltas)
-    log_every = total_load // 100
-    for i, delta in enumerate(deltas):
-        if i % log_every == 0:
-            logger.msg(f"Sent {i} queries", percent=f"{i / total_load:.2f}")
-        r.execute_command("mantis.enqueue", payload, time.time(), i)
-        time.sleep(delta / 1000)
+    # CLOCK_MONOTONIC is system wide, so all shards share the same start.
+    start = time.monotonic()
+    shards = [
+        (
+            redis_ip,
+            redis_port,
+            payload,
+            send_offsets_ms[shard::num_procs],
+            query_ids[shard::num_procs].tolist(),
+            batch_window_ms,
+            start,
+        )
+        for shard in range(num_procs)
+    ]
+    if num_procs == 1:
+        errors_ms = [_send_shard(shards[0])]
+    else:
+        with Pool(num_procs) as pool:
+            errors_ms = pool.map(_send_shard, shards)
+    errors_ms = np.concatenate(errors_ms)
 
-    logger.msg("Load generation finished!")
+    percentiles = [50, 90, 99, 99.9, 100]
+    logger.msg(
+        "Load generation finished!",
+        **OrderedDict(
+            (f"send_error_ms_p{p}", f"{v:.3f}")
+            for p, v in zip(percentiles, np.percentile(errors_ms, percentiles))
+        ),
+    )
+    if payload_by_reference:
+        # Queries still in flight keep the payload alive until they complete.
+        r.execute_command("mantis.release_payload", payload)
     r.set("load_gen_finished", "1")
@@ -1,10 +1,95 @@
-from mantis.models.sleep import Sleeper, BusySleeper
-from mantis.models.transformer import SentimentAnalysis
-from mantis.models.squeezenet import Squeezenet
-
-catalogs = {
-    "sleep": Sleeper,
-    "busy-sleep": BusySleeper,
-    "vision": Squeezenet,
-    "nlp": SentimentAnalysis,
+"""Workload catalog.
+
+The model modules import torch, torchvision or transformers, which takes seconds,
+so a model module is only imported when its workload is looked up. The names are
+known up front for click.Choice. Other packages can add workloads through the
+"mantis.workloads" entry point group, e.g. `my-model = my_package.models:MyModel`.
+"""
+
+import subprocess
+import sys
+from collections.abc import Mapping
+from importlib import import_module
+
+WORKLOAD_ENTRY_POINT_GROUP = "mantis.workloads"
+
+BUILTIN_WORKLOADS = {
+    "sleep": "mantis.models.sleep:Sleeper",
+    "busy-sleep": "mantis.models.sleep:BusySleeper",
+    "vision": "mantis.models.squeezenet:Squeezenet",
+    "nlp": "mantis.models.transformer:SentimentAnalysis",
 }
+
+# Must never be imported by `import mantis`, see test_import_time.
+HEAVY_MODULES = ["torch", "torchvision", "transformers"]
+# Budget for the cumulative import time of `mantis`, about twice what it takes
+# without the model modules. Importing torch on top of it goes over.
+IMPORT_TIME_BUDGET_S = 2.5
+
+
+class LazyCatalog(Mapping):
+    """Maps workload names to model classes given as "module:attribute"."""
+
+    def __init__(self, specs):
+        self._specs = dict(specs)
+        self._loaded = dict()
+
+    def __getitem__(self, name):
+        if name not in self._loaded:
+            module_name, _, attribute = self._specs[name].partition(":")
+            self._loaded[name] = getattr(import_module(module_name), attribute)
+        return self._loaded[name]
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
+
+
+def discover_workloads():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        return dict()
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=WORKLOAD_ENTRY_POINT_GROUP)
+    else:
+        eps = eps.get(WORKLOAD_ENTRY_POINT_GROUP, [])
+    return {ep.name: ep.value for ep in eps}
+
+
+catalogs = LazyCatalog({**discover_workloads(), **BUILTIN_WORKLOADS})
+
+
+def test_lazy_catalog():
+    catalog = LazyCatalog({"sleep": BUILTIN_WORKLOADS["sleep"]})
+    assert list(catalog.keys()) == ["sleep"]
+    assert catalog._loaded == {}
+    assert catalog["sleep"].__name__ == "Sleeper"
+    assert "sleep" in catalog._loaded
+
+
+def test_import_time():
+    # Import time benchmark, run in a fresh interpreter so nothing is cached.
+    # `python -X importtime` reports cumulative microseconds per module on stderr.
+    script = "import sys, mantis; print(' '.join(sorted(sys.modules)))"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    imported = set(proc.stdout.split())
+    assert not imported.intersection(HEAVY_MODULES)
+
+    cumulative_us = {
+        line.split("|")[2].strip(): int(line.split("|")[1])
+        for line in proc.stderr.splitlines()
+        if line.startswith("import time:") and "cumulative" not in line
+    }
+    import_time_s = cumulative_us["mantis"] / 1e6
+    print(f"import mantis took {import_time_s:.2f}s")
+    assert import_time_s < IMPORT_TIME_BUDGET_S
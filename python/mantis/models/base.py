@@ -0,0 +1,40 @@
+import os
+from typing import List
+
+
+class BaseModel:
+    # File or directory name of the artifact written by save_artifact, None for
+    # models that are cheap to construct. See `mantis build-artifacts`.
+    artifact_name = None
+
+    @classmethod
+    def load(cls, artifact_dir=None, **init_args):
+        """Load the pre built artifact if there is one, construct the model otherwise."""
+        if artifact_dir and cls.artifact_name:
+            path = os.path.join(artifact_dir, cls.artifact_name)
+            if os.path.exists(path):
+                return cls.from_artifact(path, **init_args)
+        return cls(**init_args)
+
+    @classmethod
+    def from_artifact(cls, path, **init_args):
+        raise NotImplementedError()
+
+    def save_artifact(self, path):
+        raise NotImplementedError()
+
+    def __call__(self, payload):
+        raise NotImplementedError()
+
+    def batch(self, payloads: List) -> List:
+        # Models that can run a batched forward pass should override this.
+        return [self(payload) for payload in payloads]
+
+    def share_memory(self):
+        # Called before forking consumers so the weights are shared instead of
+        # copied on write. Models holding torch modules should override this.
+        pass
+
+    @staticmethod
+    def generate_workload():
+        raise NotImplementedError()
@@ -1,8 +1,10 @@
 import time
 import hashlib
 
+from mantis.models.base import BaseModel
 
-class Sleeper:
+
+class Sleeper(BaseModel):
     def __init__(self, sleep_time_s):
         self.sleep_time = float(sleep_time_s)
 
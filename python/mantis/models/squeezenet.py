@@ -1,27 +1,56 @@
 import numpy as np
 import torch
-from torchvision.models import squeezenet1_1
-import base64
+
+from mantis.models.base import BaseModel
 
 SHAPES = (1, 3, 224, 224)
 
 
-class Squeezenet:
-    def __init__(self):
-        self.model = squeezenet1_1(pretrained=True)
+class Squeezenet(BaseModel):
+    artifact_name = "squeezenet.pt"
+
+    def __init__(self, model=None):
+        if model is None:
+            # Only needed without a TorchScript artifact.
+            from torchvision.models import squeezenet1_1
+
+            model = squeezenet1_1(pretrained=True)
+        self.model = model
+
+    @classmethod
+    def from_artifact(cls, path):
+        return cls(torch.jit.load(path))
+
+    def save_artifact(self, path):
+        example = np.frombuffer(self.generate_workload(), dtype="float32")
+        with torch.no_grad():
+            traced = torch.jit.trace(
+                self.model.eval(), torch.from_numpy(example.reshape(*SHAPES))
+            )
+        traced.save(path)
 
     def __call__(self, payload):
         # 31.4 ms ± 2.55 ms per loop (mean ± std. dev. of 7 runs, 10 loops each)
         # 1s / 40ms -> 25 qps, to reach 1000 qps, needs 40 cores
-        decoded = base64.b64decode(payload)
-        arr = np.frombuffer(decoded, dtype="float32").reshape(*SHAPES)
+        arr = np.frombuffer(payload, dtype="float32").reshape(*SHAPES)
         with torch.no_grad():
             pred = self.model(torch.tensor(arr))
-        pred_bytes = pred.detach().numpy().tobytes()
-        pred_str = base64.b64encode(pred_bytes).decode()
-        return pred_str
+        return pred.numpy().tobytes()
+
+    def batch(self, payloads):
+        arr = np.concatenate(
+            [
+                np.frombuffer(payload, dtype="float32").reshape(*SHAPES)
+                for payload in payloads
+            ]
+        )
+        with torch.no_grad():
+            pred = self.model(torch.from_numpy(arr))
+        return [row.tobytes() for row in pred.numpy()]
+
+    def share_memory(self):
+        self.model.share_memory()
 
     @staticmethod
     def generate_workload():
-        payload = np.zeros(SHAPES, dtype="float32").tobytes()
-        return base64.b64encode(payload)
+        return np.zeros(SHAPES, dtype="float32").tobytes()
@@ -0,0 +1,244 @@
+"""Worker pod lifecycle.
+
+The runner keeps a single watch on the worker pods instead of every worker
+polling the API server for its own pod. Once a pod is marked for deletion its
+workers are told to drain through Redis pub/sub, see PodSignalListener in
+consume.py.
+"""
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import pykube
+from pykube.query import now
+from structlog import get_logger
+
+logger = get_logger()
+logger = logger.bind(role="pod_monitor")
+
+DRAIN = "drain"
+WATCH_RETRY_INTERVAL_S = 1
+
+
+def pod_channel(pod_name):
+    """Pub/sub channel the workers of pod_name listen on."""
+    return f"mantis.pod.{pod_name}"
+
+
+def is_terminating(pod):
+    return bool(pod.obj["metadata"].get("deletionTimestamp"))
+
+
+class PodMonitor(threading.Thread):
+    """Tracks the readiness of the pods matching selector from one watch stream.
+
+    A watch that ends or fails is restarted from a fresh list, so no pod state
+    is missed in between.
+    """
+
+    def __init__(self, api, redis_conn, selector, namespace="default"):
+        self.api = api
+        self.r = redis_conn
+        self.selector = selector
+        self.namespace = namespace
+        # Pod name -> whether it is ready and not terminating.
+        self.pods = dict()
+        self.signalled = set()
+        self.changed = threading.Condition()
+        self.should_stop = threading.Event()
+        super().__init__(daemon=True)
+
+    def run(self):
+        while not self.should_stop.is_set():
+            try:
+                self.watch_once()
+            except Exception as e:
+                logger.msg(f"Pod watch failed, restarting: {e}")
+                time.sleep(WATCH_RETRY_INTERVAL_S)
+
+    def watch_once(self):
+        query = pykube.Pod.objects(self.api, namespace=self.namespace).filter(
+            selector=self.selector
+        )
+        pods = list(query)
+        with self.changed:
+            self.pods = dict()
+        for pod in pods:
+            self.handle("ADDED", pod)
+
+        for event in query.watch(since=now):
+            if self.should_stop.is_set():
+                return
+            if event.type == "ERROR":
+                # Usually 410 Gone, the resource version is too old to resume.
+                logger.msg("Pod watch expired, listing again", status=event.object.obj)
+                return
+            self.handle(event.type, event.object)
+
+    def handle(self, event_type, pod):
+        terminating = is_terminating(pod)
+        with self.changed:
+            if event_type == "DELETED":
+                self.pods.pop(pod.name, None)
+            else:
+                self.pods[pod.name] = pod.ready and not terminating
+            self.changed.notify_all()
+
+        if event_type == "DELETED":
+            self.signalled.discard(pod.name)
+        elif terminating and pod.name not in self.signalled:
+            self.signalled.add(pod.name)
+            self.r.publish(pod_channel(pod.name), DRAIN)
+            logger.msg("Pod is terminating, told its workers to drain", pod=pod.name)
+
+    def num_ready(self):
+        with self.changed:
+            return sum(self.pods.values())
+
+    def wait_until_ready(self, num_pods, timeout=None):
+        """Block until num_pods pods are ready, False if timeout passes first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.changed:
+            while sum(self.pods.values()) < num_pods:
+                logger.msg(
+                    "Waiting for all worker to become ready",
+                    ready=sum(self.pods.values()),
+                    expected=num_pods,
+                )
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    return False
+                self.changed.wait(wait)
+        return True
+
+    def stop(self):
+        self.should_stop.set()
+
+
+class FakePodAPIServer(ThreadingMixIn, HTTPServer):
+    """Serves the pod list and watch endpoints from a local port for tests.
+
+    Watch streams replay the events pushed with push_event, push_event(None)
+    ends the current stream.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        self.pods = dict()
+        self.resource_version = 1
+        self.events = queue.Queue()
+        super().__init__(("127.0.0.1", 0), _FakePodAPIHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def push_event(self, event_type, pod=None):
+        if pod is not None:
+            self.resource_version += 1
+            pod["metadata"]["resourceVersion"] = str(self.resource_version)
+            if event_type == "DELETED":
+                self.pods.pop(pod["metadata"]["name"], None)
+            else:
+                self.pods[pod["metadata"]["name"]] = pod
+        self.events.put(None if pod is None else {"type": event_type, "object": pod})
+
+
+class _FakePodAPIHandler(BaseHTTPRequestHandler):
+    # Watch events are sent as chunks, like the API server does.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.endswith("/pods"):
+            self.send_error(404)
+            return
+        params = parse_qs(url.query)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Connection", "close")
+
+        if params.get("watch") != ["true"]:
+            pod_list = {
+                "kind": "PodList",
+                "metadata": {"resourceVersion": str(self.server.resource_version)},
+                "items": list(self.server.pods.values()),
+            }
+            body = json.dumps(pod_list).encode()
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        while True:
+            event = self.server.events.get()
+            chunk = b"" if event is None else json.dumps(event).encode() + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+            if event is None:
+                return
+
+    def log_message(self, *args):
+        pass
+
+
+def make_pod(name, ready, terminating=False):
+    pod = {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": name, "namespace": "default", "labels": {"app": "worker"}},
+        "status": {"conditions": [{"type": "Ready", "status": str(ready)}]},
+    }
+    if terminating:
+        pod["metadata"]["deletionTimestamp"] = "2020-01-01T00:00:00Z"
+    return pod
+
+
+def test_pod_monitor():
+    class Publisher:
+        def __init__(self):
+            self.published = []
+
+        def publish(self, channel, message):
+            self.published.append((channel, message))
+
+    server = FakePodAPIServer()
+    server.push_event("ADDED", make_pod("w-1", ready=False))
+    publisher = Publisher()
+    api = pykube.HTTPClient(pykube.KubeConfig.from_url(server.url))
+    monitor = PodMonitor(api, publisher, {"app": "worker"})
+    monitor.start()
+
+    assert not monitor.wait_until_ready(1, timeout=0.2)
+    server.push_event("MODIFIED", make_pod("w-1", ready=True))
+    server.push_event("ADDED", make_pod("w-2", ready=True))
+    assert monitor.wait_until_ready(2, timeout=5)
+
+    # Drain is signalled once, however often the terminating pod is updated.
+    server.push_event("MODIFIED", make_pod("w-1", ready=True, terminating=True))
+    server.push_event("MODIFIED", make_pod("w-1", ready=False, terminating=True))
+    server.push_event("DELETED", make_pod("w-1", ready=False, terminating=True))
+    deadline = time.monotonic() + 5
+    while "w-1" in monitor.pods and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert publisher.published == [(pod_channel("w-1"), DRAIN)]
+    assert monitor.num_ready() == 1
+
+    # A dropped watch is resumed from a fresh list.
+    server.push_event(None)
+    server.push_event("ADDED", make_pod("w-3", ready=True))
+    assert monitor.wait_until_ready(2, timeout=5)
+    assert set(monitor.pods) == {"w-2", "w-3"}
+    monitor.stop()
+    server.push_event(None)
+    monitor.join(timeout=5)
+    assert not monitor.is_alive()
+    server.shutdown()
@@ -8,8 +8,10 @@ import json
 import shlex
 import os
 from pathlib import Path
-from collections import OrderedDict, Counter
+from collections import OrderedDict, deque
 import inspect
+import queue
+import threading
 from datetime import datetime
 from pprint import pformat
 
@@ -25,7 +27,10 @@ import pandas as pd
 
 from mantis.models import catalogs
 from mantis.controllers import registry, DONT_SCALE
-from mantis.controllers.base import AbsoluteValueBaseController
+from mantis.controllers.base import AbsoluteValueBaseController, BaseController
+from mantis.envelope import HEADER_DTYPE
+from mantis.pod_monitor import PodMonitor
+from mantis.sketch import LatencyWindow
 from mantis.util import parse_custom_args, post_result_to_slack
 
 
@@ -35,6 +40,17 @@ logger.bind(role="runner")
 K8S_DIR = Path(__file__).parent / "k8s"
 RESULT_KEY = "completion_queue"
 REDIS_PORT = 7000
+# Control intervals the ResultWriter may buffer before blocking the controller.
+WRITER_QUEUE_SIZE = 32
+PARQUET_COMPRESSION = "zstd"
+# See mantis.config in mantis.cc
+DISPATCH_POLICIES = [
+    "round_robin",
+    "join_shortest_queue",
+    "power_of_d",
+    "least_expected_work",
+    "shared_queue",
+]
 
 
 def random_letters(length=10):
@@ -81,7 +97,16 @@ class K8sClient:
         return redis_name
 
     def create_workers(
-        self, redis_name, workload, workload_args, start_replicas, image_sha
+        self,
+        redis_name,
+        workload,
+        workload_args,
+        start_replicas,
+        image_sha,
+        max_batch_size=1,
+        max_batch_wait_ms=0,
+        procs_per_pod=1,
+        standby=False,
     ):
         with open(K8S_DIR / "2_worker.yaml") as f:
             # workers, frac_worker = list(yaml.load_all(f, Loader=yaml.FullLoader))
@@ -91,11 +116,16 @@ class K8sClient:
             {"name": "MANTIS_WORKLOAD", "value": workload},
             {"name": "MANTIS_CUSTOM_ARGS", "value": workload_args},
             {"name": "OMP_NUM_THREADS", "value": "1"},
+            {"name": "MANTIS_MAX_BATCH_SIZE", "value": str(max_batch_size)},
+            {"name": "MANTIS_MAX_BATCH_WAIT_MS", "value": str(max_batch_wait_ms)},
+            {"name": "MANTIS_CONSUMER_PROCS", "value": str(procs_per_pod)},
             {
                 "name": "MY_POD_NAME",
                 "valueFrom": {"fieldRef": {"fieldPath": "metadata.name"}},
             },
         ]
+        if standby:
+            envvars.append({"name": "MANTIS_STANDBY", "value": "1"})
         workers["spec"]["template"]["spec"]["containers"][0]["env"] = envvars
         workers["spec"]["replicas"] = start_replicas
         workers["spec"]["template"]["spec"]["containers"][0][
@@ -107,25 +137,14 @@ class K8sClient:
         self.recreate_resource(pykube.Deployment, workers)
         # self.recreate_resource(pykube.Pod, frac_worker)
 
-        def worker_states():
-            worker_pods = list(
-                pykube.Pod.objects(self.k8s_api).filter(selector={"app": "worker"})
-            )
-            # worker_pods.append(
-            #     pykube.Pod.objects(self.k8s_api).get_by_name(
-            #         frac_worker["metadata"]["name"]
-            #     )
-            # )
-            states = {pod.name: pod.ready for pod in worker_pods}
-            return states
-
-        states = worker_states()
-        while not all(states.values()):
-            logger.msg(
-                f"Waiting for all worker to become ready: {Counter(states.values()).most_common()}"
-            )
-            time.sleep(2)
-            states = worker_states()
+        # Also tells the workers of terminating pods to drain.
+        self.pod_monitor = PodMonitor(
+            self.k8s_api,
+            redis.Redis(redis_name, port=REDIS_PORT),
+            workers["spec"]["selector"]["matchLabels"],
+        )
+        self.pod_monitor.start()
+        self.pod_monitor.wait_until_ready(start_replicas)
 
         self.worker_deploy_name = workers["metadata"]["name"]
 
@@ -136,13 +155,28 @@ class K8sClient:
         )
         deploy.scale(int(new_integer))
 
-    def create_load_generator(self, redis_name, workload, load_file, image_sha):
+    def create_load_generator(
+        self,
+        redis_name,
+        workload,
+        load_file,
+        image_sha,
+        batch_window_ms=0,
+        num_procs=1,
+        payload_by_reference=False,
+    ):
         with open(K8S_DIR / "4_load_gen.yaml") as f:
             [gen] = list(yaml.load_all(f, Loader=yaml.FullLoader))
         env = [
             {"name": "MANTIS_REDIS_IP", "value": redis_name},
             {"name": "MANTIS_WORKLOAD", "value": workload},
             {"name": "MANTIS_LOAD_FILE", "value": load_file},
+            {"name": "MANTIS_BATCH_WINDOW_MS", "value": str(batch_window_ms)},
+            {"name": "MANTIS_LOAD_GEN_PROCS", "value": str(num_procs)},
+            {
+                "name": "MANTIS_PAYLOAD_BY_REFERENCE",
+                "value": "1" if payload_by_reference else "0",
+            },
         ]
         gen["spec"]["template"]["spec"]["containers"][0]["env"] = env
         gen["spec"]["template"]["spec"]["containers"][0][
@@ -152,7 +186,15 @@ class K8sClient:
 
 
 class ResultWriter:
-    def __init__(self, config):
+    """Writes traces and controller status from a background thread.
+
+    The controller loop only enqueues data, bounded by WRITER_QUEUE_SIZE
+    intervals. trace_format is either "jsonl" (trace.jsonl and status.jsonl) or
+    "parquet", which writes trace.parquet and arrivals.parquet with one row
+    group per control interval and keeps status.jsonl without the arrivals.
+    """
+
+    def __init__(self, config, trace_format="jsonl"):
         base = "/{}-{}-{}/{}".format(
             config["load"].replace("/data/", "").replace(".npy", ""),
             config["workload"],
@@ -161,31 +203,147 @@ class ResultWriter:
         )
         os.makedirs(base)
         self.base = base
+        self.trace_format = trace_format
 
         self.config_path = base + "/config.json"
-        self.query_trace_path = base + "/trace.jsonl"
         self.mantis_status_path = base + "/status.jsonl"
-
-        self.trace_file = open(self.query_trace_path, "w")
         self.status_file = open(self.mantis_status_path, "w")
 
+        if trace_format == "parquet":
+            # Optional dependency, only needed for the columnar output.
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            self.pa = pa
+            timestamp = pa.timestamp("ns")
+            self.trace_writer = pq.ParquetWriter(
+                base + "/trace.parquet",
+                pa.schema(
+                    [
+                        ("query_id", pa.int64()),
+                        ("worker_id", pa.string()),
+                        ("payload_digest", pa.uint64()),
+                        ("deadline", timestamp),
+                        ("_1_lg_sent", timestamp),
+                        ("_2_enqueue_time", timestamp),
+                        ("_3_dequeue_time", timestamp),
+                        ("_4_done_time", timestamp),
+                    ]
+                ),
+                compression=PARQUET_COMPRESSION,
+            )
+            self.arrivals_writer = pq.ParquetWriter(
+                base + "/arrivals.parquet",
+                pa.schema([("arrival_ts", timestamp)]),
+                compression=PARQUET_COMPRESSION,
+            )
+        else:
+            self.query_trace_path = base + "/trace.jsonl"
+            self.trace_file = open(self.query_trace_path, "w")
+
         with open(self.config_path, "w") as f:
             json.dump(config, f)
         self.config = config
 
-    def write_trace_raw(self, msg):
-        self.trace_file.write(msg)
-        self.trace_file.write("\n")
+        self.queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        # Set by the writer thread when a write fails, raised to the controller
+        # loop on its next write or close.
+        self.write_error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _raise_write_error(self):
+        if self.write_error is not None:
+            raise self.write_error
+
+    def _put(self, item):
+        self._raise_write_error()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            logger.msg("Result writer is falling behind, blocking the controller")
+            self.queue.put(item)
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.write_error is not None:
+                # Keep draining so that a blocked _put wakes up and raises.
+                continue
+            write, args = item
+            try:
+                write(*args)
+            except Exception as e:
+                logger.msg("Result writer failed", write=write.__name__, error=repr(e))
+                self.write_error = e
+
+    def write_traces(self, completions):
+        # completions: records of mantis.envelope.HEADER_DTYPE
+        if len(completions) == 0:
+            return
+        if self.trace_format == "parquet":
+            self._put((self._write_traces_parquet, (completions,)))
+        else:
+            self._put((self._write_traces_jsonl, (completions,)))
+
+    def _write_traces_jsonl(self, completions):
+        df = pd.DataFrame(completions)
+        df["worker_id"] = df["worker_id"].str.decode("utf-8")
+        lines = df.to_json(orient="records", lines=True)
+        self.trace_file.write(lines if lines.endswith("\n") else lines + "\n")
+        self.trace_file.flush()
 
-    def write_summary_dict(self, data):
+    def _write_traces_parquet(self, completions):
+        pa = self.pa
+        columns = {
+            "query_id": pa.array(completions["query_id"]),
+            "worker_id": pa.array(np.char.decode(completions["worker_id"], "utf-8")),
+            "payload_digest": pa.array(completions["payload_digest"]),
+        }
+        for field in [
+            "deadline",
+            "_1_lg_sent",
+            "_2_enqueue_time",
+            "_3_dequeue_time",
+            "_4_done_time",
+        ]:
+            ts_ns = np.round(completions[field] * 1e9).astype(np.int64)
+            columns[field] = pa.array(ts_ns, type=pa.timestamp("ns"))
+        self.trace_writer.write_table(pa.table(columns))
+
+    def write_summary_dict(self, data, arrival_ts_ns=None):
+        self._put((self._write_summary_dict, (data, arrival_ts_ns)))
+
+    def _write_summary_dict(self, data, arrival_ts_ns):
+        if arrival_ts_ns is not None:
+            if self.trace_format == "parquet":
+                pa = self.pa
+                self.arrivals_writer.write_table(
+                    pa.table(
+                        {"arrival_ts": pa.array(arrival_ts_ns, type=pa.timestamp("ns"))}
+                    )
+                )
+            else:
+                data["real_arrival_ts_ns"] = arrival_ts_ns.tolist()
         self.status_file.write(json.dumps(data))
         self.status_file.write("\n")
-
-    def flush(self):
-        self.trace_file.flush()
         self.status_file.flush()
 
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.status_file.close()
+        if self.trace_format == "parquet":
+            self.trace_writer.close()
+            self.arrivals_writer.close()
+        else:
+            self.trace_file.close()
+        self._raise_write_error()
+
     def experiment_done(self, result=dict()):
+        self.close()
         self.run_notebook_script()
         self.upload(result)
         self.post_result(result)
@@ -236,9 +394,16 @@ Result:
         post_result_to_slack(text, images)
 
 
-def get_controller(name, args, start_replicas):
+def get_controller(name, args, start_replicas, **run_args):
+    """Build a controller from its --controller-args.
+
+    run_args describe the run, e.g. control_interval_s, and are passed to the
+    controllers that take them in place of what args say.
+    """
     ctl_class = registry[name]
     parsed_ctl_args = parse_custom_args(args)
+    ctl_params = inspect.signature(ctl_class).parameters
+    parsed_ctl_args.update({k: v for k, v in run_args.items() if k in ctl_params})
     ctl_is_aboslute = issubclass(ctl_class, AbsoluteValueBaseController)
     if ctl_is_aboslute:
         parsed_ctl_args.update({"curr_replicas": start_replicas})
@@ -246,6 +411,35 @@ def get_controller(name, args, start_replicas):
     return ctl, ctl_is_aboslute
 
 
+def get_target_replicas(action, curr_reps, max_replicas, ctl_is_absolute):
+    """Turn a controller action into a replica count, None for DONT_SCALE."""
+    if ctl_is_absolute:
+        target_reps = action
+    elif action != DONT_SCALE:
+        target_reps = curr_reps + action
+    else:
+        return None
+    target_reps = max(target_reps, 1)
+    target_reps = min(target_reps, max_replicas)
+    if not ctl_is_absolute:
+        # PID adjustment
+        if action > 0:
+            target_reps = math.ceil(target_reps)  # Round up
+        if action < 0:
+            target_reps = math.floor(target_reps)  # Round down
+    return target_reps
+
+
+def latency_status(interval_sketch, window_sketch):
+    """Status fields for the latency sketches of one control interval."""
+    status = {"latency_sketch_ms": interval_sketch.to_dict()}
+    if interval_sketch.count:
+        status["interval_latency_ms"] = interval_sketch.quantiles()
+    if window_sketch.count:
+        status["window_latency_ms"] = window_sketch.quantiles()
+    return status
+
+
 @click.command()
 @click.option("--load", required=True, type=click.Path(exists=True))
 @click.option("--workload", required=True, type=click.Choice(list(catalogs.keys())))
@@ -255,6 +449,75 @@ def get_controller(name, args, start_replicas):
 @click.option("--max-replicas", type=int, default=72)
 @click.option("--start-replicas", type=int, default=5)
 @click.option("--controller-time-step", type=float, default=5)
+@click.option(
+    "--latency-window-s",
+    type=float,
+    default=60,
+    help="Span of the sliding latency window handed to controllers.",
+)
+@click.option("--load-gen-batch-window-ms", type=float, default=0)
+@click.option("--load-gen-procs", type=int, default=1)
+@click.option("--payload-by-reference", is_flag=True)
+@click.option("--worker-max-batch-size", type=int, default=1)
+@click.option("--worker-max-batch-wait-ms", type=float, default=0)
+@click.option(
+    "--worker-procs",
+    type=int,
+    default=1,
+    help="Consumer processes per worker pod. Replica counts are in queues, so "
+    "pods are scaled to ceil(replicas / worker_procs).",
+)
+@click.option(
+    "--standby-pool-size",
+    type=int,
+    default=0,
+    help="Warm standby replicas kept next to the active ones. Scaling activates "
+    "or deactivates standby replicas at once, Kubernetes only refills the pool.",
+)
+@click.option(
+    "--dispatch-policy",
+    type=click.Choice(DISPATCH_POLICIES),
+    default="power_of_d",
+    help="How mantis.enqueue picks the queue of a query.",
+)
+@click.option(
+    "--power-of-d",
+    type=int,
+    default=2,
+    help="Queues sampled per query by the power_of_d policy.",
+)
+@click.option(
+    "--prefetch",
+    type=int,
+    default=2,
+    help="Queries in flight per worker with the shared_queue policy. Should be at "
+    "least --worker-max-batch-size.",
+)
+@click.option(
+    "--queue-backend",
+    type=click.Choice(["list", "stream"]),
+    default="list",
+    help="stream keeps popped queries until they are completed, so that the "
+    "queries of a crashed worker are dispatched again. Needs Redis 6.2.",
+)
+@click.option(
+    "--reclaim-idle-ms",
+    type=int,
+    default=30000,
+    help="With --queue-backend stream, dispatch again the queries a live worker "
+    "popped but did not complete within this long.",
+)
+@click.option(
+    "--deadline-ms",
+    type=float,
+    default=0,
+    help="Reject queries at enqueue that are not expected to be done within this "
+    "long after they were sent, and skip those that expired while queued. "
+    "0 disables deadlines.",
+)
+@click.option(
+    "--trace-format", type=click.Choice(["jsonl", "parquet"]), default="jsonl"
+)
 # @click.option("--fractional-sleep", type=float, required=True)
 @click.option("--redis-image-sha", required=True)
 @click.option("--py-image-sha", required=True)
@@ -267,18 +530,54 @@ def run_controller(
     max_replicas,
     start_replicas,
     controller_time_step,
+    latency_window_s,
+    load_gen_batch_window_ms,
+    load_gen_procs,
+    payload_by_reference,
+    worker_max_batch_size,
+    worker_max_batch_wait_ms,
+    worker_procs,
+    standby_pool_size,
+    dispatch_policy,
+    power_of_d,
+    prefetch,
+    queue_backend,
+    reclaim_idle_ms,
+    deadline_ms,
+    trace_format,
     redis_image_sha,
     py_image_sha,
     # fractional_sleep,
 ):
     client = K8sClient()
 
-    ctl, ctl_is_absolute = get_controller(controller, controller_args, start_replicas)
+    ctl, ctl_is_absolute = get_controller(
+        controller,
+        controller_args,
+        start_replicas,
+        control_interval_s=controller_time_step,
+        max_replicas=max_replicas,
+    )
 
     logger.msg("Creating redis")
     redis_ip = client.create_redis(redis_image_sha)
 
     r = redis.Redis(redis_ip, port=7000, decode_responses=True)
+    # For the packed replies of mantis.drain_completions and mantis.status_binary
+    r_bin = redis.Redis(redis_ip, port=7000)
+    r.execute_command(
+        "mantis.config",
+        "dispatch_policy",
+        dispatch_policy,
+        "power_of_d",
+        power_of_d,
+        "prefetch",
+        prefetch,
+        "backend",
+        queue_backend,
+        "deadline_ms",
+        deadline_ms,
+    )
     # r.set("fractional_sleep", str(fractional_sleep))
     # r.set("fractional_prob", str(0.5))
 
@@ -287,14 +586,26 @@ def run_controller(
         redis_ip,
         workload=workload,
         workload_args=workload_args,
-        start_replicas=start_replicas,
+        start_replicas=math.ceil((start_replicas + standby_pool_size) / worker_procs),
         image_sha=py_image_sha,
+        max_batch_size=worker_max_batch_size,
+        max_batch_wait_ms=worker_max_batch_wait_ms,
+        procs_per_pod=worker_procs,
+        standby=standby_pool_size > 0,
     )
 
     logger.msg("Creating load generator")
     num_queries_total, num_queries_received = len(np.load(load)), 0
+    # Rejected at enqueue or skipped by a worker, see --deadline-ms.
+    num_queries_shed = 0
     client.create_load_generator(
-        redis_ip, workload=workload, load_file=load, image_sha=py_image_sha
+        redis_ip,
+        workload=workload,
+        load_file=load,
+        image_sha=py_image_sha,
+        batch_window_ms=load_gen_batch_window_ms,
+        num_procs=load_gen_procs,
+        payload_by_reference=payload_by_reference,
     )
 
     # Retrieve all parameters
@@ -307,29 +618,58 @@ def run_controller(
     r.set("worker_should_go", "true")
 
     def get_num_replica_registered():
-        return len(json.loads(r.execute_command("mantis.status"))["queue_sizes"])
+        status = json.loads(r.execute_command("mantis.status"))
+        return len(status["queue_sizes"]) + len(status["standby_queue_sizes"])
 
+    num_start_pods = math.ceil((start_replicas + standby_pool_size) / worker_procs)
     replica_regstered = 0
-    while replica_regstered != start_replicas:
+    while replica_regstered != num_start_pods * worker_procs:
         logger.msg(
             "Waiting for replicas to register", replica_regstered=replica_regstered
         )
         replica_regstered = get_num_replica_registered()
         time.sleep(1)
 
+    if standby_pool_size > 0:
+        r.execute_command("mantis.activate", start_replicas)
+
     # Let load gen start
     r.set("load_gen_should_go", "true")
 
-    writer = ResultWriter(config)
-
-    def scale(new_reps):
+    writer = ResultWriter(config, trace_format)
+
+    # Number of active replicas asked for, kept up from the standby pool.
+    target_active = start_replicas
+
+    def scale(new_reps, curr_reps):
+        nonlocal target_active
+        if standby_pool_size > 0:
+            target_active = new_reps
+            if new_reps > curr_reps:
+                activated = r.execute_command("mantis.activate", new_reps - curr_reps)
+                logger.msg("Activated standby replicas", count=len(activated))
+            elif new_reps < curr_reps:
+                r.execute_command("mantis.deactivate", curr_reps - new_reps)
+            new_reps += standby_pool_size
+        else:
+            # Replicas asked for earlier and not up yet count towards new_reps.
+            num_pending = max(new_reps - curr_reps, 0)
+            while len(pending_startups) > num_pending:
+                pending_startups.pop()
+            while len(pending_startups) < num_pending:
+                pending_startups.append(time.time())
         # Set integer component
-        client.scale_workers(new_reps)
+        client.scale_workers(math.ceil(new_reps / worker_procs))
         # Set fracitonal component
         # frac_val = str(new_reps % 1.0)
         # r.set("fractional_prob", frac_val)
         # logger.msg(f"Setting fractional_value={frac_val}")
 
+    # When each replica asked for and not registered yet was asked for, to
+    # measure the start up delay for the controller.
+    pending_startups = deque()
+    latency_window = LatencyWindow(math.ceil(latency_window_s / controller_time_step))
+
     # Stop after stop_condition_count_down * timestep after receiving 100% of the queries
     stop_condition_count_down = 3
 
@@ -337,8 +677,10 @@ def run_controller(
         start = time.time()
 
         # Latency list
-        length_to_pop = r.llen(RESULT_KEY)
-        num_queries_received += length_to_pop
+        completions = np.frombuffer(
+            r_bin.execute_command("mantis.drain_completions"), dtype=HEADER_DTYPE
+        )
+        num_queries_received += len(completions)
 
         logger.msg(
             "Result received: {:.2f}%".format(
@@ -348,42 +690,41 @@ def run_controller(
             total=num_queries_total,
         )
 
-        e2e_latencies = []
-        for _ in range(length_to_pop):
-            __, val = r.blpop(RESULT_KEY)
-            writer.write_trace_raw(val)
-            parsed_msg = json.loads(val)
-            query_id = parsed_msg["query_id"]
-            e2e_latency = float(parsed_msg["_4_done_time"]) - (parsed_msg["_1_lg_sent"])
-            e2e_latencies.append(e2e_latency)
+        writer.write_traces(completions)
+        e2e_latencies = completions["_4_done_time"] - completions["_1_lg_sent"]
+        interval_sketch, window_sketch = latency_window.observe(e2e_latencies * 1000)
         if len(e2e_latencies):
-            percentiles = [25, 50, 95, 99, 100]
             logger.msg(
                 "Received {} from last interval".format(len(e2e_latencies)),
                 **OrderedDict(
-                    zip(
-                        map(str, percentiles),
-                        map(
-                            lambda s: f"{s:.4f}",
-                            np.percentile(e2e_latencies, percentiles),
-                        ),
-                    )
+                    (k, f"{v / 1000:.4f}")
+                    for k, v in interval_sketch.quantiles().items()
                 ),
             )
         else:
             logger.msg("No result received in 5sec")
 
-        val = r.execute_command("mantis.status")
+        val, arrival_ts_ns = r_bin.execute_command("mantis.status_binary")
 
         msg = json.loads(val)
+        arrival_ts_ns = np.frombuffer(arrival_ts_ns, dtype="<i8")
+        if msg["overwritten_arrival_ts"]:
+            logger.msg(
+                "Arrival timestamps were overwritten in the module",
+                count=msg["overwritten_arrival_ts"],
+            )
 
         # Msg schema
-        # // Real deltas from last call. List[int]
-        # status_report["real_arrival_ts_ns"] = timestamps_ns;
+        # // Real deltas from last call, packed int64 in the second reply element
+        # timestamps_ns
+        # // Int
+        # status_report["overwritten_arrival_ts"] = overwritten;
         # // Active queue sizes ActiveList[int]
         # status_report["queue_sizes"] = queue_sizes;
         # // Dropped queue sizes DropList[int] (Scaling down)
         # status_report["dropped_queue_sizes"] = dropped_queue_sizes;
+        # // Queries waiting for a worker with the shared_queue policy. Int
+        # status_report["shared_queue_size"] = shared_queue_size;
         # // -------------------------------------
         # status_report["current_ts_ns"] = current_time;
         # // Float, configurable
@@ -392,6 +733,19 @@ def run_controller(
         # status_report["queue_events"] = events;
         #   event["time_ns"] = curr_time_ns; event["type"] = ADD/DROP; event["queue_id"] = queue_name;
 
+        for event in map(json.loads, msg["queue_events"]):
+            if event["type"] == "ADD" and pending_startups:
+                startup_delay_s = event["time_ns"] / 1e9 - pending_startups.popleft()
+                logger.msg("Replica started", startup_delay_s=f"{startup_delay_s:.2f}")
+                if isinstance(ctl, BaseController):
+                    ctl.observe_startup_delay(startup_delay_s)
+            if "startup" in event:
+                logger.msg(
+                    "Worker registered",
+                    queue_id=event["queue_id"],
+                    **{f"{k}_s": f"{v:.2f}" for k, v in event["startup"].items()},
+                )
+
         for key in ["queue_sizes", "dropped_queue_sizes", "dead_queue_sizes"]:
             queue_sizes = msg[key]
             if len(queue_sizes) == 0:
@@ -401,52 +755,67 @@ def run_controller(
                 f"{key} distribution", **{str(k): v for k, v in histogram.items()}
             )
 
+        deadline_counts = msg["deadline_counts"]
+        num_queries_shed += deadline_counts["rejected"] + deadline_counts["expired"]
+        if any(deadline_counts.values()):
+            logger.msg("Queries missing their deadline", **deadline_counts)
+
+        if any(msg["dead_queue_sizes"]):
+            moved = r.execute_command("mantis.rebalance")
+            logger.msg("Moved queries off dead queues", count=moved)
+        if queue_backend == "stream":
+            reclaimed = r.execute_command("mantis.reclaim", reclaim_idle_ms)
+            if reclaimed:
+                logger.msg("Reclaimed unacknowledged queries", count=reclaimed)
+
         curr_int_reps = len(msg["queue_sizes"])
+        if standby_pool_size > 0 and curr_int_reps < target_active:
+            # The pool ran dry on the last scale up or an active worker went away.
+            activated = r.execute_command(
+                "mantis.activate", target_active - curr_int_reps
+            )
+            curr_int_reps += len(activated)
         # fractional_value = msg["fractional_value"]
         curr_reps = curr_int_reps
 
+        msg.update(latency_status(interval_sketch, window_sketch))
+        if isinstance(ctl, BaseController):
+            ctl.observe_latency_sketches(interval_sketch, window_sketch)
+            ctl.observe_service_times(
+                (completions["_4_done_time"] - completions["_3_dequeue_time"]) * 1000
+            )
         action = ctl.get_action_from_state(
-            np.array(e2e_latencies) * 1000,
-            np.array(msg["real_arrival_ts_ns"]) / 1000,
+            e2e_latencies * 1000,
+            arrival_ts_ns / 1000,
             curr_reps,
-            sum(msg["queue_sizes"]),
+            sum(msg["queue_sizes"]) + msg["shared_queue_size"],
         )
-        if ctl_is_absolute:
-            target_reps = action
-            target_reps = max(target_reps, 1)
-            target_reps = min(target_reps, max_replicas)
-            msg["ctl_from"] = curr_reps
-            msg["ctl_action"] = action
-            msg["ctl_final_decision"] = target_reps
-            logger.msg(
-                "Descision is aboslute, scaling to", from_=curr_reps, to_=target_reps
-            )
-            scale(target_reps)
-        elif action != DONT_SCALE:
-            target_reps = curr_reps + action
-            target_reps = max(target_reps, 1)
-            target_reps = min(target_reps, max_replicas)
-            # PID adjustment
-            if action > 0:
-                target_reps = math.ceil(target_reps)  # Round up
-            if action < 0:
-                target_reps = math.floor(target_reps)  # Round down
-            logger.msg("Scaling to", from_=curr_reps, to_=target_reps, delta=action)
-            msg["ctl_from"] = curr_reps
-            msg["ctl_action"] = action
-            msg["ctl_final_decision"] = target_reps
-
-            scale(target_reps)
-        else:
+        target_reps = get_target_replicas(
+            action, curr_reps, max_replicas, ctl_is_absolute
+        )
+        if target_reps is None:
             msg["ctl_from"] = curr_reps
             msg["ctl_action"] = 0
             msg["ctl_final_decision"] = curr_reps
             logger.msg(f"Controller returned {DONT_SCALE}, skipping scaling")
+        else:
+            if ctl_is_absolute:
+                logger.msg(
+                    "Descision is aboslute, scaling to",
+                    from_=curr_reps,
+                    to_=target_reps,
+                )
+            else:
+                logger.msg("Scaling to", from_=curr_reps, to_=target_reps, delta=action)
+            msg["ctl_from"] = curr_reps
+            msg["ctl_action"] = action
+            msg["ctl_final_decision"] = target_reps
+            scale(target_reps, curr_reps)
 
-        writer.write_summary_dict(msg)
-        writer.flush()
+        writer.write_summary_dict(msg, arrival_ts_ns)
 
-        if r.get("load_gen_finished") and np.sum(msg["queue_sizes"]) == 0:
+        num_queued = np.sum(msg["queue_sizes"]) + msg["shared_queue_size"]
+        if r.get("load_gen_finished") and num_queued == 0:
             stop_condition_count_down -= 1
             logger.msg(
                 "About to trigger stopping",
@@ -464,7 +833,10 @@ def run_controller(
             result = {
                 "num_queries_received": num_queries_received,
                 "num_queries_total": num_queries_total,
-                "missing_queries": num_queries_total - num_queries_received,
+                "num_queries_shed": num_queries_shed,
+                "missing_queries": num_queries_total
+                - num_queries_received
+                - num_queries_shed,
             }
             writer.experiment_done(result)
             break
@@ -0,0 +1,436 @@
+import heapq
+import json
+import math
+import random
+from collections import OrderedDict, deque
+
+import click
+import numpy as np
+from structlog import get_logger
+
+from mantis.controllers import registry
+from mantis.load_gen import make_schedule
+from mantis.models import catalogs
+from mantis.controllers.base import BaseController
+from mantis.runner import get_controller, get_target_replicas, latency_status
+from mantis.sketch import LatencyWindow
+from mantis.util import parse_custom_args
+
+logger = get_logger()
+logger = logger.bind(role="simulator")
+
+# Service time in seconds measured on the real workers, used when --service-time
+# is not given. The sleep workloads take theirs from --workload-args.
+DEFAULT_SERVICE_TIMES = {
+    "vision": "normal:0.0314,0.00255",
+    "nlp": "normal:0.0517,0.000104",
+}
+# The policies of mantis.config that the simulator models. least_expected_work
+# would only add noise to join_shortest_queue with identical workers, and
+# shared_queue binds queries to workers late, which SimulatedWorker cannot.
+DISPATCH_POLICIES = ["round_robin", "join_shortest_queue", "power_of_d"]
+# What happens to the queries waiting on a worker that is scaled down.
+# redistribute is what the runner does, see mantis.drop_queue REDISTRIBUTE.
+SCALE_DOWN_MODES = ["redistribute", "drain", "drop"]
+
+
+def parse_service_time(spec):
+    """Parse "const:s", "exp:mean_s" or "normal:mean_s,std_s" into a sampler.
+
+    The sampler takes (rng, size) and returns non negative service times in s.
+    """
+    kind, _, params = spec.partition(":")
+    params = [float(p) for p in params.split(",") if p]
+    if kind == "const" and len(params) == 1:
+        return lambda rng, size: np.full(size, params[0])
+    if kind == "exp" and len(params) == 1:
+        return lambda rng, size: rng.exponential(params[0], size)
+    if kind == "normal" and len(params) == 2:
+        return lambda rng, size: np.clip(
+            rng.normal(params[0], params[1], size), 0, None
+        )
+    raise click.BadParameter(f"Unknown service time distribution {spec}")
+
+
+def default_service_time(workload, workload_args):
+    if workload in DEFAULT_SERVICE_TIMES:
+        return DEFAULT_SERVICE_TIMES[workload]
+    return "const:{}".format(parse_custom_args(workload_args)["sleep_time_s"])
+
+
+class SimulatedWorker:
+    """A single server FIFO queue, like one consumer popping its mantis queue.
+
+    Service times are known at dispatch, so the start and done time of a query
+    are fixed when it is enqueued and no completion events are needed.
+    """
+
+    def __init__(self, created_at, ready_at):
+        self.created_at = created_at
+        self.ready_at = ready_at
+        self.free_at = ready_at
+        self.retired_at = None
+        # (start_time, done_time, query index) of queries not done yet.
+        self.queue = deque()
+
+    def length(self, now):
+        # Matches the module: the query in service still counts.
+        while self.queue and self.queue[0][1] <= now:
+            self.queue.popleft()
+        return len(self.queue)
+
+    def enqueue(self, idx, arrival, service_time):
+        start = max(arrival, self.free_at)
+        self.free_at = start + service_time
+        self.queue.append((start, self.free_at, idx))
+        return self.free_at
+
+    def retire(self, now, drain):
+        """Stop the worker, returning the queries it will not serve."""
+        self.retired_at = now
+        if drain:
+            return []
+        self.length(now)
+        lost = [idx for start, _, idx in self.queue if start > now]
+        self.queue = deque(q for q in self.queue if q[0] <= now)
+        self.free_at = self.queue[-1][1] if self.queue else now
+        return lost
+
+    def busy_until(self):
+        return max(self.retired_at, self.free_at)
+
+
+class Simulation:
+    def __init__(
+        self,
+        ctl,
+        ctl_is_absolute,
+        start_replicas,
+        max_replicas,
+        startup_delay_s,
+        scale_down,
+        seed,
+        latency_window_intervals=12,
+        dispatch_policy="power_of_d",
+        power_of_d=2,
+    ):
+        assert scale_down in SCALE_DOWN_MODES
+        assert dispatch_policy in DISPATCH_POLICIES
+        self.ctl = ctl
+        self.ctl_is_absolute = ctl_is_absolute
+        self.max_replicas = max_replicas
+        self.startup_delay_s = startup_delay_s
+        self.scale_down = scale_down
+        self.dispatch_policy = dispatch_policy
+        self.power_of_d = power_of_d
+        self.round_robin_next = 0
+        self.rng = random.Random(seed)
+        self.active = [SimulatedWorker(0, 0) for _ in range(start_replicas)]
+        self.retired = []
+        self.latency_window = LatencyWindow(latency_window_intervals)
+
+    def ready_workers(self, now):
+        return [w for w in self.active if w.ready_at <= now]
+
+    def choose_worker(self, now):
+        """Pick a ready worker with the dispatch policy, as mantis.enqueue does."""
+        candidates = self.ready_workers(now)
+        if not candidates:
+            # Nothing is up yet, the query waits on the first worker to start.
+            return min(self.active, key=lambda w: w.ready_at)
+        if self.dispatch_policy == "round_robin":
+            self.round_robin_next += 1
+            return candidates[(self.round_robin_next - 1) % len(candidates)]
+        if self.dispatch_policy == "power_of_d" and self.power_of_d < len(candidates):
+            candidates = self.rng.sample(candidates, self.power_of_d)
+        # The shortest queue, ties are broken at random.
+        lengths = [w.length(now) for w in candidates]
+        shortest = min(lengths)
+        return self.rng.choice(
+            [w for w, n in zip(candidates, lengths) if n == shortest]
+        )
+
+    def scale(self, target_reps, now):
+        """Scale to target_reps, returning the queries taken off retired workers.
+
+        Those are lost with the drop mode and have to be dispatched again with
+        redistribute, unless no worker is ready to take them, then the retired
+        workers drain them like with the drain mode.
+        """
+        while len(self.active) < target_reps:
+            self.active.append(SimulatedWorker(now, now + self.startup_delay_s))
+        retiring = []
+        while len(self.active) > target_reps:
+            # Pods still starting up go first, like a deployment scaling down.
+            pending = [w for w in self.active if w.ready_at > now]
+            worker = pending[-1] if pending else self.rng.choice(self.active)
+            self.active.remove(worker)
+            self.retired.append(worker)
+            retiring.append(worker)
+
+        drain = self.scale_down == "drain" or (
+            self.scale_down == "redistribute" and not self.ready_workers(now)
+        )
+        taken = []
+        for worker in retiring:
+            taken.extend(worker.retire(now, drain))
+        return taken
+
+    def run(self, arrivals_s, service_times_s, controller_time_step):
+        """Replay arrivals_s, returning the e2e latency of every query in s.
+
+        Queries lost on scale down with the drop mode have a NaN latency.
+        """
+        num_queries = len(arrivals_s)
+        latencies_s = np.full(num_queries, np.nan)
+        completions = []  # heap of (done_time, query index)
+        self.status = []
+
+        next_query, now = 0, 0.0
+        if isinstance(self.ctl, BaseController):
+            self.ctl.observe_startup_delay(self.startup_delay_s)
+        while next_query < num_queries or completions:
+            now += controller_time_step
+            start_query = next_query
+            while next_query < num_queries and arrivals_s[next_query] < now:
+                arrival = arrivals_s[next_query]
+                worker = self.choose_worker(arrival)
+                done = worker.enqueue(next_query, arrival, service_times_s[next_query])
+                heapq.heappush(completions, (done, next_query))
+                next_query += 1
+
+            e2e_latencies, completed = [], []
+            while completions and completions[0][0] <= now:
+                done, idx = heapq.heappop(completions)
+                if np.isnan(latencies_s[idx]):
+                    latencies_s[idx] = done - arrivals_s[idx]
+                    e2e_latencies.append(latencies_s[idx])
+                    completed.append(idx)
+            e2e_latencies = np.array(e2e_latencies)
+            interval_sketch, window_sketch = self.latency_window.observe(
+                e2e_latencies * 1000
+            )
+            if isinstance(self.ctl, BaseController):
+                self.ctl.observe_latency_sketches(interval_sketch, window_sketch)
+                self.ctl.observe_service_times(service_times_s[completed] * 1000)
+            arrival_ts_ns = arrivals_s[start_query:next_query] * 1e9
+
+            ready = self.ready_workers(now)
+            queue_sizes = [w.length(now) for w in ready]
+            curr_reps = len(ready)
+            action = self.ctl.get_action_from_state(
+                e2e_latencies * 1000,
+                arrival_ts_ns / 1000,
+                curr_reps,
+                sum(queue_sizes),
+            )
+            target_reps = get_target_replicas(
+                action, curr_reps, self.max_replicas, self.ctl_is_absolute
+            )
+            taken = []
+            if target_reps is not None:
+                taken = self.scale(target_reps, now)
+            lost, redistributed = [], []
+            if taken:
+                # Their retired worker will not complete them, drop the stale
+                # heap entries.
+                taken_set = set(taken)
+                completions = [c for c in completions if c[1] not in taken_set]
+                if self.scale_down == "redistribute":
+                    redistributed = taken
+                    for idx in taken:
+                        worker = self.choose_worker(now)
+                        done = worker.enqueue(idx, now, service_times_s[idx])
+                        completions.append((done, idx))
+                else:
+                    lost = taken
+                    latencies_s[lost] = np.inf
+                heapq.heapify(completions)
+
+            self.status.append(
+                {
+                    "current_ts_s": now,
+                    "num_arrivals": len(arrival_ts_ns),
+                    "num_completions": len(e2e_latencies),
+                    "num_lost": len(lost),
+                    "num_redistributed": len(redistributed),
+                    "queue_sizes": queue_sizes,
+                    "ctl_from": curr_reps,
+                    "ctl_action": 0 if target_reps is None else action,
+                    "ctl_final_decision": len(self.active),
+                    **latency_status(interval_sketch, window_sketch),
+                }
+            )
+
+        latencies_s[np.isinf(latencies_s)] = np.nan
+        return latencies_s
+
+    def replica_seconds(self, end):
+        total = sum(w.busy_until() - w.created_at for w in self.retired)
+        return total + sum(end - w.created_at for w in self.active)
+
+
+def test_simulation_single_worker():
+    ctl, ctl_is_absolute = get_controller("fixed", "action=0", 1)
+    sim = Simulation(ctl, ctl_is_absolute, 1, 1, 0, "drain", seed=0)
+    arrivals = np.array([0.0, 0.01, 0.05])
+    latencies = sim.run(arrivals, np.full(3, 0.02), controller_time_step=1)
+    assert np.allclose(latencies, [0.02, 0.03, 0.02])
+    assert sim.status[0]["num_completions"] == 3
+
+
+def test_simulation_startup_delay_and_drain():
+    ctl, ctl_is_absolute = get_controller("fixed", "action=1", 1)
+    sim = Simulation(ctl, ctl_is_absolute, 1, 2, 5, "drain", seed=0)
+    arrivals = np.arange(0, 12, 0.5)
+    sim.run(arrivals, np.full(len(arrivals), 0.1), controller_time_step=1)
+    # The second replica is requested at t=1 and only counts once it is ready.
+    assert [s["ctl_from"] for s in sim.status[:7]] == [1, 1, 1, 1, 1, 2, 2]
+
+    worker = SimulatedWorker(0, 0)
+    for i in range(3):
+        worker.enqueue(i, 0, 0.1)
+    # The query in service finishes, the one behind it is lost.
+    assert worker.retire(0.15, drain=False) == [2]
+    assert worker.busy_until() == 0.2
+
+
+def test_simulation_scale_down():
+    max_latency = {}
+    for scale_down in SCALE_DOWN_MODES:
+        ctl, ctl_is_absolute = get_controller("fixed", "action=-1", 2)
+        sim = Simulation(
+            ctl, ctl_is_absolute, 2, 2, 0, scale_down, 0, dispatch_policy="round_robin"
+        )
+        latencies = sim.run(np.zeros(10), np.full(10, 0.4), controller_time_step=1)
+        # Each worker has two queries waiting when one is scaled down at t=1.
+        assert sum(s["num_lost"] + s["num_redistributed"] for s in sim.status) == (
+            0 if scale_down == "drain" else 2
+        )
+        assert np.isnan(latencies).sum() == (2 if scale_down == "drop" else 0)
+        max_latency[scale_down] = np.nanmax(latencies)
+    # Redistributed queries wait behind the queue of the remaining worker.
+    assert np.isclose(max_latency["drain"], 2.0)
+    assert np.isclose(max_latency["redistribute"], 2.8)
+
+
+def test_get_controller_run_args():
+    ctl, _ = get_controller(
+        "erlang_c", "max_replicas=72", 1, control_interval_s=2, max_replicas=8
+    )
+    assert ctl.control_interval_s == 2 and ctl.max_replicas == 8
+    # Controllers without these settings are left alone.
+    get_controller("fixed", "action=0", 1, control_interval_s=2, max_replicas=8)
+
+
+@click.command()
+@click.option("--load", required=True, type=click.Path(exists=True))
+@click.option("--workload", required=True, type=click.Choice(list(catalogs.keys())))
+@click.option("--workload-args", default="", type=str)
+@click.option("--controller", required=True, type=click.Choice(list(registry.keys())))
+@click.option("--controller-args", default="", type=str)
+@click.option("--max-replicas", type=int, default=72)
+@click.option("--start-replicas", type=int, default=5)
+@click.option("--controller-time-step", type=float, default=5)
+@click.option("--latency-window-s", type=float, default=60)
+@click.option(
+    "--service-time",
+    default=None,
+    help="const:s, exp:mean_s or normal:mean_s,std_s. "
+    "Defaults to the measured service time of the workload.",
+)
+@click.option(
+    "--startup-delay-s",
+    type=float,
+    default=10,
+    help="Time from scaling up until a new worker serves queries.",
+)
+@click.option(
+    "--scale-down",
+    type=click.Choice(SCALE_DOWN_MODES),
+    default="redistribute",
+    help="What happens to the queries waiting on a scaled down worker: "
+    "dispatched to the other workers as the runner does, served by the worker "
+    "before it exits, or lost.",
+)
+@click.option(
+    "--dispatch-policy",
+    type=click.Choice(DISPATCH_POLICIES),
+    default="power_of_d",
+    help="How queries are dispatched to workers, see the runner. "
+    "least_expected_work and shared_queue are not simulated.",
+)
+@click.option(
+    "--power-of-d",
+    type=int,
+    default=2,
+    help="Workers sampled per query by the power_of_d policy.",
+)
+@click.option("--seed", type=int, default=0)
+@click.option("--output", type=click.Path(), default=None, help="Per interval jsonl.")
+def simulate(
+    load,
+    workload,
+    workload_args,
+    controller,
+    controller_args,
+    max_replicas,
+    start_replicas,
+    controller_time_step,
+    latency_window_s,
+    service_time,
+    startup_delay_s,
+    scale_down,
+    dispatch_policy,
+    power_of_d,
+    seed,
+    output,
+):
+    """Replay a load trace against a controller without a cluster."""
+    ctl, ctl_is_absolute = get_controller(
+        controller,
+        controller_args,
+        start_replicas,
+        control_interval_s=controller_time_step,
+        max_replicas=max_replicas,
+    )
+    if service_time is None:
+        service_time = default_service_time(workload, workload_args)
+    sampler = parse_service_time(service_time)
+
+    arrivals_s = make_schedule(np.load(load)) / 1000
+    service_times_s = sampler(np.random.RandomState(seed), len(arrivals_s))
+    logger.msg("Simulating", num_queries=len(arrivals_s), service_time=service_time)
+
+    sim = Simulation(
+        ctl,
+        ctl_is_absolute,
+        start_replicas,
+        max_replicas,
+        startup_delay_s,
+        scale_down,
+        seed,
+        math.ceil(latency_window_s / controller_time_step),
+        dispatch_policy,
+        power_of_d,
+    )
+    latencies_s = sim.run(arrivals_s, service_times_s, controller_time_step)
+    end = sim.status[-1]["current_ts_s"]
+
+    if output:
+        with open(output, "w") as f:
+            for status in sim.status:
+                f.write(json.dumps(status) + "\n")
+
+    served = latencies_s[~np.isnan(latencies_s)] * 1000
+    percentiles = [50, 90, 99, 99.9, 100]
+    logger.msg(
+        "Simulation finished!",
+        num_lost=int(np.isnan(latencies_s).sum()),
+        num_redistributed=sum(s["num_redistributed"] for s in sim.status),
+        replica_seconds=f"{sim.replica_seconds(end):.1f}",
+        **OrderedDict(
+            (f"e2e_ms_p{p}", f"{v:.3f}")
+            for p, v in zip(percentiles, np.percentile(served, percentiles))
+        ),
+    )
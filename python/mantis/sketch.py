@@ -0,0 +1,135 @@
+import math
+from collections import Counter, deque
+
+import numpy as np
+
+# Quantiles reported in the status output and logs.
+REPORTED_QUANTILES = [0.25, 0.5, 0.95, 0.99, 1.0]
+
+
+class DDSketch:
+    """Mergeable quantile sketch with a bounded relative error.
+
+    Values are counted in logarithmic buckets, so any quantile is within
+    relative_accuracy of the exact one. Memory only grows with the dynamic
+    range of the values, not with their number. Values at or below min_value
+    are counted together as zero.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-6):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = Counter()
+        self.zero_count = 0
+        self.count = 0
+        self.max = -math.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.max = max(self.max, float(values.max()))
+        positive = values[values > self.min_value]
+        self.zero_count += len(values) - len(positive)
+        keys, counts = np.unique(
+            np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+            return_counts=True,
+        )
+        self.bins.update(dict(zip(keys.tolist(), counts.tolist())))
+
+    def merge(self, other):
+        assert other.gamma == self.gamma, "Can only merge sketches of equal accuracy"
+        self.bins.update(other.bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                # Midpoint of (gamma^(key-1), gamma^key] in relative terms.
+                return min(2 * self.gamma**key / (self.gamma + 1), self.max)
+        return self.max
+
+    def quantiles(self, qs=REPORTED_QUANTILES):
+        return {f"p{q * 100:g}": self.quantile(q) for q in qs}
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "min_value": self.min_value,
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "max": self.max if self.count else None,
+            "bins": {str(k): v for k, v in sorted(self.bins.items())},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"], data["min_value"])
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.max = -math.inf if data["max"] is None else data["max"]
+        sketch.bins = Counter({int(k): v for k, v in data["bins"].items()})
+        return sketch
+
+
+class LatencyWindow:
+    """Per interval latency sketches, merged over the last num_intervals."""
+
+    def __init__(self, num_intervals, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.intervals = deque(maxlen=max(int(num_intervals), 1))
+
+    def observe(self, latencies_ms):
+        """Add one control interval, returning its sketch and the window's."""
+        interval = DDSketch(self.relative_accuracy)
+        interval.add(latencies_ms)
+        self.intervals.append(interval)
+        window = DDSketch(self.relative_accuracy)
+        for sketch in self.intervals:
+            window.merge(sketch)
+        return interval, window
+
+
+def test_sketch_relative_error():
+    values = np.random.RandomState(0).lognormal(3, 1, 100000)
+    sketch = DDSketch(relative_accuracy=0.01)
+    sketch.add(values[:50000])
+    other = DDSketch(relative_accuracy=0.01)
+    other.add(values[50000:])
+    sketch.merge(other)
+
+    ordered = np.sort(values)
+    for q in [0.01, 0.5, 0.9, 0.99, 0.999]:
+        exact = ordered[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+    assert sketch.quantile(1) == values.max()
+    assert len(sketch.bins) < 1000
+
+    restored = DDSketch.from_dict(sketch.to_dict())
+    assert restored.quantiles() == sketch.quantiles()
+
+
+def test_latency_window():
+    window = LatencyWindow(num_intervals=2)
+    window.observe([1000.0] * 10)
+    interval, merged = window.observe([10.0] * 90)
+    assert interval.count == 90 and merged.count == 100
+    assert merged.quantile(0.99) > 900
+    interval, merged = window.observe([])
+    assert math.isnan(interval.quantile(0.99))
+    assert merged.count == 90
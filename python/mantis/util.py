@@ -1,5 +1,7 @@
 import os
 import json
+import time
+from collections import OrderedDict
 
 import requests
 from structlog import get_logger
@@ -18,6 +20,19 @@ def parse_custom_args(custom_args):
     return init_args
 
 
+class PhaseTimer:
+    """Wall clock duration of consecutive phases, e.g. of a worker start up."""
+
+    def __init__(self):
+        self.durations_s = OrderedDict()
+        self._phase_start = time.time()
+
+    def end_phase(self, name):
+        now = time.time()
+        self.durations_s[name] = now - self._phase_start
+        self._phase_start = now
+
+
 def post_result_to_slack(markdown_result, text_to_image_links={}):
     url = os.environ["SLACK_ENDPOINT"]
 
@@ -1,12 +1,24 @@
+#include <strings.h>
+
+#include <algorithm>
+#include <array>
 #include <chrono>
+#include <cstring>
 #include <iostream>
 #include <iterator>
+#include <map>
 #include <numeric>
 #include <random>
 #include <string_view>
+#include <unordered_map>
+#include <unordered_set>
+#include <utility>
+#include <vector>
 
 #include "glog/logging.h"
 #include "json.hpp"
+// For the module timers, see sweep_dead_queues.
+#define REDISMODULE_EXPERIMENTAL_API
 #include "redismodule.h"
 
 #define CAT_I(a, b) a##b
@@ -15,88 +27,389 @@
 
 #define MANTIS_DEBUG
 
-constexpr std::string_view ACTIVE_QUEUES = "active_queues";
-constexpr std::string_view REMOVED_QUEUES = "removed_queues";
-constexpr std::string_view REAL_TIMESTAMPS_NS = "real_timestamp";
 constexpr std::string_view FRACTIONAL_PROB = "fractional_prob";
 constexpr std::string_view COMPLETION_QUEUE = "completion_queue";
-constexpr std::string_view QUEUE_EVENTS = "queue_events";
-constexpr std::string_view HEALTH_CHECK_ZSET = "health-checks";
+// Queries waiting for a worker under the shared_queue dispatch policy.
+constexpr std::string_view SHARED_QUEUE = "shared_queue";
+// With the stream backend every worker queue is a stream read by its worker
+// through this consumer group, see mantis/consume.py.
+constexpr const char *STREAM_GROUP = "mantis";
+constexpr const char *STREAM_QUERY_FIELD = "query";
+// Consumer that takes entries off a stream to dispatch them again.
+constexpr const char *STREAM_RECLAIMER = "mantis-reclaim";
+// Streams need Redis 5, and XAUTOCLAIM for mantis.reclaim needs Redis 6.2.
+constexpr long long STREAM_MIN_REDIS_VERSION = 60200;
+
+// How often the liveness of the registered queues is re-evaluated. Dead queues
+// are noticed up to this late, but it walks CLIENT LIST. A heartbeat slack below
+// twice this shortens it, see sweep_interval_ms.
+long long LIVENESS_SWEEP_INTERVAL_MS = 500;
 
-inline std::vector<std::string> get_array_reply(RedisModuleCallReply *data_array) {
-  size_t data_length = RedisModule_CallReplyLength(data_array);
+inline long long get_current_time_ns() {
+  return std::chrono::duration_cast<std::chrono::nanoseconds>(
+             std::chrono::system_clock::now().time_since_epoch())
+      .count();
+}
 
-  std::vector<std::string> array;
-  array.reserve(data_length);
+// Binary envelope for queries and completions, shared with mantis/envelope.py.
+// A fixed size header (native little endian layout) is followed by the raw
+// payload bytes, or by the raw result bytes once the query is completed.
+constexpr size_t WORKER_ID_SIZE = 32;
+struct QueryHeader {
+  int64_t query_id;
+  char worker_id[WORKER_ID_SIZE];  // Zero padded, not null terminated if full.
+  // Non zero if the body is a payload handle from mantis.put_payload rather
+  // than the payload itself.
+  uint64_t payload_digest;
+  // Time by which the query has to be done, 0 if it has none. Workers skip
+  // queries whose deadline passed while queued, see mantis.expire.
+  double deadline;
+  double lg_sent_time;
+  double enqueue_time;
+  double dequeue_time;
+  double done_time;
+};
+static_assert(sizeof(QueryHeader) == 88, "QueryHeader must match mantis/envelope.py");
+
+inline std::string get_worker_id(const QueryHeader &header) {
+  return std::string(header.worker_id, strnlen(header.worker_id, WORKER_ID_SIZE));
+}
 
-  for (size_t i = 0; i < data_length; i++) {
-    size_t str_len;
-    const char *char_ptr = RedisModule_CallReplyStringPtr(
-        RedisModule_CallReplyArrayElement(data_array, i), &str_len);
-    std::string truncated(char_ptr, str_len);
-    array.push_back(truncated);
+// Fixed capacity buffer of arrival timestamps. When mantis.status is not called
+// often enough the oldest timestamps are overwritten and counted.
+class TimestampRing {
+ public:
+  explicit TimestampRing(size_t capacity) : buffer_(capacity) {}
+
+  void push(int64_t timestamp_ns) {
+    buffer_[(start_ + size_) % buffer_.size()] = timestamp_ns;
+    if (size_ < buffer_.size()) {
+      size_ += 1;
+    } else {
+      start_ = (start_ + 1) % buffer_.size();
+      overwritten_ += 1;
+    }
   }
 
-  return array;
+  // Copy the timestamps out, oldest first, and empty the buffer.
+  std::vector<int64_t> drain() {
+    std::vector<int64_t> timestamps(size_);
+    size_t first_part = std::min(size_, buffer_.size() - start_);
+    std::copy_n(buffer_.begin() + start_, first_part, timestamps.begin());
+    std::copy_n(buffer_.begin(), size_ - first_part, timestamps.begin() + first_part);
+    start_ = 0;
+    size_ = 0;
+    return timestamps;
+  }
+
+  long long take_overwritten() { return std::exchange(overwritten_, 0); }
+
+ private:
+  std::vector<int64_t> buffer_;
+  size_t start_ = 0;
+  size_t size_ = 0;
+  long long overwritten_ = 0;
+};
+
+// Enough for 10k qps over a 100 seconds status interval.
+constexpr size_t ARRIVAL_TIMESTAMPS_CAPACITY = 1 << 20;
+
+struct QueueState {
+  long long last_heartbeat_ns = 0;
+  // Set by sweep_dead_queues, so that the enqueue path only reads a flag.
+  bool dead = false;
+  // Whether a client named after the queue was ever connected at a sweep. The
+  // queue is dead while that connection is gone.
+  bool named_connection = false;
+  // Set by sweep_dead_queues while that connection is gone. Heartbeats and
+  // completions sent over other connections do not revive the queue meanwhile.
+  bool disconnected = false;
+  // Number of queries dispatched to this queue that are not completed yet. This
+  // includes the query the worker is currently working on.
+  long long length = 0;
+  // Moving average of the measured service time, 0 until the first completion.
+  double service_time_s = 0;
+  // A stream read through STREAM_GROUP rather than a list, fixed when the queue
+  // is first registered.
+  bool stream = false;
+};
+
+// The module keeps its own view of the worker queues so that the enqueue and
+// status paths never have to go through RedisModule_Call to find out which
+// queues exist, whether they are alive, and how long they are.
+struct QueueRegistry {
+  std::unordered_map<std::string, QueueState> queues;
+  // Active queues, in registration order. A vector makes sampling O(1).
+  std::vector<std::string> active;
+  // Registered queues of warm workers that get no queries until they are moved
+  // to `active` by mantis.activate.
+  std::vector<std::string> standby;
+  // Dropped queues that still have outstanding queries.
+  std::unordered_set<std::string> dropped;
+
+  // Drained by mantis.status
+  TimestampRing arrival_timestamps_ns{ARRIVAL_TIMESTAMPS_CAPACITY};
+  std::vector<std::string> events;
+};
+
+QueueRegistry registry;
+
+// How mantis.enqueue picks a queue, set with mantis.config.
+enum DispatchPolicy {
+  ROUND_ROBIN,
+  JOIN_SHORTEST_QUEUE,
+  POWER_OF_D,
+  // Fewest queued queries times the measured service time of the queue.
+  LEAST_EXPECTED_WORK,
+  // Queries wait in SHARED_QUEUE and every worker queue is refilled up to
+  // `prefetch` queries as its queries complete.
+  SHARED_QUEUE_PULL,
+  NUM_DISPATCH_POLICIES,
+};
+
+constexpr std::array<std::string_view, NUM_DISPATCH_POLICIES> DISPATCH_POLICY_NAMES = {
+    "round_robin", "join_shortest_queue", "power_of_d", "least_expected_work",
+    "shared_queue"};
+
+// Weight of a new sample in QueueState::service_time_s.
+constexpr double SERVICE_TIME_EWMA_ALPHA = 0.2;
+
+struct Dispatcher {
+  DispatchPolicy policy = POWER_OF_D;
+  long long d = 2;
+  long long prefetch = 2;
+  // Queues registered from now on are streams rather than lists.
+  bool streams = false;
+  size_t round_robin_next = 0;
+  // Service time of all queues, the prior for queues without completions.
+  double service_time_s = 0;
+  // Queries get a deadline this long after they were sent, 0 for none.
+  double deadline_ms = 0;
+  // A queue without heartbeat or completion for this long is dead. Has to be
+  // longer than POP_TIMEOUT_S in mantis/consume.py, the heartbeat interval of
+  // idle workers, and than the longest batch of a busy one.
+  long long heartbeat_slack_ms = 5000;
+  // Queries dispatched by each policy since the last mantis.status.
+  std::array<long long, NUM_DISPATCH_POLICIES> counts{};
+  // Queries since the last mantis.status that were moved to another queue to
+  // make their deadline, rejected by mantis.enqueue because no queue could
+  // make it, or skipped by their worker because it had passed.
+  long long diverted = 0;
+  long long rejected = 0;
+  long long expired = 0;
+};
+
+Dispatcher dispatcher;
+
+// Content addressed payload store. Load generators upload the payload once with
+// mantis.put_payload and enqueue the returned handle instead of the bytes;
+// workers fetch the bytes with mantis.get_payload and cache them by handle.
+constexpr std::string_view PAYLOAD_HANDLE_PREFIX = "payload:";
+constexpr size_t PAYLOAD_HANDLE_SIZE = PAYLOAD_HANDLE_PREFIX.size() + 16;
+
+struct PayloadEntry {
+  std::string data;
+  // One reference per put_payload not yet released plus one per query in flight.
+  long long refcount = 0;
+};
+
+std::unordered_map<uint64_t, PayloadEntry> payload_store;
+
+// 64 bit FNV-1a
+inline uint64_t hash_payload(std::string_view data) {
+  uint64_t hash = 14695981039346656037ULL;
+  for (unsigned char c : data) {
+    hash ^= c;
+    hash *= 1099511628211ULL;
+  }
+  return hash == 0 ? 1 : hash;  // 0 means inline payload in QueryHeader
 }
 
-inline long long get_current_time_ns() {
-  return std::chrono::duration_cast<std::chrono::nanoseconds>(
-             std::chrono::system_clock::now().time_since_epoch())
-      .count();
+inline std::string make_payload_handle(uint64_t digest) {
+  char hex[17];
+  snprintf(hex, sizeof(hex), "%016llx", static_cast<unsigned long long>(digest));
+  return std::string(PAYLOAD_HANDLE_PREFIX) + hex;
 }
 
-inline long long get_queue_length(RedisModuleCtx *ctx, std::string queue_name) {
-  RedisModuleCallReply *reply;
-  reply = RedisModule_Call(ctx, "LLEN", "c", queue_name.c_str());
-  long long length = RedisModule_CallReplyInteger(reply);
-  return length;
+// Returns the digest if `payload` is a payload handle, 0 otherwise.
+inline uint64_t parse_payload_handle(std::string_view payload) {
+  if (payload.size() != PAYLOAD_HANDLE_SIZE ||
+      payload.substr(0, PAYLOAD_HANDLE_PREFIX.size()) != PAYLOAD_HANDLE_PREFIX) {
+    return 0;
+  }
+  std::string hex(payload.substr(PAYLOAD_HANDLE_PREFIX.size()));
+  char *end;
+  uint64_t digest = std::strtoull(hex.c_str(), &end, 16);
+  if (*end != '\0') return 0;
+  return digest;
 }
 
-bool queue_is_active(RedisModuleCtx *ctx, std::string queue_name) {
-  RedisModuleCallReply *reply;
-  reply =
-      RedisModule_Call(ctx, "SISMEMBER", "cc", ACTIVE_QUEUES.data(), queue_name.c_str());
-  long long is_active = RedisModule_CallReplyInteger(reply);
-  return (is_active == 1);
+// False if `payload_str` is the handle of a payload that is not in the store.
+inline bool is_known_payload(RedisModuleString *payload_str) {
+  size_t payload_len;
+  const char *payload = RedisModule_StringPtrLen(payload_str, &payload_len);
+  uint64_t digest = parse_payload_handle(std::string_view(payload, payload_len));
+  return digest == 0 || payload_store.find(digest) != payload_store.end();
 }
 
-inline std::vector<std::string> get_active_queues(RedisModuleCtx *ctx) {
-  RedisModuleCallReply *reply;
-  reply = RedisModule_Call(ctx, "SMEMBERS", "c", ACTIVE_QUEUES.data());
-  std::vector<std::string> queues = get_array_reply(reply);
-  return queues;
+inline void release_payload(uint64_t digest) {
+  auto it = payload_store.find(digest);
+  if (it == payload_store.end()) return;
+  if (--it->second.refcount <= 0) payload_store.erase(it);
 }
+std::mt19937 rng{std::random_device{}()};
 
-inline std::vector<std::string> get_removed_queus(RedisModuleCtx *ctx) {
-  // Retrieve all members
-  RedisModuleCallReply *reply;
-  reply = RedisModule_Call(ctx, "SMEMBERS", "c", REMOVED_QUEUES.data());
-  std::vector<std::string> queues = get_array_reply(reply);
-
-  // Filter out those are queues are cleared already
-  std::vector<std::string> still_not_empty_queues;
-  std::vector<std::string> empty_queues;
-  for (auto &name : queues) {
-    reply = RedisModule_Call(ctx, "LLEN", "c", name.c_str());
-    auto length = RedisModule_CallReplyInteger(reply);
-    if (length == 0) {
-      empty_queues.push_back(name);
-    } else {
-      still_not_empty_queues.push_back(name);
+// Version of the server as major * 10000 + minor * 100 + patch, read at load.
+long long redis_version = 0;
+
+long long get_redis_version(RedisModuleCtx *ctx) {
+  RedisModuleCallReply *reply = RedisModule_Call(ctx, "INFO", "c", "server");
+  if (reply == nullptr) return 0;
+  long long version = 0;
+  if (RedisModule_CallReplyType(reply) == REDISMODULE_REPLY_STRING) {
+    size_t len;
+    const char *ptr = RedisModule_CallReplyStringPtr(reply, &len);
+    std::string info(ptr, len);
+    constexpr std::string_view VERSION_FIELD = "redis_version:";
+    size_t pos = info.find(VERSION_FIELD);
+    int major = 0, minor = 0, patch = 0;
+    if (pos != std::string::npos && sscanf(info.c_str() + pos + VERSION_FIELD.size(),
+                                           "%d.%d.%d", &major, &minor, &patch) >= 2) {
+      version = major * 10000LL + minor * 100 + patch;
+    }
+  }
+  RedisModule_FreeCallReply(reply);
+  return version;
+}
+
+inline void push_to_list(RedisModuleCtx *ctx, std::string_view key_name,
+                         std::string_view value, int where = REDISMODULE_LIST_TAIL) {
+  RedisModuleString *key_str =
+      RedisModule_CreateString(ctx, key_name.data(), key_name.size());
+  RedisModuleKey *key =
+      static_cast<RedisModuleKey *>(RedisModule_OpenKey(ctx, key_str, REDISMODULE_WRITE));
+  RedisModuleString *value_str =
+      RedisModule_CreateString(ctx, value.data(), value.size());
+  RedisModule_ListPush(key, where, value_str);
+}
+
+inline long long get_queue_length(RedisModuleCtx *ctx, std::string_view queue_name) {
+  RedisModuleString *key_str =
+      RedisModule_CreateString(ctx, queue_name.data(), queue_name.size());
+  RedisModuleKey *key =
+      static_cast<RedisModuleKey *>(RedisModule_OpenKey(ctx, key_str, REDISMODULE_READ));
+  if (key == nullptr) return 0;
+  return RedisModule_ValueLength(key);
+}
+
+inline void update_heartbeat(const std::string &queue) {
+  auto it = registry.queues.find(queue);
+  if (it == registry.queues.end()) return;
+  it->second.last_heartbeat_ns = get_current_time_ns();
+  it->second.dead = it->second.disconnected;
+}
+
+inline bool is_queue_dead(const std::string &queue_name) {
+  return registry.queues[queue_name].dead;
+}
+
+// Names of the connected clients, parsed from CLIENT LIST.
+std::unordered_set<std::string> get_client_names(RedisModuleCtx *ctx) {
+  std::unordered_set<std::string> names;
+  RedisModuleCallReply *reply = RedisModule_Call(ctx, "CLIENT", "c", "LIST");
+  if (reply == nullptr) return names;
+  if (RedisModule_CallReplyType(reply) == REDISMODULE_REPLY_STRING) {
+    size_t len;
+    const char *ptr = RedisModule_CallReplyStringPtr(reply, &len);
+    std::string_view clients(ptr, len);
+    constexpr std::string_view NAME_FIELD = " name=";
+    size_t pos = 0;
+    while ((pos = clients.find(NAME_FIELD, pos)) != std::string_view::npos) {
+      pos += NAME_FIELD.size();
+      size_t end = clients.find_first_of(" \n", pos);
+      if (end == std::string_view::npos) end = clients.size();
+      if (end > pos) names.emplace(clients.substr(pos, end - pos));
+      pos = end;
     }
   }
+  RedisModule_FreeCallReply(reply);
+  return names;
+}
 
-  for (auto &name : empty_queues) {
-    reply = RedisModule_Call(ctx, "SREM", "cc", REMOVED_QUEUES.data(), name.c_str());
+long long last_sweep_ns = 0;
+
+// A queue is alive while its heartbeat is recent. Workers only send heartbeats
+// when idle, and completions count as heartbeats too. Workers also name their
+// connection after their queue, so that a worker whose connection closed is
+// dead right away rather than after the slack. A connection that stays open,
+// half-open after a node is lost or of a hung worker, does not keep it alive.
+void sweep_dead_queues(RedisModuleCtx *ctx) {
+  long long current_ns = get_current_time_ns();
+  last_sweep_ns = current_ns;
+  std::unordered_set<std::string> connected = get_client_names(ctx);
+
+  for (auto &[queue_name, state] : registry.queues) {
+    auto time_passed_ns = current_ns - state.last_heartbeat_ns;
+    bool is_connected = connected.count(queue_name) > 0;
+    state.disconnected = state.named_connection && !is_connected;
+    if (is_connected) state.named_connection = true;
+    bool dead =
+        state.disconnected || time_passed_ns > dispatcher.heartbeat_slack_ms * 1000000;
+    if (dead && !state.dead) {
+      LOG(WARNING) << "Missed heartbeat for queue=" << queue_name
+                   << " treating is as dead. time_passed_ms="
+                   << ((double)time_passed_ns / 1e6)
+                   << (state.disconnected ? ", its connection closed." : ".");
+    }
+    state.dead = dead;
   }
+}
+
+// At least two sweeps per heartbeat slack, so that a silent queue is found dead
+// within one and a half times the slack.
+inline long long sweep_interval_ms() {
+  return std::max(
+      1LL, std::min(LIVENESS_SWEEP_INTERVAL_MS, dispatcher.heartbeat_slack_ms / 2));
+}
+
+RedisModuleTimerID sweep_timer = 0;
 
-  return still_not_empty_queues;
+void sweep_timer_callback(RedisModuleCtx *ctx, void *data) {
+  REDISMODULE_NOT_USED(data);
+  sweep_dead_queues(ctx);
+  sweep_timer =
+      RedisModule_CreateTimer(ctx, sweep_interval_ms(), sweep_timer_callback, nullptr);
 }
 
-inline void update_heartbeat(RedisModuleCtx *ctx, std::string queue) {
-  std::string key = "heartbeat/" + queue;
-  RedisModule_Call(ctx, "SET", "cl", key.c_str(), get_current_time_ns());
+// Re-arms the sweep timer, e.g. after the heartbeat slack changed. Not to be
+// called from the timer callback, the server frees the timer that fired.
+void reschedule_sweep(RedisModuleCtx *ctx) {
+  if (RedisModule_CreateTimer == nullptr) return;
+  RedisModule_StopTimer(ctx, sweep_timer, nullptr);
+  sweep_timer =
+      RedisModule_CreateTimer(ctx, sweep_interval_ms(), sweep_timer_callback, nullptr);
+}
+
+// Servers without module timers (before Redis 5) sweep from the commands that
+// read the liveness instead.
+inline void maybe_sweep_dead_queues(RedisModuleCtx *ctx) {
+  if (RedisModule_CreateTimer != nullptr) return;
+  if (get_current_time_ns() - last_sweep_ns > sweep_interval_ms() * 1000000) {
+    sweep_dead_queues(ctx);
+  }
+}
+
+inline std::string make_event_string(std::string type, std::string queue_name,
+                                     const nlohmann::json &startup = nullptr) {
+  long long curr_time = get_current_time_ns();
+  nlohmann::json event;
+  event["time_ns"] = curr_time;
+  event["type"] = type;
+  event["queue_id"] = queue_name;
+  if (!startup.is_null()) event["startup"] = startup;
+  std::string serialized_event = event.dump();
+  LOG(INFO) << "Created event" << serialized_event;
+  return serialized_event;
 }
 
 // mantis.health uuid
@@ -106,186 +419,685 @@ int MantisCommand(HEALTH)(RedisModuleCtx *ctx, RedisModuleString **argv, int arg
 
   size_t _;
   std::string uuid_s = RedisModule_StringPtrLen(argv[1], &_);
-  update_heartbeat(ctx, uuid_s);
+  update_heartbeat(uuid_s);
 
   RedisModule_ReplyWithNull(ctx);
   return REDISMODULE_OK;
 }
 
-long long HEARTBEAT_SLACK_DURATION_MS = 100;
+std::string choose_round_robin(const std::vector<std::string> &queues) {
+  for (size_t tries = 0; tries < queues.size(); tries++) {
+    const std::string &name = queues[dispatcher.round_robin_next++ % queues.size()];
+    if (!is_queue_dead(name)) return name;
+  }
+  return "";
+}
 
-inline bool is_queue_dead(RedisModuleCtx *ctx, std::string queue_name) {
-  std::string namespaced_queue_name = "heartbeat/" + queue_name;
-  RedisModuleCallReply *reply;
-  reply = RedisModule_Call(ctx, "GET", "c", namespaced_queue_name.c_str());
-  int reply_type = RedisModule_CallReplyType(reply);
-  if (reply_type == REDISMODULE_REPLY_NULL) {
-    LOG_FIRST_N(WARNING, 3) << "No heartbeat received for queue=" << queue_name
-                            << " treating it as dead.";
-    return true;  // No heartbeat, assume not available
+// The healthy queue with the smallest cost, ties are broken at random.
+template <typename Cost>
+std::string choose_min_cost(const std::vector<std::string> &queues, Cost cost) {
+  std::string chosen;
+  double min_cost = 0;
+  size_t num_ties = 0;
+  for (const std::string &name : queues) {
+    if (is_queue_dead(name)) continue;
+    double queue_cost = cost(registry.queues[name]);
+    if (chosen.empty() || queue_cost < min_cost) {
+      chosen = name;
+      min_cost = queue_cost;
+      num_ties = 1;
+    } else if (queue_cost == min_cost &&
+               std::uniform_int_distribution<size_t>(0, num_ties++)(rng) == 0) {
+      chosen = name;
+    }
   }
-  size_t _;
-  std::string heartbeat_s = RedisModule_CallReplyStringPtr(reply, &_);
-  auto heartbeat_ns = std::stoll(heartbeat_s);
-  auto current_ns = get_current_time_ns();
-  auto time_passed_ns = current_ns - heartbeat_ns;
+  return chosen;
+}
 
-  if (time_passed_ns > HEARTBEAT_SLACK_DURATION_MS * 1000000) {
-    LOG_FIRST_N(WARNING, 3) << "Missed heartbeat for queue=" << queue_name
-                            << " treating is as dead. time_passed_ms="
-                            << ((double)time_passed_ns / 1e6) << ".";
-    return true;  // Heartbeat slack exceeded.
+// Shortest of d distinct healthy queues sampled from `queues`.
+std::string choose_power_of_d(const std::vector<std::string> &queues, size_t d) {
+  auto queue_length = [](const QueueState &state) { return state.length; };
+  if (d >= queues.size()) return choose_min_cost(queues, queue_length);
+
+  // Fast path: sample from all queues directly and only fall back to filtering
+  // when a sampled queue turns out to be dead.
+  std::uniform_int_distribution<size_t> dist(0, queues.size() - 1);
+  std::vector<size_t> sampled;
+  const std::string *shortest = nullptr;
+  while (sampled.size() < d) {
+    size_t i = dist(rng);
+    if (std::find(sampled.begin(), sampled.end(), i) != sampled.end()) continue;
+    sampled.push_back(i);
+    const std::string &name = queues[i];
+    if (is_queue_dead(name)) {
+      std::vector<std::string> healthy;
+      std::copy_if(queues.begin(), queues.end(), std::back_inserter(healthy),
+                   [](const std::string &value) { return !is_queue_dead(value); });
+      return healthy.empty() ? "" : choose_power_of_d(healthy, d);
+    }
+    if (shortest == nullptr ||
+        registry.queues[name].length < registry.queues[*shortest].length) {
+      shortest = &name;
+    }
   }
+  return *shortest;
+}
 
-  return false;
+// Expected time until a query queued to `state` now is done, with prior_s as
+// the service time of a queue without completions.
+inline double expected_work_s(const QueueState &state, double prior_s) {
+  double service_time_s = state.service_time_s > 0 ? state.service_time_s : prior_s;
+  return (state.length + 1) * service_time_s;
 }
 
-// mantis.enqueue payload lg_sent_time unique_id
-int MantisCommand(ENQUEUE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
-  if (argc != 4) return RedisModule_WrongArity(ctx);
-  RedisModule_AutoMemory(ctx);
+std::string choose_least_expected_work(const std::vector<std::string> &queues) {
+  double prior_s = dispatcher.service_time_s > 0 ? dispatcher.service_time_s : 1;
+  return choose_min_cost(queues, [prior_s](const QueueState &state) {
+    return expected_work_s(state, prior_s);
+  });
+}
 
-  // BEGIN: choose a queue
-  std::vector<std::string> active_queues = get_active_queues(ctx);
-  std::vector<std::string> queues;
-  std::copy_if(active_queues.begin(), active_queues.end(), std::back_inserter(queues),
-               [ctx](std::string &value) { return !is_queue_dead(ctx, value); });
-
-  std::string chosen_queue_name;
-  CHECK(queues.size() > 0) << "No queue available";
-  if (queues.size() == 1) {
-    chosen_queue_name = queues[0];
+std::string choose_queue() {
+  const std::vector<std::string> &active = registry.active;
+  std::string chosen;
+  switch (dispatcher.policy) {
+    case ROUND_ROBIN:
+      chosen = choose_round_robin(active);
+      break;
+    case JOIN_SHORTEST_QUEUE:
+      chosen =
+          choose_min_cost(active, [](const QueueState &state) { return state.length; });
+      break;
+    case POWER_OF_D:
+      chosen = choose_power_of_d(active, dispatcher.d);
+      break;
+    case LEAST_EXPECTED_WORK:
+      chosen = choose_least_expected_work(active);
+      break;
+    case SHARED_QUEUE_PULL:  // See fill_from_shared_queue.
+    case NUM_DISPATCH_POLICIES:
+      break;
+  }
+  CHECK(!chosen.empty()) << "No queue available";
+  dispatcher.counts[dispatcher.policy] += 1;
+  return chosen;
+}
+
+inline bool is_active(const std::string &queue_name) {
+  return std::find(registry.active.begin(), registry.active.end(), queue_name) !=
+         registry.active.end();
+}
+
+inline bool is_stream_queue(const std::string &queue_name) {
+  auto it = registry.queues.find(queue_name);
+  return it != registry.queues.end() && it->second.stream;
+}
+
+// Append a query to a worker queue, which is either a list or a stream.
+void push_query(RedisModuleCtx *ctx, const std::string &queue_name,
+                std::string_view query) {
+  if (!is_stream_queue(queue_name)) return push_to_list(ctx, queue_name, query);
+  RedisModule_Call(ctx, "XADD", "cccb", queue_name.c_str(), "*", STREAM_QUERY_FIELD,
+                   query.data(), query.size());
+}
+
+// Push a query taken off another queue to `queue_name`, setting its worker id.
+void assign_query(RedisModuleCtx *ctx, std::string_view query_view,
+                  const std::string &queue_name) {
+  std::string query(query_view);
+  QueryHeader header;
+  std::memcpy(&header, query.data(), sizeof(QueryHeader));
+  std::memset(header.worker_id, 0, WORKER_ID_SIZE);
+  queue_name.copy(header.worker_id, WORKER_ID_SIZE);
+  std::memcpy(query.data(), &header, sizeof(QueryHeader));
+
+  push_query(ctx, queue_name, query);
+  registry.queues[queue_name].length += 1;
+}
+
+inline std::string_view string_view_of(RedisModuleString *str) {
+  size_t len;
+  const char *ptr = RedisModule_StringPtrLen(str, &len);
+  return std::string_view(ptr, len);
+}
+
+inline RedisModuleKey *open_shared_queue(RedisModuleCtx *ctx) {
+  RedisModuleString *key_str =
+      RedisModule_CreateString(ctx, SHARED_QUEUE.data(), SHARED_QUEUE.size());
+  return static_cast<RedisModuleKey *>(
+      RedisModule_OpenKey(ctx, key_str, REDISMODULE_READ | REDISMODULE_WRITE));
+}
+
+// Move queries from the head of SHARED_QUEUE to `queue_name` until it has
+// `prefetch` queries in flight.
+void fill_from_shared_queue(RedisModuleCtx *ctx, const std::string &queue_name) {
+  if (dispatcher.policy != SHARED_QUEUE_PULL) return;
+  auto it = registry.queues.find(queue_name);
+  if (it == registry.queues.end() || it->second.dead || !is_active(queue_name)) return;
+
+  RedisModuleKey *key = open_shared_queue(ctx);
+  while (it->second.length < dispatcher.prefetch) {
+    RedisModuleString *query_str = RedisModule_ListPop(key, REDISMODULE_LIST_HEAD);
+    if (query_str == nullptr) break;
+    assign_query(ctx, string_view_of(query_str), queue_name);
+    dispatcher.counts[SHARED_QUEUE_PULL] += 1;
+  }
+}
+
+// Dispatch the queries left in SHARED_QUEUE with the current policy, used when
+// switching away from shared_queue.
+void dispatch_shared_queue(RedisModuleCtx *ctx) {
+  RedisModuleKey *key = open_shared_queue(ctx);
+  RedisModuleString *query_str;
+  while ((query_str = RedisModule_ListPop(key, REDISMODULE_LIST_HEAD)) != nullptr) {
+    assign_query(ctx, string_view_of(query_str), choose_queue());
+  }
+}
+
+inline std::string call_reply_string(RedisModuleCallReply *reply) {
+  size_t len;
+  const char *ptr = RedisModule_CallReplyStringPtr(reply, &len);
+  return ptr == nullptr ? std::string() : std::string(ptr, len);
+}
+
+// Collect the ids and queries of the stream entries in an XREADGROUP or
+// XAUTOCLAIM reply. Entries deleted in the meantime only have an id.
+void parse_stream_entries(RedisModuleCallReply *entries, std::vector<std::string> &ids,
+                          std::vector<std::string> &queries) {
+  for (size_t i = 0; i < RedisModule_CallReplyLength(entries); i++) {
+    RedisModuleCallReply *entry = RedisModule_CallReplyArrayElement(entries, i);
+    if (RedisModule_CallReplyType(entry) != REDISMODULE_REPLY_ARRAY) continue;
+    ids.push_back(call_reply_string(RedisModule_CallReplyArrayElement(entry, 0)));
+    RedisModuleCallReply *fields = RedisModule_CallReplyArrayElement(entry, 1);
+    if (RedisModule_CallReplyType(fields) != REDISMODULE_REPLY_ARRAY) continue;
+    for (size_t j = 0; j + 1 < RedisModule_CallReplyLength(fields); j += 2) {
+      if (call_reply_string(RedisModule_CallReplyArrayElement(fields, j)) ==
+          STREAM_QUERY_FIELD) {
+        queries.push_back(
+            call_reply_string(RedisModule_CallReplyArrayElement(fields, j + 1)));
+      }
+    }
+  }
+}
+
+void ack_and_delete(RedisModuleCtx *ctx, const std::string &queue_name,
+                    const std::vector<std::string> &ids) {
+  for (auto &id : ids) {
+    RedisModule_Call(ctx, "XACK", "ccc", queue_name.c_str(), STREAM_GROUP, id.c_str());
+    RedisModule_Call(ctx, "XDEL", "cc", queue_name.c_str(), id.c_str());
+  }
+}
+
+// Take the queries its worker has not popped yet off `queue_name`, oldest first.
+std::vector<std::string> take_waiting_queries(RedisModuleCtx *ctx,
+                                              const std::string &queue_name) {
+  std::vector<std::string> queries;
+  if (!is_stream_queue(queue_name)) {
+    RedisModuleString *key_str =
+        RedisModule_CreateString(ctx, queue_name.data(), queue_name.size());
+    RedisModuleKey *key = static_cast<RedisModuleKey *>(
+        RedisModule_OpenKey(ctx, key_str, REDISMODULE_READ | REDISMODULE_WRITE));
+    RedisModuleString *query_str;
+    while ((query_str = RedisModule_ListPop(key, REDISMODULE_LIST_HEAD)) != nullptr) {
+      queries.emplace_back(string_view_of(query_str));
+    }
+    return queries;
+  }
+
+  RedisModuleCallReply *reply =
+      RedisModule_Call(ctx, "XREADGROUP", "cccccc", "GROUP", STREAM_GROUP,
+                       STREAM_RECLAIMER, "STREAMS", queue_name.c_str(), ">");
+  if (reply == nullptr || RedisModule_CallReplyType(reply) != REDISMODULE_REPLY_ARRAY) {
+    return queries;
+  }
+  std::vector<std::string> ids;
+  for (size_t i = 0; i < RedisModule_CallReplyLength(reply); i++) {
+    RedisModuleCallReply *stream = RedisModule_CallReplyArrayElement(reply, i);
+    parse_stream_entries(RedisModule_CallReplyArrayElement(stream, 1), ids, queries);
+  }
+  ack_and_delete(ctx, queue_name, ids);
+  return queries;
+}
+
+// Take the queries its worker popped but did not complete within min_idle_ms
+// off the stream `queue_name`, oldest first.
+std::vector<std::string> claim_idle_queries(RedisModuleCtx *ctx,
+                                            const std::string &queue_name,
+                                            long long min_idle_ms) {
+  std::vector<std::string> ids, queries;
+  std::string min_idle = std::to_string(min_idle_ms);
+  std::string start = "0-0";
+  do {
+    RedisModuleCallReply *reply = RedisModule_Call(
+        ctx, "XAUTOCLAIM", "ccccccc", queue_name.c_str(), STREAM_GROUP, STREAM_RECLAIMER,
+        min_idle.c_str(), start.c_str(), "COUNT", "100");
+    if (reply == nullptr || RedisModule_CallReplyType(reply) != REDISMODULE_REPLY_ARRAY) {
+      LOG_FIRST_N(WARNING, 1) << "XAUTOCLAIM failed on " << queue_name
+                              << ", it needs Redis 6.2 or newer.";
+      break;
+    }
+    start = call_reply_string(RedisModule_CallReplyArrayElement(reply, 0));
+    parse_stream_entries(RedisModule_CallReplyArrayElement(reply, 1), ids, queries);
+  } while (start != "0-0");
+  ack_and_delete(ctx, queue_name, ids);
+  return queries;
+}
+
+// Whether an active queue other than `queue_name` is healthy, pass "" for any.
+inline bool any_healthy_queue_but(const std::string &queue_name) {
+  return std::any_of(registry.active.begin(), registry.active.end(),
+                     [&queue_name](const std::string &name) {
+                       return name != queue_name && !is_queue_dead(name);
+                     });
+}
+
+// Dispatch queries taken off `queue_name` again with the dispatch policy and
+// return how many there were.
+long long requeue_queries(RedisModuleCtx *ctx, const std::string &queue_name,
+                          const std::vector<std::string> &queries) {
+  bool shared = dispatcher.policy == SHARED_QUEUE_PULL;
+  if (shared) {
+    // In front of the queries waiting in the shared queue, in the same order.
+    for (auto it = queries.rbegin(); it != queries.rend(); ++it) {
+      push_to_list(ctx, SHARED_QUEUE, *it, REDISMODULE_LIST_HEAD);
+    }
   } else {
-    std::vector<std::string> two_chosen_queues;
-    std::sample(queues.begin(), queues.end(), std::back_inserter(two_chosen_queues), 2,
-                std::mt19937{std::random_device{}()});
-    std::sort(two_chosen_queues.begin(), two_chosen_queues.end(),
-              [ctx](std::string &a, std::string &b) {
-                return get_queue_length(ctx, a) < get_queue_length(ctx, b);
-              });
-    chosen_queue_name = two_chosen_queues[0];
+    for (auto &query : queries) assign_query(ctx, query, choose_queue());
+  }
+
+  long long moved = queries.size();
+  auto it = registry.queues.find(queue_name);
+  if (it != registry.queues.end()) {
+    it->second.length = std::max(it->second.length - moved, 0LL);
+  }
+  if (shared) {
+    for (auto &name : registry.active) fill_from_shared_queue(ctx, name);
+  }
+  return moved;
+}
+
+// Move the queries still waiting in `queue_name` to the healthy active queues
+// with the dispatch policy, oldest first, and return how many were moved.
+// Queries its worker already popped stay counted in its length.
+long long redistribute_queue(RedisModuleCtx *ctx, const std::string &queue_name) {
+  if (dispatcher.policy != SHARED_QUEUE_PULL && !any_healthy_queue_but(queue_name)) {
+    return 0;
+  }
+  return requeue_queries(ctx, queue_name, take_waiting_queries(ctx, queue_name));
+}
+
+// Whether a query can be done within budget_s from now. When the chosen queue
+// is expected to miss it, `queue_name` is switched to the queue expected to be
+// done first if that one makes it. Queries are admitted until the first
+// completion gives a service time to estimate with, and whenever the queue it
+// would go to is idle, so that an estimate that is too pessimistic does not
+// reject everything.
+bool admit_query(RedisModuleCtx *ctx, std::string &queue_name, double budget_s) {
+  double prior_s = dispatcher.service_time_s;
+  if (prior_s <= 0) return true;
+
+  if (dispatcher.policy == SHARED_QUEUE_PULL) {
+    // The healthy active queues work through the backlog together.
+    long long backlog = get_queue_length(ctx, SHARED_QUEUE);
+    long long num_healthy = 0;
+    for (auto &name : registry.active) {
+      if (is_queue_dead(name)) continue;
+      backlog += registry.queues[name].length;
+      num_healthy += 1;
+    }
+    if (num_healthy == 0 || backlog < num_healthy) return true;
+    return (static_cast<double>(backlog) / num_healthy + 1) * prior_s <= budget_s;
+  }
+
+  if (expected_work_s(registry.queues[queue_name], prior_s) <= budget_s) return true;
+  std::string fastest = choose_min_cost(
+      registry.active,
+      [prior_s](const QueueState &state) { return expected_work_s(state, prior_s); });
+  if (fastest.empty()) return false;
+  const QueueState &state = registry.queues[fastest];
+  if (state.length > 0 && expected_work_s(state, prior_s) > budget_s) return false;
+  if (fastest != queue_name) {
+    queue_name = fastest;
+    dispatcher.diverted += 1;
   }
+  return true;
+}
+
+// Dispatch a single query to one of the active queues. Returns false if the
+// query was rejected because it cannot make its deadline.
+bool enqueue_query(RedisModuleCtx *ctx, RedisModuleString *payload_str,
+                   RedisModuleString *sent_time_str, RedisModuleString *unique_id) {
+  auto current_time_ns = get_current_time_ns();
+  auto current_time_s = static_cast<double>(current_time_ns) / 1.0e9;
+
+  // BEGIN: choose a queue
+  maybe_sweep_dead_queues(ctx);
+  bool shared = dispatcher.policy == SHARED_QUEUE_PULL;
+  std::string chosen_queue_name = shared ? "" : choose_queue();
   // END: choose a queue
 
   // BEGIN: construct serialized_query
-  RedisModuleString *payload_str = argv[1];
-  RedisModuleString *sent_time_str = argv[2];
-  RedisModuleString *unique_id = argv[3];
   long long unique_id_int;
   RedisModule_StringToLongLong(unique_id, &unique_id_int);
 
-  std::string payload;
   size_t payload_len;
+  const char *payload = RedisModule_StringPtrLen(payload_str, &payload_len);
   double sent_time;
-
-  payload = RedisModule_StringPtrLen(payload_str, &payload_len);
   RedisModule_StringToDouble(sent_time_str, &sent_time);
 
-  auto current_time_ns = get_current_time_ns();
-  auto current_time_s = static_cast<double>(current_time_ns) / 1.0e9;
+  registry.arrival_timestamps_ns.push(current_time_ns);
 
-  RedisModule_Call(ctx, "RPUSH", "cl", REAL_TIMESTAMPS_NS.data(), current_time_ns);
+  double deadline = 0;
+  if (dispatcher.deadline_ms > 0) {
+    deadline = sent_time + dispatcher.deadline_ms / 1000;
+    if (!admit_query(ctx, chosen_queue_name, deadline - current_time_s)) {
+      dispatcher.rejected += 1;
+      return false;
+    }
+  }
 
-  nlohmann::json query;
-  query["payload"] = payload;
-  query["query_id"] = unique_id_int;
-  query["worker_id"] = chosen_queue_name;
-  query["_1_lg_sent"] = sent_time;
-  query["_2_enqueue_time"] = current_time_s;
-  std::string serialized_query = query.dump();
+  QueryHeader header = {};
+  header.query_id = unique_id_int;
+  chosen_queue_name.copy(header.worker_id, WORKER_ID_SIZE);
+  header.payload_digest = parse_payload_handle(std::string_view(payload, payload_len));
+  if (header.payload_digest != 0) payload_store[header.payload_digest].refcount += 1;
+  header.deadline = deadline;
+  header.lg_sent_time = sent_time;
+  header.enqueue_time = current_time_s;
+
+  std::string serialized_query(sizeof(QueryHeader) + payload_len, '\0');
+  std::memcpy(serialized_query.data(), &header, sizeof(QueryHeader));
+  std::memcpy(serialized_query.data() + sizeof(QueryHeader), payload, payload_len);
   // END: construct serialized_query
 
   // BEGIN: enqueue serialized_query
-  RedisModule_Call(ctx, "RPUSH", "cc", chosen_queue_name.c_str(),
-                   serialized_query.c_str());
+  if (shared) {
+    // Behind the queries already waiting, then handed to the shortest worker
+    // queue if it has room.
+    push_to_list(ctx, SHARED_QUEUE, serialized_query);
+    std::string shortest = choose_min_cost(
+        registry.active, [](const QueueState &state) { return state.length; });
+    if (!shortest.empty()) fill_from_shared_queue(ctx, shortest);
+    return true;
+  }
+  push_query(ctx, chosen_queue_name, serialized_query);
+  registry.queues[chosen_queue_name].length += 1;
   // END: enqueue serialized_query
+  return true;
+}
 
-  RedisModule_ReplyWithNull(ctx);
+// mantis.enqueue payload lg_sent_time unique_id
+// Replies 1, or 0 if the query was rejected, see mantis.config deadline_ms.
+int MantisCommand(ENQUEUE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 4) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
+
+  if (!is_known_payload(argv[1])) {
+    return RedisModule_ReplyWithError(ctx, "ERR unknown payload handle");
+  }
+
+  bool admitted = enqueue_query(ctx, argv[1], argv[2], argv[3]);
+
+  return RedisModule_ReplyWithLongLong(ctx, admitted);
+}
+
+// mantis.enqueue_batch payload lg_sent_time unique_id [payload lg_sent_time ...]
+// Replies with the number of queries that were not rejected.
+int MantisCommand(ENQUEUE_BATCH)(RedisModuleCtx *ctx, RedisModuleString **argv,
+                                 int argc) {
+  if (argc < 4 || (argc - 1) % 3 != 0) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
+
+  // Nothing is enqueued if one of the handles is unknown.
+  for (int i = 1; i < argc; i += 3) {
+    if (!is_known_payload(argv[i])) {
+      return RedisModule_ReplyWithError(ctx, "ERR unknown payload handle");
+    }
+  }
+
+  long long admitted = 0;
+  for (int i = 1; i < argc; i += 3) {
+    admitted += enqueue_query(ctx, argv[i], argv[i + 1], argv[i + 2]);
+  }
+
+  RedisModule_ReplyWithLongLong(ctx, admitted);
   return REDISMODULE_OK;
 }
 
-inline std::string make_event_string(std::string type, std::string queue_name) {
-  long long curr_time = get_current_time_ns();
-  nlohmann::json event;
-  event["time_ns"] = curr_time;
-  event["type"] = type;
-  event["queue_id"] = queue_name;
-  std::string serialized_event = event.dump();
-  LOG(INFO) << "Created event" << serialized_event;
-  return serialized_event;
+inline void erase_name(std::vector<std::string> &names, const std::string &name) {
+  names.erase(std::remove(names.begin(), names.end(), name), names.end());
 }
 
-// mantis.add_queue my-random-uuid-queue-name
-int MantisCommand(ADD_QUEUE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
-  if (argc != 2) return RedisModule_WrongArity(ctx);
+// Shared by mantis.add_queue and mantis.add_standby.
+// startup_json, e.g. the duration of each start up phase of the worker, is
+// attached to the ADD or STANDBY event.
+int register_queue(RedisModuleCtx *ctx, RedisModuleString **argv, int argc,
+                   bool standby) {
+  if (argc != 2 && argc != 3) return RedisModule_WrongArity(ctx);
   RedisModule_AutoMemory(ctx);
 
+  // Note that queue name will be client generated.
+  // We assume the client has already called "subscribe" to that queue.
   size_t queue_name_len;
   std::string queue_name_s = RedisModule_StringPtrLen(argv[1], &queue_name_len);
+  if (queue_name_len > WORKER_ID_SIZE) {
+    return RedisModule_ReplyWithError(ctx, "ERR queue name longer than 32 bytes");
+  }
 
-  // Note that queue name will be client generated.
-  // We assume the client has already called "subscribe" to that queue.
-  RedisModuleString *queue_name = argv[1];
+  nlohmann::json startup;
+  if (argc == 3) {
+    size_t startup_len;
+    const char *startup_ptr = RedisModule_StringPtrLen(argv[2], &startup_len);
+    startup = nlohmann::json::parse(startup_ptr, startup_ptr + startup_len, nullptr,
+                                    /*allow_exceptions=*/false);
+    if (startup.is_discarded()) {
+      return RedisModule_ReplyWithError(ctx, "ERR startup report is not valid JSON");
+    }
+  }
 
-  RedisModule_Call(ctx, "SADD", "cs", ACTIVE_QUEUES.data(), queue_name);
-  RedisModule_Call(ctx, "RPUSH", "cc", QUEUE_EVENTS.data(),
-                   make_event_string("ADD", queue_name_s).c_str());
-  update_heartbeat(ctx, queue_name_s);
+  bool is_new = registry.queues.find(queue_name_s) == registry.queues.end();
+  QueueState &state = registry.queues[queue_name_s];
+  if (is_new) {
+    state.stream = dispatcher.streams;
+    // The queue might already hold items, e.g. when a worker re-registers.
+    state.length = get_queue_length(ctx, queue_name_s);
+  }
+  if (state.stream) {
+    // Fails with BUSYGROUP when the worker re-registers, which is fine.
+    RedisModule_Call(ctx, "XGROUP", "ccccc", "CREATE", queue_name_s.c_str(), STREAM_GROUP,
+                     "0", "MKSTREAM");
+  }
+  state.last_heartbeat_ns = get_current_time_ns();
+  state.dead = state.disconnected;
+
+  registry.dropped.erase(queue_name_s);
+  erase_name(standby ? registry.active : registry.standby, queue_name_s);
+  auto &names = standby ? registry.standby : registry.active;
+  if (std::find(names.begin(), names.end(), queue_name_s) == names.end()) {
+    names.push_back(queue_name_s);
+  }
+  fill_from_shared_queue(ctx, queue_name_s);
+  registry.events.push_back(
+      make_event_string(standby ? "STANDBY" : "ADD", queue_name_s, startup));
 
   RedisModule_ReplyWithNull(ctx);
   return REDISMODULE_OK;
 }
 
-// mantis.drop_queue my-random-uuid-queue-name
-int MantisCommand(DROP_QUEUE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+// mantis.add_queue my-random-uuid-queue-name [startup_json]
+int MantisCommand(ADD_QUEUE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  return register_queue(ctx, argv, argc, /*standby=*/false);
+}
+
+// mantis.add_standby my-random-uuid-queue-name [startup_json]
+// Register a warm worker without sending it queries, see mantis.activate.
+int MantisCommand(ADD_STANDBY)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  return register_queue(ctx, argv, argc, /*standby=*/true);
+}
+
+// Move up to `count` of the shortest healthy queues in `from` to `to`, recording
+// an `event_type` event for each, and reply with the names of the moved queues.
+int move_queues(RedisModuleCtx *ctx, std::vector<std::string> &from,
+                std::vector<std::string> &to, long long count,
+                const std::string &event_type) {
+  maybe_sweep_dead_queues(ctx);
+  std::vector<std::string> candidates;
+  std::copy_if(from.begin(), from.end(), std::back_inserter(candidates),
+               [](const std::string &name) { return !is_queue_dead(name); });
+  std::stable_sort(candidates.begin(), candidates.end(),
+                   [](const std::string &a, const std::string &b) {
+                     return registry.queues[a].length < registry.queues[b].length;
+                   });
+  if (static_cast<long long>(candidates.size()) > count) candidates.resize(count);
+
+  RedisModule_ReplyWithArray(ctx, candidates.size());
+  for (auto &name : candidates) {
+    erase_name(from, name);
+    to.push_back(name);
+    fill_from_shared_queue(ctx, name);
+    registry.events.push_back(make_event_string(event_type, name));
+    RedisModule_ReplyWithStringBuffer(ctx, name.c_str(), name.size());
+  }
+  return REDISMODULE_OK;
+}
+
+// mantis.activate count
+// Start dispatching to up to `count` healthy standby queues, shortest first.
+// Replies with the activated queue names, fewer than `count` if the standby pool
+// runs dry.
+int MantisCommand(ACTIVATE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
   if (argc != 2) return RedisModule_WrongArity(ctx);
   RedisModule_AutoMemory(ctx);
+  long long count;
+  if (RedisModule_StringToLongLong(argv[1], &count) != REDISMODULE_OK || count < 0) {
+    return RedisModule_ReplyWithError(ctx, "ERR count must be a non negative integer");
+  }
+  return move_queues(ctx, registry.standby, registry.active, count, "ACTIVATE");
+}
+
+// mantis.deactivate count
+// Stop dispatching to up to `count` healthy active queues, shortest first, and
+// move them back to standby. Their workers keep serving the queued queries.
+int MantisCommand(DEACTIVATE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 2) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
+  long long count;
+  if (RedisModule_StringToLongLong(argv[1], &count) != REDISMODULE_OK || count < 0) {
+    return RedisModule_ReplyWithError(ctx, "ERR count must be a non negative integer");
+  }
+  return move_queues(ctx, registry.active, registry.standby, count, "DEACTIVATE");
+}
+
+// mantis.drop_queue my-random-uuid-queue-name [REDISTRIBUTE]
+// With REDISTRIBUTE the queries still waiting in the queue are dispatched to
+// the healthy active queues right away, and the reply is how many were moved.
+// They stay for the worker to drain if there is no healthy queue to move to.
+int MantisCommand(DROP_QUEUE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 2 && argc != 3) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
 
   size_t queue_name_len;
   std::string queue_name_s = RedisModule_StringPtrLen(argv[1], &queue_name_len);
+  bool redistribute = false;
+  if (argc == 3) {
+    size_t option_len;
+    const char *option = RedisModule_StringPtrLen(argv[2], &option_len);
+    if (strcasecmp(option, "REDISTRIBUTE") != 0) {
+      return RedisModule_ReplyWithError(ctx, "ERR unknown drop_queue option");
+    }
+    redistribute = true;
+  }
 
-  RedisModuleString *queue_name = argv[1];
-  RedisModule_Call(ctx, "SADD", "cs", REMOVED_QUEUES.data(), queue_name);
-  RedisModule_Call(ctx, "SREM", "cs", ACTIVE_QUEUES.data(), queue_name);
-  RedisModule_Call(ctx, "RPUSH", "cc", QUEUE_EVENTS.data(),
-                   make_event_string("DROP", queue_name_s).c_str());
-  RedisModule_Call(ctx, "DEL", "c", ("heartbeat/" + queue_name_s).c_str());
-
-  RedisModule_ReplyWithNull(ctx);
-  return REDISMODULE_OK;
-}
+  erase_name(registry.active, queue_name_s);
+  erase_name(registry.standby, queue_name_s);
 
-inline void drain_redis_list(RedisModuleCtx *ctx, std::string_view key,
-                             std::function<void(std::string)> on_item) {
-  RedisModuleCallReply *lrange_reply;
-  lrange_reply = RedisModule_Call(ctx, "LRANGE", "ccc", key.data(), "0", "-1");
-  std::vector<std::string> array = get_array_reply(lrange_reply);
-  for (auto &item : array) {
-    on_item(item);
+  long long moved = 0;
+  if (redistribute) {
+    maybe_sweep_dead_queues(ctx);
+    moved = redistribute_queue(ctx, queue_name_s);
   }
-  size_t array_size = array.size();
-  for (size_t i = 0; i < array_size; i++) {
-    RedisModule_Call(ctx, "LPOP", "c", key.data());
+
+  auto it = registry.queues.find(queue_name_s);
+  if (it != registry.queues.end()) {
+    if (it->second.length > 0) {
+      registry.dropped.insert(queue_name_s);
+    } else {
+      registry.queues.erase(it);
+    }
   }
+  registry.events.push_back(make_event_string("DROP", queue_name_s));
+
+  if (redistribute) return RedisModule_ReplyWithLongLong(ctx, moved);
+  RedisModule_ReplyWithNull(ctx);
+  return REDISMODULE_OK;
 }
 
-// mantis.status
-int MantisCommand(STATUS)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+// mantis.rebalance
+// Dispatch the queries waiting in dead active queues to the healthy ones, and
+// reply with how many were moved. A dead queue stays registered in case its
+// worker comes back.
+int MantisCommand(REBALANCE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
   if (argc != 1) return RedisModule_WrongArity(ctx);
   REDISMODULE_NOT_USED(argv);
+  RedisModule_AutoMemory(ctx);
+
+  maybe_sweep_dead_queues(ctx);
+  std::vector<std::string> dead;
+  std::copy_if(registry.active.begin(), registry.active.end(), std::back_inserter(dead),
+               [](const std::string &name) { return is_queue_dead(name); });
+
+  long long moved = 0;
+  for (auto &queue_name : dead) moved += redistribute_queue(ctx, queue_name);
+  if (moved > 0) {
+    LOG(INFO) << "Moved " << moved << " queries off " << dead.size() << " dead queues";
+  }
+  return RedisModule_ReplyWithLongLong(ctx, moved);
+}
 
+// mantis.reclaim min_idle_ms
+// Dispatch again, for the stream queues, the queries of dead queues, and
+// the queries a live worker popped but has not completed for min_idle_ms, and
+// reply with how many were moved. The worker that popped a reclaimed query may
+// still serve it, so queries are served at least once, but mantis.complete
+// drops that worker's completion and only the copy dispatched again counts.
+int MantisCommand(RECLAIM)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 2) return RedisModule_WrongArity(ctx);
   RedisModule_AutoMemory(ctx);
 
-  // Get timestamps in ns
-  std::vector<long long> timestamps_ns;
-  drain_redis_list(ctx, REAL_TIMESTAMPS_NS, [&timestamps_ns](std::string item) {
-    timestamps_ns.push_back(std::stoll(item));
-  });
-  // End get timestamp
+  long long min_idle_ms;
+  if (RedisModule_StringToLongLong(argv[1], &min_idle_ms) == REDISMODULE_ERR ||
+      min_idle_ms < 0) {
+    return RedisModule_ReplyWithError(ctx,
+                                      "ERR min_idle_ms must be a non negative integer");
+  }
+  maybe_sweep_dead_queues(ctx);
+  std::vector<std::string> queue_names;
+  for (auto &[queue_name, state] : registry.queues) {
+    if (state.stream) queue_names.push_back(queue_name);
+  }
 
+  long long moved = 0;
+  for (auto &queue_name : queue_names) {
+    if (dispatcher.policy != SHARED_QUEUE_PULL && !any_healthy_queue_but(queue_name)) {
+      continue;
+    }
+    // Popped queries are older than the ones still waiting.
+    bool dead = is_queue_dead(queue_name);
+    std::vector<std::string> queries =
+        claim_idle_queries(ctx, queue_name, dead ? 0 : min_idle_ms);
+    if (dead) {
+      for (auto &query : take_waiting_queries(ctx, queue_name)) queries.push_back(query);
+    }
+    moved += requeue_queries(ctx, queue_name, queries);
+  }
+  if (moved > 0) LOG(INFO) << "Reclaimed " << moved << " queries";
+  return RedisModule_ReplyWithLongLong(ctx, moved);
+}
+
+// Everything in the status report except the arrival timestamps.
+nlohmann::json make_status_report(RedisModuleCtx *ctx) {
   std::vector<std::string> events;
-  drain_redis_list(ctx, QUEUE_EVENTS,
-                   [&events](std::string item) { events.push_back(item); });
+  events.swap(registry.events);
 
   // Begin get fractional_value
   RedisModuleCallReply *reply;
@@ -302,112 +1114,544 @@ int MantisCommand(STATUS)(RedisModuleCtx *ctx, RedisModuleString **argv, int arg
 
   // Get queue sizes
   // The total queue sizes are active + dropped queue sizes.
-  std::vector<std::string> queues = get_active_queues(ctx);
-  // for (auto &queue_name : queues) {
-  //   queue_sizes.push_back(get_queue_length(ctx, queue_name));
-  // }
-
-  std::vector<std::string> healthy_queues;
-  std::copy_if(queues.begin(), queues.end(), std::back_inserter(healthy_queues),
-               [ctx](std::string &value) { return !is_queue_dead(ctx, value); });
-  std::vector<std::string> dead_queues;
-  std::copy_if(queues.begin(), queues.end(), std::back_inserter(dead_queues),
-               [ctx](std::string &value) { return is_queue_dead(ctx, value); });
+  long long current_time = get_current_time_ns();
+  maybe_sweep_dead_queues(ctx);
 
   std::vector<long long> queue_sizes;
-  std::transform(healthy_queues.begin(), healthy_queues.end(),
-                 std::back_inserter(queue_sizes),
-                 [ctx](std::string &value) { return get_queue_length(ctx, value); });
   std::vector<long long> dead_queue_sizes;
-  std::transform(dead_queues.begin(), dead_queues.end(),
-                 std::back_inserter(dead_queue_sizes),
-                 [ctx](std::string &value) { return get_queue_length(ctx, value); });
+  for (auto &queue_name : registry.active) {
+    long long length = registry.queues[queue_name].length;
+    if (is_queue_dead(queue_name)) {
+      dead_queue_sizes.push_back(length);
+    } else {
+      queue_sizes.push_back(length);
+    }
+  }
 
-  std::vector<long long> dropped_queue_sizes;
-  std::vector<std::string> dropped_queues = get_removed_queus(ctx);
-  for (auto &queue_name : dropped_queues) {
-    dropped_queue_sizes.push_back(get_queue_length(ctx, queue_name));
+  std::vector<long long> standby_queue_sizes;
+  for (auto &queue_name : registry.standby) {
+    if (!is_queue_dead(queue_name)) {
+      standby_queue_sizes.push_back(registry.queues[queue_name].length);
+    }
   }
 
-  // Sum active queue size and dropped queue size
-  long long total_queue_size = std::accumulate(queue_sizes.begin(), queue_sizes.end(), 0);
-  total_queue_size +=
-      std::accumulate(dropped_queue_sizes.begin(), dropped_queue_sizes.end(), 0);
+  std::vector<long long> dropped_queue_sizes;
+  for (auto &queue_name : registry.dropped) {
+    dropped_queue_sizes.push_back(registry.queues[queue_name].length);
+  }
   // End get queue sizes
 
-  // size_t active_replicas = queues.size();
-  // size_t dropped_replicas = dropped_queues.size();
-  long long current_time = get_current_time_ns();
-
   nlohmann::json status_report;
 
-  // Real deltas from last call. List[int]
-  status_report["real_arrival_ts_ns"] = timestamps_ns;
+  // Number of arrival timestamps lost because the buffer was full. Int
+  status_report["overwritten_arrival_ts"] =
+      registry.arrival_timestamps_ns.take_overwritten();
 
   // Queue added/droppede event List[json]
   status_report["queue_events"] = events;
 
-  // List[UUID]
-  // status_report["queues"] = queues;
-  // status_report["dropped_queues"] = dropped_queues;
-
   // Active queue sizes ActiveList[int]
   status_report["queue_sizes"] = queue_sizes;
   status_report["dead_queue_sizes"] = dead_queue_sizes;
 
+  // Healthy standby queue sizes StandbyList[int]
+  status_report["standby_queue_sizes"] = standby_queue_sizes;
+
   // Dropped queue sizes DropList[int] (Scaling down)
   status_report["dropped_queue_sizes"] = dropped_queue_sizes;
 
-  // -------- Inferred ----------
-  // Sum(ActiveList[int], DropList[int])
-  // status_report["total_queue_size"] = total_queue_size;
-
-  // Int
-  // status_report["num_active_replica"] = active_replicas;
-  // Int
-  // status_report["num_dropped_replica"] = dropped_replicas;
-  // Int = Int + Int
-  // status_report["num_total_replica"] = active_replicas + dropped_replicas;
-
   // -------------------------------------
   status_report["current_ts_ns"] = current_time;
 
   // Float, configurable
   status_report["fractional_value"] = fractional_val;
 
+  // Queries waiting in the shared queue for a worker. Int
+  status_report["shared_queue_size"] = get_queue_length(ctx, SHARED_QUEUE);
+
+  // Dispatch policy in use and queries dispatched per policy. {str: int}
+  status_report["dispatch_policy"] = DISPATCH_POLICY_NAMES[dispatcher.policy];
+  nlohmann::json dispatch_counts = nlohmann::json::object();
+  for (size_t policy = 0; policy < NUM_DISPATCH_POLICIES; policy++) {
+    dispatch_counts[std::string(DISPATCH_POLICY_NAMES[policy])] =
+        std::exchange(dispatcher.counts[policy], 0);
+  }
+  status_report["dispatch_counts"] = dispatch_counts;
+  status_report["deadline_counts"] = {
+      {"diverted", std::exchange(dispatcher.diverted, 0)},
+      {"rejected", std::exchange(dispatcher.rejected, 0)},
+      {"expired", std::exchange(dispatcher.expired, 0)},
+  };
+
+  return status_report;
+}
+
+// mantis.config [dispatch_policy round_robin|join_shortest_queue|power_of_d|
+//                least_expected_work|shared_queue] [power_of_d d] [prefetch k]
+//               [backend list|stream] [deadline_ms ms] [heartbeat_slack_ms ms]
+// Set the given options, or reply with the current ones as JSON without any.
+int MantisCommand(CONFIG)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc % 2 != 1) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
+
+  if (argc == 1) {
+    nlohmann::json config;
+    config["dispatch_policy"] = DISPATCH_POLICY_NAMES[dispatcher.policy];
+    config["power_of_d"] = dispatcher.d;
+    config["prefetch"] = dispatcher.prefetch;
+    config["backend"] = dispatcher.streams ? "stream" : "list";
+    config["deadline_ms"] = dispatcher.deadline_ms;
+    config["heartbeat_slack_ms"] = dispatcher.heartbeat_slack_ms;
+    std::string config_string = config.dump();
+    return RedisModule_ReplyWithStringBuffer(ctx, config_string.c_str(),
+                                             config_string.size());
+  }
+
+  // Validate everything first so that an error leaves the config untouched.
+  Dispatcher updated = dispatcher;
+  for (int i = 1; i < argc; i += 2) {
+    size_t len;
+    const char *key_ptr = RedisModule_StringPtrLen(argv[i], &len);
+    std::string_view key(key_ptr, len);
+    const char *value_ptr = RedisModule_StringPtrLen(argv[i + 1], &len);
+    std::string_view value(value_ptr, len);
+
+    if (key == "dispatch_policy") {
+      auto it =
+          std::find(DISPATCH_POLICY_NAMES.begin(), DISPATCH_POLICY_NAMES.end(), value);
+      if (it == DISPATCH_POLICY_NAMES.end()) {
+        return RedisModule_ReplyWithError(ctx, "ERR unknown dispatch policy");
+      }
+      updated.policy = static_cast<DispatchPolicy>(it - DISPATCH_POLICY_NAMES.begin());
+    } else if (key == "power_of_d") {
+      if (RedisModule_StringToLongLong(argv[i + 1], &updated.d) == REDISMODULE_ERR ||
+          updated.d < 1) {
+        return RedisModule_ReplyWithError(ctx,
+                                          "ERR power_of_d must be a positive integer");
+      }
+    } else if (key == "prefetch") {
+      if (RedisModule_StringToLongLong(argv[i + 1], &updated.prefetch) ==
+              REDISMODULE_ERR ||
+          updated.prefetch < 1) {
+        return RedisModule_ReplyWithError(ctx, "ERR prefetch must be a positive integer");
+      }
+    } else if (key == "deadline_ms") {
+      if (RedisModule_StringToDouble(argv[i + 1], &updated.deadline_ms) ==
+              REDISMODULE_ERR ||
+          updated.deadline_ms < 0) {
+        return RedisModule_ReplyWithError(
+            ctx, "ERR deadline_ms must be a non negative number");
+      }
+    } else if (key == "heartbeat_slack_ms") {
+      if (RedisModule_StringToLongLong(argv[i + 1], &updated.heartbeat_slack_ms) ==
+              REDISMODULE_ERR ||
+          updated.heartbeat_slack_ms < 1) {
+        return RedisModule_ReplyWithError(
+            ctx, "ERR heartbeat_slack_ms must be a positive integer");
+      }
+    } else if (key == "backend") {
+      if (value != "list" && value != "stream") {
+        return RedisModule_ReplyWithError(ctx, "ERR backend must be list or stream");
+      }
+      if (value == "stream" && redis_version < STREAM_MIN_REDIS_VERSION) {
+        return RedisModule_ReplyWithError(
+            ctx, "ERR the stream backend needs Redis 6.2 or newer");
+      }
+      // Queues registered before keep their type.
+      updated.streams = value == "stream";
+    } else {
+      return RedisModule_ReplyWithError(ctx, "ERR unknown config option");
+    }
+  }
+  maybe_sweep_dead_queues(ctx);
+  if (updated.policy != SHARED_QUEUE_PULL && get_queue_length(ctx, SHARED_QUEUE) > 0 &&
+      !any_healthy_queue_but("")) {
+    return RedisModule_ReplyWithError(
+        ctx, "ERR no healthy queue to dispatch the shared queue to");
+  }
+  bool slack_changed = updated.heartbeat_slack_ms != dispatcher.heartbeat_slack_ms;
+  dispatcher = updated;
+  if (slack_changed) reschedule_sweep(ctx);
+  LOG(INFO) << "Dispatch policy is " << DISPATCH_POLICY_NAMES[dispatcher.policy]
+            << " with d=" << dispatcher.d << " prefetch=" << dispatcher.prefetch
+            << (dispatcher.streams ? " on streams" : " on lists")
+            << " deadline_ms=" << dispatcher.deadline_ms
+            << " heartbeat_slack_ms=" << dispatcher.heartbeat_slack_ms;
+
+  if (dispatcher.policy == SHARED_QUEUE_PULL) {
+    for (auto &queue_name : registry.active) fill_from_shared_queue(ctx, queue_name);
+  } else {
+    dispatch_shared_queue(ctx);
+  }
+
+  return RedisModule_ReplyWithSimpleString(ctx, "OK");
+}
+
+// mantis.status
+int MantisCommand(STATUS)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 1) return RedisModule_WrongArity(ctx);
+  REDISMODULE_NOT_USED(argv);
+
+  RedisModule_AutoMemory(ctx);
+
+  nlohmann::json status_report = make_status_report(ctx);
+
+  // Real deltas from last call. List[int]
+  status_report["real_arrival_ts_ns"] = registry.arrival_timestamps_ns.drain();
+
   std::string report_string = status_report.dump();
 
   RedisModule_ReplyWithStringBuffer(ctx, report_string.c_str(), report_string.size());
   return REDISMODULE_OK;
 }
 
-// mantis.complete payload
-// - query["_4_done_time"] = time.time()
-// - r.lpush("completion_queue", json.dumps(query))
+// mantis.status_binary
+// Reply with [status json without real_arrival_ts_ns, arrival timestamps packed as
+// little endian int64], so the timestamps can be read with np.frombuffer.
+int MantisCommand(STATUS_BINARY)(RedisModuleCtx *ctx, RedisModuleString **argv,
+                                 int argc) {
+  if (argc != 1) return RedisModule_WrongArity(ctx);
+  REDISMODULE_NOT_USED(argv);
+
+  RedisModule_AutoMemory(ctx);
+
+  std::string report_string = make_status_report(ctx).dump();
+  std::vector<int64_t> timestamps_ns = registry.arrival_timestamps_ns.drain();
+
+  RedisModule_ReplyWithArray(ctx, 2);
+  RedisModule_ReplyWithStringBuffer(ctx, report_string.c_str(), report_string.size());
+  RedisModule_ReplyWithStringBuffer(ctx,
+                                    reinterpret_cast<const char *>(timestamps_ns.data()),
+                                    timestamps_ns.size() * sizeof(int64_t));
+  return REDISMODULE_OK;
+}
+
+inline void update_service_time(double &average_s, double sample_s) {
+  if (average_s == 0) {
+    average_s = sample_s;
+  } else {
+    average_s += SERVICE_TIME_EWMA_ALPHA * (sample_s - average_s);
+  }
+}
+
+// Book keeping for a query that left `queue_name`.
+inline void mark_query_done(const std::string &queue_name, double service_time_s) {
+  auto it = registry.queues.find(queue_name);
+  if (it == registry.queues.end()) return;
+
+  QueueState &state = it->second;
+  state.last_heartbeat_ns = get_current_time_ns();
+  state.dead = state.disconnected;
+  if (state.length > 0) state.length -= 1;
+  if (service_time_s > 0) {
+    update_service_time(state.service_time_s, service_time_s);
+    update_service_time(dispatcher.service_time_s, service_time_s);
+  }
+
+  // Forget dropped queue once it is fully drained.
+  if (state.length == 0 && registry.dropped.erase(queue_name) > 0) {
+    registry.queues.erase(it);
+  }
+}
+
+// HDR style log-linear histogram of latencies in microseconds. Every power of
+// two range is split into 2^HISTOGRAM_SUB_BUCKET_BITS linear buckets, so the
+// lower bound of a bucket is within ~3% of every value counted in it. Values
+// below 2^HISTOGRAM_SUB_BUCKET_BITS us get a bucket each.
+constexpr int HISTOGRAM_SUB_BUCKET_BITS = 5;
+constexpr uint64_t HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_SUB_BUCKET_BITS;
+
+class LatencyHistogram {
+ public:
+  void record(double seconds) {
+    uint64_t value_us = seconds > 0 ? static_cast<uint64_t>(seconds * 1e6) : 0;
+    counts_[bucket_index(value_us)] += 1;
+    count_ += 1;
+    max_us_ = std::max(max_us_, value_us);
+  }
+
+  // {"count": int, "max_us": int, "buckets": [[lower_bound_us, count], ...]}
+  nlohmann::json to_json() const {
+    nlohmann::json buckets = nlohmann::json::array();
+    for (auto &[index, count] : counts_) {
+      buckets.push_back({bucket_lower_bound_us(index), count});
+    }
+    return {{"count", count_}, {"max_us", max_us_}, {"buckets", buckets}};
+  }
+
+  static int bucket_index(uint64_t value_us) {
+    if (value_us < HISTOGRAM_SUB_BUCKETS) return value_us;
+    int shift = 63 - __builtin_clzll(value_us) - HISTOGRAM_SUB_BUCKET_BITS;
+    return ((shift + 1) << HISTOGRAM_SUB_BUCKET_BITS) +
+           static_cast<int>((value_us >> shift) - HISTOGRAM_SUB_BUCKETS);
+  }
+
+  static uint64_t bucket_lower_bound_us(int index) {
+    if (index < static_cast<int>(HISTOGRAM_SUB_BUCKETS)) return index;
+    int shift = (index >> HISTOGRAM_SUB_BUCKET_BITS) - 1;
+    return ((index & (HISTOGRAM_SUB_BUCKETS - 1)) + HISTOGRAM_SUB_BUCKETS) << shift;
+  }
+
+ private:
+  std::map<int, long long> counts_;  // Sparse, by bucket index.
+  long long count_ = 0;
+  uint64_t max_us_ = 0;
+};
+
+struct CompletionHistograms {
+  LatencyHistogram e2e;       // lg_sent_time -> done_time
+  LatencyHistogram queueing;  // enqueue_time -> dequeue_time
+  LatencyHistogram service;   // dequeue_time -> done_time
+
+  void record(const QueryHeader &header) {
+    e2e.record(header.done_time - header.lg_sent_time);
+    queueing.record(header.dequeue_time - header.enqueue_time);
+    service.record(header.done_time - header.dequeue_time);
+  }
+
+  nlohmann::json to_json() const {
+    return {{"e2e", e2e.to_json()},
+            {"queueing", queueing.to_json()},
+            {"service", service.to_json()}};
+  }
+};
+
+// Filled by mantis.complete, drained by mantis.latency_histograms.
+struct LatencyHistograms {
+  CompletionHistograms overall;
+  std::unordered_map<std::string, CompletionHistograms> workers;
+};
+
+LatencyHistograms latency_histograms;
+
+// Acknowledge and delete the stream entry `entry_id` that the worker of
+// `queue_name` popped. Returns false if it was acknowledged before, which is
+// when mantis.reclaim took the query off the queue to dispatch it again.
+bool ack_popped_entry(RedisModuleCtx *ctx, const std::string &queue_name,
+                      RedisModuleString *entry_id) {
+  RedisModuleCallReply *reply =
+      RedisModule_Call(ctx, "XACK", "ccs", queue_name.c_str(), STREAM_GROUP, entry_id);
+  if (reply == nullptr || RedisModule_CallReplyType(reply) != REDISMODULE_REPLY_INTEGER) {
+    return true;
+  }
+  if (RedisModule_CallReplyInteger(reply) == 0) return false;
+  RedisModule_Call(ctx, "XDEL", "cs", queue_name.c_str(), entry_id);
+  return true;
+}
+
+// Book keeping shared by mantis.complete and mantis.expire. Returns false for a
+// query popped off a stream that was reclaimed in the meantime. Its copy on
+// another queue is counted when that one is done, so this one must not be.
+bool finish_query(RedisModuleCtx *ctx, const QueryHeader &header,
+                  RedisModuleString *entry_id, double service_time_s) {
+  std::string worker_id = get_worker_id(header);
+  if (entry_id != nullptr && !ack_popped_entry(ctx, worker_id, entry_id)) {
+    return false;
+  }
+  mark_query_done(worker_id, service_time_s);
+  fill_from_shared_queue(ctx, worker_id);
+  if (header.payload_digest != 0) release_payload(header.payload_digest);
+  return true;
+}
+
+// mantis.complete completed_query [stream_entry_id]
+// - completed_query is the query header followed by the result bytes
+// - header.done_time = time.time()
+// - r.lpush("completion_queue", completed_query)
+// Workers on the stream backend pass the id of the entry they popped, which is
+// acknowledged here. Replies 1, or 0 if the query was reclaimed and the
+// completion is dropped.
 int MantisCommand(COMPLETE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
-  if (argc != 2) return RedisModule_WrongArity(ctx);
+  if (argc != 2 && argc != 3) return RedisModule_WrongArity(ctx);
 
   RedisModule_AutoMemory(ctx);
 
-  RedisModuleString *payload_str = argv[1];
+  size_t query_len;
+  const char *query_ptr = RedisModule_StringPtrLen(argv[1], &query_len);
+  if (query_len < sizeof(QueryHeader)) {
+    return RedisModule_ReplyWithError(ctx, "ERR completed query is missing its header");
+  }
+  std::string completed_query(query_ptr, query_len);
+
+  QueryHeader header;
+  std::memcpy(&header, completed_query.data(), sizeof(QueryHeader));
+  auto current_time_ns = get_current_time_ns();
+  header.done_time = static_cast<double>(current_time_ns) / 1.0e9;
+  if (!finish_query(ctx, header, argc == 3 ? argv[2] : nullptr,
+                    header.done_time - header.dequeue_time)) {
+    return RedisModule_ReplyWithLongLong(ctx, 0);
+  }
+  std::memcpy(completed_query.data(), &header, sizeof(QueryHeader));
+
+  latency_histograms.overall.record(header);
+  latency_histograms.workers[get_worker_id(header)].record(header);
+
+  push_to_list(ctx, COMPLETION_QUEUE, completed_query, REDISMODULE_LIST_HEAD);
+
+  return RedisModule_ReplyWithLongLong(ctx, 1);
+}
+
+// mantis.expire expired_query [stream_entry_id]
+// Like mantis.complete for a query its worker skipped because its deadline
+// passed while it was queued. It is counted, but not reported as completed.
+int MantisCommand(EXPIRE)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 2 && argc != 3) return RedisModule_WrongArity(ctx);
+
+  RedisModule_AutoMemory(ctx);
+
+  size_t query_len;
+  const char *query_ptr = RedisModule_StringPtrLen(argv[1], &query_len);
+  if (query_len < sizeof(QueryHeader)) {
+    return RedisModule_ReplyWithError(ctx, "ERR expired query is missing its header");
+  }
+  QueryHeader header;
+  std::memcpy(&header, query_ptr, sizeof(QueryHeader));
+  if (!finish_query(ctx, header, argc == 3 ? argv[2] : nullptr,
+                    /*service_time_s=*/0)) {
+    return RedisModule_ReplyWithLongLong(ctx, 0);
+  }
+  dispatcher.expired += 1;
+
+  return RedisModule_ReplyWithLongLong(ctx, 1);
+}
+
+// mantis.latency_histograms
+// Reply with the e2e, queueing and service time histograms of the queries
+// completed since the last call, overall and per worker, and reset them:
+// {"sub_bucket_bits": int, "overall": {...}, "workers": {worker_id: {...}}}
+int MantisCommand(LATENCY_HISTOGRAMS)(RedisModuleCtx *ctx, RedisModuleString **argv,
+                                      int argc) {
+  if (argc != 1) return RedisModule_WrongArity(ctx);
+  REDISMODULE_NOT_USED(argv);
+
+  LatencyHistograms histograms = std::exchange(latency_histograms, {});
+
+  nlohmann::json report;
+  report["sub_bucket_bits"] = HISTOGRAM_SUB_BUCKET_BITS;
+  report["overall"] = histograms.overall.to_json();
+  report["workers"] = nlohmann::json::object();
+  for (auto &[worker_id, worker_histograms] : histograms.workers) {
+    report["workers"][worker_id] = worker_histograms.to_json();
+  }
+
+  std::string report_string = report.dump();
+  RedisModule_ReplyWithStringBuffer(ctx, report_string.c_str(), report_string.size());
+  return REDISMODULE_OK;
+}
+
+// mantis.drain_completions
+// Pop every completed query and reply with their headers packed back to back,
+// oldest first, so the runner can parse them with a single np.frombuffer.
+int MantisCommand(DRAIN_COMPLETIONS)(RedisModuleCtx *ctx, RedisModuleString **argv,
+                                     int argc) {
+  if (argc != 1) return RedisModule_WrongArity(ctx);
+  REDISMODULE_NOT_USED(argv);
+  RedisModule_AutoMemory(ctx);
+
+  RedisModuleString *key_str =
+      RedisModule_CreateString(ctx, COMPLETION_QUEUE.data(), COMPLETION_QUEUE.size());
+  RedisModuleKey *key = static_cast<RedisModuleKey *>(
+      RedisModule_OpenKey(ctx, key_str, REDISMODULE_READ | REDISMODULE_WRITE));
+  if (RedisModule_KeyType(key) != REDISMODULE_KEYTYPE_LIST) {
+    RedisModule_ReplyWithStringBuffer(ctx, "", 0);
+    return REDISMODULE_OK;
+  }
+
+  size_t num_completions = RedisModule_ValueLength(key);
+  std::string headers;
+  headers.reserve(num_completions * sizeof(QueryHeader));
+  for (size_t i = 0; i < num_completions; i++) {
+    // mantis.complete pushes to the head, so the oldest one is at the tail.
+    RedisModuleString *completed = RedisModule_ListPop(key, REDISMODULE_LIST_TAIL);
+    size_t completed_len;
+    const char *completed_ptr = RedisModule_StringPtrLen(completed, &completed_len);
+    if (completed_len >= sizeof(QueryHeader)) {
+      headers.append(completed_ptr, sizeof(QueryHeader));
+    }
+    // Free right away instead of holding every completion until AutoMemory does.
+    RedisModule_FreeString(ctx, completed);
+  }
+
+  RedisModule_ReplyWithStringBuffer(ctx, headers.data(), headers.size());
+  return REDISMODULE_OK;
+}
+
+// mantis.put_payload payload
+// Reply with the payload handle that can be passed to mantis.enqueue in place of
+// the payload. Each put must be paired with a mantis.release_payload.
+int MantisCommand(PUT_PAYLOAD)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 2) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
+
   size_t payload_len;
-  std::string payload = RedisModule_StringPtrLen(payload_str, &payload_len);
+  const char *payload = RedisModule_StringPtrLen(argv[1], &payload_len);
+  std::string_view payload_view(payload, payload_len);
+
+  uint64_t digest = hash_payload(payload_view);
+  PayloadEntry &entry = payload_store[digest];
+  if (entry.refcount == 0) {
+    entry.data = payload_view;
+  } else if (entry.data != payload_view) {
+    return RedisModule_ReplyWithError(ctx, "ERR payload digest collision");
+  }
+  entry.refcount += 1;
 
-  auto query = nlohmann::json::parse(payload);
-  auto queue_name = query["worker_id"];
-  update_heartbeat(ctx, queue_name);
+  std::string handle = make_payload_handle(digest);
+  RedisModule_ReplyWithStringBuffer(ctx, handle.c_str(), handle.size());
+  return REDISMODULE_OK;
+}
 
-  auto current_time_ns = get_current_time_ns();
-  auto current_time_s = static_cast<double>(current_time_ns) / 1.0e9;
-  query["_4_done_time"] = current_time_s;
-  std::string serialized_query = query.dump();
+// mantis.get_payload handle
+int MantisCommand(GET_PAYLOAD)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 2) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
 
-  RedisModule_Call(ctx, "LPUSH", "cc", COMPLETION_QUEUE.data(), serialized_query.c_str());
+  size_t handle_len;
+  const char *handle = RedisModule_StringPtrLen(argv[1], &handle_len);
+  uint64_t digest = parse_payload_handle(std::string_view(handle, handle_len));
+  if (digest == 0 || payload_store.find(digest) == payload_store.end()) {
+    RedisModule_ReplyWithNull(ctx);
+    return REDISMODULE_OK;
+  }
+
+  const std::string &data = payload_store[digest].data;
+  RedisModule_ReplyWithStringBuffer(ctx, data.data(), data.size());
+  return REDISMODULE_OK;
+}
+
+// mantis.release_payload handle
+int MantisCommand(RELEASE_PAYLOAD)(RedisModuleCtx *ctx, RedisModuleString **argv,
+                                   int argc) {
+  if (argc != 2) return RedisModule_WrongArity(ctx);
+  RedisModule_AutoMemory(ctx);
+
+  size_t handle_len;
+  const char *handle = RedisModule_StringPtrLen(argv[1], &handle_len);
+  release_payload(parse_payload_handle(std::string_view(handle, handle_len)));
 
   RedisModule_ReplyWithNull(ctx);
   return REDISMODULE_OK;
 }
 
+// mantis.reset
+// Forget every registered queue, the config, the stored payloads and the latency
+// histograms. The module state lives outside the keyspace and survives FLUSHALL,
+// so call this along with it. Keys are left alone.
+int MantisCommand(RESET)(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc != 1) return RedisModule_WrongArity(ctx);
+  REDISMODULE_NOT_USED(argv);
+
+  registry = QueueRegistry();
+  dispatcher = Dispatcher();
+  payload_store.clear();
+  latency_histograms = LatencyHistograms();
+  last_sweep_ns = 0;
+  reschedule_sweep(ctx);
+  LOG(INFO) << "Reset the module state";
+
+  return RedisModule_ReplyWithSimpleString(ctx, "OK");
+}
+
 // Used to prevent module reload -> double init of glog.
 bool is_glog_initialized = false;
 
@@ -427,6 +1671,12 @@ int RedisModule_OnLoad(RedisModuleCtx *ctx, RedisModuleString **argv, int argc)
   if (RedisModule_Init(ctx, "mantis", 1, REDISMODULE_APIVER_1) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
 
+  redis_version = get_redis_version(ctx);
+  if (redis_version < STREAM_MIN_REDIS_VERSION) {
+    LOG(INFO) << "Redis " << redis_version << " is older than 6.2, only the list "
+              << "backend is available";
+  }
+
   if (RedisModule_CreateCommand(ctx, "mantis.health", MantisCommand(HEALTH), "write", 0,
                                 0, 0) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
@@ -435,22 +1685,85 @@ int RedisModule_OnLoad(RedisModuleCtx *ctx, RedisModuleString **argv, int argc)
                                 0, 0) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
 
+  if (RedisModule_CreateCommand(ctx, "mantis.enqueue_batch", MantisCommand(ENQUEUE_BATCH),
+                                "write", 0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
   if (RedisModule_CreateCommand(ctx, "mantis.add_queue", MantisCommand(ADD_QUEUE),
                                 "write", 0, 0, 0) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
 
+  if (RedisModule_CreateCommand(ctx, "mantis.add_standby", MantisCommand(ADD_STANDBY),
+                                "write", 0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.activate", MantisCommand(ACTIVATE), "write",
+                                0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.deactivate", MantisCommand(DEACTIVATE),
+                                "write", 0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
   if (RedisModule_CreateCommand(ctx, "mantis.drop_queue", MantisCommand(DROP_QUEUE),
                                 "write", 0, 0, 0) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
 
+  if (RedisModule_CreateCommand(ctx, "mantis.rebalance", MantisCommand(REBALANCE),
+                                "write", 0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.reclaim", MantisCommand(RECLAIM), "write", 0,
+                                0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+  if (RedisModule_CreateCommand(ctx, "mantis.config", MantisCommand(CONFIG), "write", 0,
+                                0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
   if (RedisModule_CreateCommand(ctx, "mantis.status", MantisCommand(STATUS), "readonly",
                                 0, 0, 0) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
 
+  if (RedisModule_CreateCommand(ctx, "mantis.status_binary", MantisCommand(STATUS_BINARY),
+                                "readonly", 0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
   if (RedisModule_CreateCommand(ctx, "mantis.complete", MantisCommand(COMPLETE), "write",
                                 0, 0, 0) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
 
+  if (RedisModule_CreateCommand(ctx, "mantis.expire", MantisCommand(EXPIRE), "write", 0,
+                                0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+  if (RedisModule_CreateCommand(ctx, "mantis.latency_histograms",
+                                MantisCommand(LATENCY_HISTOGRAMS), "write", 0, 0,
+                                0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.drain_completions",
+                                MantisCommand(DRAIN_COMPLETIONS), "write", 0, 0,
+                                0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.put_payload", MantisCommand(PUT_PAYLOAD),
+                                "write", 0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.get_payload", MantisCommand(GET_PAYLOAD),
+                                "readonly", 0, 0, 0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.release_payload",
+                                MantisCommand(RELEASE_PAYLOAD), "write", 0, 0,
+                                0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  if (RedisModule_CreateCommand(ctx, "mantis.reset", MantisCommand(RESET), "write", 0, 0,
+                                0) == REDISMODULE_ERR)
+    return REDISMODULE_ERR;
+
+  reschedule_sweep(ctx);
+
   return REDISMODULE_OK;
 }
 }
@@ -1,15 +1,33 @@
 import pytest
 import redis
+import struct
 import time
 import json
 
+# See QueryHeader in mantis.cc
+HEADER = struct.Struct("<q32sQddddd")
+# Tests that look at liveness shorten the heartbeat slack to this, which also
+# makes the module sweep every HEARTBEAT_SLACK_MS / 2, see sweep_interval_ms.
+HEARTBEAT_SLACK_MS = 100
+# Until a liveness sweep ran for sure, with room for a late timer.
+SWEPT_AFTER_S = 2 * HEARTBEAT_SLACK_MS / 1000
+# Until a queue without heartbeat is found dead.
+DEAD_AFTER_S = HEARTBEAT_SLACK_MS / 1000 + SWEPT_AFTER_S
+
 
 @pytest.fixture(scope="session")
 def redis_conn():
-    r = redis.Redis("0.0.0.0", port=7000, decode_responses=True)
+    r = redis.Redis("0.0.0.0", port=7000)
     yield r
 
 
+@pytest.fixture(autouse=True)
+def clean_server(redis_conn):
+    # The module state outlives FLUSHALL, every test starts without queues.
+    redis_conn.execute_command("FLUSHALL")
+    redis_conn.execute_command("mantis.reset")
+
+
 def test_health(redis_conn):
     conn = redis_conn
     assert conn.ping()
@@ -31,8 +49,8 @@ def test_e2e(redis_conn):
     _, q2_query = r.blpop("q2", timeout=1)
     assert q1_query
     assert q2_query
-    assert "_1_lg_sent" in q1_query
-    assert "_1_lg_sent" in q2_query
+    assert q1_query[HEADER.size :] == PAYLOAD.encode()
+    assert HEADER.unpack_from(q2_query)[1].rstrip(b"\0") == b"q2"
 
     # some query processing....
 
@@ -45,10 +63,12 @@ def test_e2e(redis_conn):
     r.execute_command("mantis.enqueue", PAYLOAD, time.time(), 3)
     _, q2_query = r.blpop("q2", timeout=1)
     assert q2_query
-    assert "_1_lg_sent" in q2_query
+    assert HEADER.unpack_from(q2_query)[0] == 3
 
     # we completed two queries, see them in completion queue
-    assert r.llen("completion_queue") >= 2
+    assert r.llen("completion_queue") == 2
+    done_time = HEADER.unpack_from(r.lindex("completion_queue", 0))[-1]
+    assert done_time > 0
 
     # lastly, check metric table
     status = json.loads(r.execute_command("mantis.status"))
@@ -58,19 +78,577 @@ def test_e2e(redis_conn):
 def test_heartbeat(redis_conn):
     r = redis_conn
 
-    r.execute_command("FLUSHALL")
-
+    r.execute_command("mantis.config", "heartbeat_slack_ms", HEARTBEAT_SLACK_MS)
     r.execute_command("mantis.add_queue", "h-q1")
-    time.sleep(0.5)  # This should makes q1 exceed heartbeat
+    time.sleep(DEAD_AFTER_S)  # This should makes q1 exceed heartbeat
 
     r.execute_command("mantis.add_queue", "h-q2")
     r.execute_command("mantis.enqueue", "aaa", time.time(), 4)
     assert r.llen("h-q1") == 0
     assert r.llen("h-q2") == 1
 
-    time.sleep(0.5)  # This should makes q2 exceed heartbeat
+    time.sleep(DEAD_AFTER_S)  # This should makes q2 exceed heartbeat
 
     # Now resume the heartbeat for q1
     r.execute_command("mantis.health", "h-q1")
     r.execute_command("mantis.enqueue", "aaa", time.time(), 4)
     assert r.llen("h-q1") == 1
+
+
+def test_status_tracks_outstanding_queries(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.add_queue", "s-q1")
+    r.execute_command("mantis.enqueue", "aaa", time.time(), 5)
+    r.execute_command("mantis.enqueue", "aaa", time.time(), 6)
+
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == [2]
+    assert len(status["real_arrival_ts_ns"]) == 2
+
+    _, query = r.blpop("s-q1", timeout=1)
+    r.execute_command("mantis.complete", query)
+    r.execute_command("mantis.drop_queue", "s-q1")
+
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == []
+    assert status["dropped_queue_sizes"] == [1]
+    assert status["real_arrival_ts_ns"] == []
+
+    # Draining the last query forgets the dropped queue
+    _, query = r.blpop("s-q1", timeout=1)
+    r.execute_command("mantis.complete", query)
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["dropped_queue_sizes"] == []
+
+
+def test_enqueue_batch(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.add_queue", "b-q1")
+    r.execute_command("mantis.add_queue", "b-q2")
+
+    now = time.time()
+    args = []
+    for i in range(10):
+        args.extend(["payload", now, i])
+    assert r.execute_command("mantis.enqueue_batch", *args) == 10
+    assert r.llen("b-q1") + r.llen("b-q2") == 10
+
+    query_ids = set()
+    for queue in ["b-q1", "b-q2"]:
+        for query in r.lrange(queue, 0, -1):
+            query_ids.add(HEADER.unpack_from(query)[0])
+    assert query_ids == set(range(10))
+
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.enqueue_batch", "payload", now)
+
+
+def test_binary_payload(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.add_queue", "bin-q1")
+
+    payload = bytes(range(256)) * 4
+    r.execute_command("mantis.enqueue", payload, 1.5, 7)
+    _, query = r.blpop("bin-q1", timeout=1)
+    query_id, worker_id, digest, deadline, lg_sent, enqueue_time, _, _ = (
+        HEADER.unpack_from(query)
+    )
+    assert query_id == 7
+    assert worker_id.rstrip(b"\0") == b"bin-q1"
+    assert digest == 0
+    assert deadline == 0
+    assert lg_sent == 1.5
+    assert enqueue_time > 0
+    assert query[HEADER.size :] == payload
+
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.complete", b"too short")
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.add_queue", "q" * 33)
+
+
+def test_payload_store(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.add_queue", "p-q1")
+
+    payload = b"\0" * 1024
+    handle = r.execute_command("mantis.put_payload", payload)
+    assert r.execute_command("mantis.put_payload", payload) == handle
+    assert r.execute_command("mantis.get_payload", handle) == payload
+
+    r.execute_command("mantis.enqueue", handle, time.time(), 8)
+    _, query = r.blpop("p-q1", timeout=1)
+    assert HEADER.unpack_from(query)[2] != 0
+    assert query[HEADER.size :] == handle
+
+    # Two puts and one query in flight hold the payload
+    r.execute_command("mantis.release_payload", handle)
+    r.execute_command("mantis.release_payload", handle)
+    assert r.execute_command("mantis.get_payload", handle) == payload
+    r.execute_command("mantis.complete", query[: HEADER.size])
+    assert r.execute_command("mantis.get_payload", handle) is None
+
+    # A released handle is not taken for an inline payload.
+    with pytest.raises(redis.ResponseError, match="unknown payload handle"):
+        r.execute_command("mantis.enqueue", handle, time.time(), 9)
+    with pytest.raises(redis.ResponseError, match="unknown payload handle"):
+        r.execute_command(
+            "mantis.enqueue_batch", "aaa", time.time(), 10, handle, time.time(), 11
+        )
+    assert r.llen("p-q1") == 0
+
+
+def test_status_binary(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.add_queue", "sb-q1")
+    before_ns = time.time() * 1e9
+    for i in range(3):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+
+    report, timestamps = r.execute_command("mantis.status_binary")
+    report = json.loads(report)
+    assert "real_arrival_ts_ns" not in report
+    assert report["queue_sizes"] == [3]
+
+    timestamps = struct.unpack(f"<{len(timestamps) // 8}q", timestamps)
+    assert len(timestamps) == 3
+    assert list(timestamps) == sorted(timestamps)
+    assert timestamps[0] >= before_ns - 1e6
+
+    _, timestamps = r.execute_command("mantis.status_binary")
+    assert timestamps == b""
+
+
+def test_drain_completions(redis_conn):
+    r = redis_conn
+
+    assert r.execute_command("mantis.drain_completions") == b""
+
+    r.execute_command("mantis.add_queue", "d-q1")
+    for i in range(3):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    for _ in range(3):
+        _, query = r.blpop("d-q1", timeout=1)
+        r.execute_command("mantis.complete", query[: HEADER.size] + b"result")
+
+    headers = r.execute_command("mantis.drain_completions")
+    assert len(headers) == 3 * HEADER.size
+    query_ids = [header[0] for header in HEADER.iter_unpack(headers)]
+    assert query_ids == [0, 1, 2]
+    assert r.llen("completion_queue") == 0
+
+
+def test_latency_histograms(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.add_queue", "lh-q1")
+    for i in range(2):
+        r.execute_command("mantis.enqueue", "aaa", time.time() - 1, i)
+    for _ in range(2):
+        _, query = r.blpop("lh-q1", timeout=1)
+        header = list(HEADER.unpack_from(query))
+        header[5] -= 0.5  # _2_enqueue_time
+        header[6] = header[5] + 0.25  # _3_dequeue_time
+        r.execute_command("mantis.complete", HEADER.pack(*header))
+
+    report = json.loads(r.execute_command("mantis.latency_histograms"))
+    assert list(report["workers"]) == ["lh-q1"]
+    assert report["workers"]["lh-q1"] == report["overall"]
+
+    histograms = report["overall"]
+    for name, expected_us in [("e2e", 1e6), ("queueing", 0.25e6), ("service", 0.25e6)]:
+        assert histograms[name]["count"] == 2
+        lower_bound_us, _ = histograms[name]["buckets"][-1]
+        assert expected_us * (1 - 2 ** -report["sub_bucket_bits"]) <= lower_bound_us
+        assert lower_bound_us <= histograms[name]["max_us"] < expected_us * 1.1
+
+    # Reset on read
+    report = json.loads(r.execute_command("mantis.latency_histograms"))
+    assert report["overall"]["e2e"]["count"] == 0
+    assert report["workers"] == {}
+
+
+def test_reset(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.config", "dispatch_policy", "round_robin")
+    r.execute_command("mantis.add_queue", "rs-q1")
+    handle = r.execute_command("mantis.put_payload", "aaa")
+    r.execute_command("mantis.enqueue", handle, time.time(), 0)
+    r.execute_command("mantis.drop_queue", "rs-q1")
+
+    r.execute_command("FLUSHALL")
+    r.execute_command("mantis.reset")
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == status["dropped_queue_sizes"] == []
+    assert status["queue_events"] == status["real_arrival_ts_ns"] == []
+    assert json.loads(r.execute_command("mantis.config"))["dispatch_policy"] == (
+        "power_of_d"
+    )
+    assert r.execute_command("mantis.get_payload", handle) is None
+
+
+def test_add_queue_startup_report(redis_conn):
+    r = redis_conn
+
+    startup = {"load_model": 1.5, "warm_up": 0.25}
+    r.execute_command("mantis.add_queue", "st-q1", json.dumps(startup))
+    r.execute_command("mantis.add_queue", "st-q2")
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.add_queue", "st-q3", "{not json")
+
+    events = json.loads(r.execute_command("mantis.status"))["queue_events"]
+    events = [json.loads(event) for event in events]
+    assert [event["queue_id"] for event in events] == ["st-q1", "st-q2"]
+    assert events[0]["startup"] == startup
+    assert "startup" not in events[1]
+
+
+def test_standby_pool(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.add_queue", "sb-active")
+    r.execute_command("mantis.add_standby", "sb-standby1")
+    r.execute_command("mantis.add_standby", "sb-standby2")
+    for i in range(4):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert r.llen("sb-active") == 4
+    assert r.llen("sb-standby1") == r.llen("sb-standby2") == 0
+
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == [4]
+    assert status["standby_queue_sizes"] == [0, 0]
+
+    assert r.execute_command("mantis.activate", 1) == [b"sb-standby1"]
+    r.execute_command("mantis.enqueue", "aaa", time.time(), 4)
+    assert r.llen("sb-standby1") == 1
+
+    # The shortest active queue goes back to standby and keeps its queries.
+    assert r.execute_command("mantis.deactivate", 1) == [b"sb-standby1"]
+    assert r.execute_command("mantis.activate", 5) == [b"sb-standby2", b"sb-standby1"]
+    status = json.loads(r.execute_command("mantis.status"))
+    assert sorted(status["queue_sizes"]) == [0, 1, 4]
+    assert status["standby_queue_sizes"] == []
+    event_types = [json.loads(event)["type"] for event in status["queue_events"]]
+    assert event_types == ["ACTIVATE", "DEACTIVATE", "ACTIVATE", "ACTIVATE"]
+
+
+def test_named_connection_liveness(redis_conn):
+    r = redis_conn
+
+    # Workers name their connection after their queue, a worker whose
+    # connection closes is dead long before its heartbeat is late.
+    r.execute_command("mantis.config", "heartbeat_slack_ms", HEARTBEAT_SLACK_MS)
+    worker = redis.Redis("0.0.0.0", port=7000, client_name="nc-q1")
+    worker.execute_command("mantis.add_queue", "nc-q1")
+    time.sleep(SWEPT_AFTER_S)
+    worker.execute_command("mantis.health", "nc-q1")
+    r.execute_command("mantis.enqueue", "aaa", time.time(), 0)
+    assert r.llen("nc-q1") == 1
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == [1]
+
+    worker.close()
+    for _ in range(2):  # Even with heartbeats sent over another connection.
+        time.sleep(SWEPT_AFTER_S)
+        r.execute_command("mantis.health", "nc-q1")
+        status = json.loads(r.execute_command("mantis.status"))
+        assert status["queue_sizes"] == []
+        assert status["dead_queue_sizes"] == [1]
+
+    # An open connection does not keep a queue alive without heartbeats, e.g.
+    # one left half-open by a lost node or that of a hung worker.
+    hung = redis.Redis("0.0.0.0", port=7000, client_name="nc-q2")
+    hung.execute_command("mantis.add_queue", "nc-q2")
+    time.sleep(DEAD_AFTER_S)
+    assert hung.ping()
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["dead_queue_sizes"] == [1, 0]
+    hung.close()
+
+
+def test_dispatch_policies(redis_conn):
+    r = redis_conn
+
+    queues = ["dp-q1", "dp-q2", "dp-q3"]
+    for name in queues:
+        r.execute_command("mantis.add_queue", name)
+
+    def complete_all(name, service_time_s):
+        while r.llen(name):
+            header = list(HEADER.unpack_from(r.lpop(name)))
+            header[6] = time.time() - service_time_s  # _3_dequeue_time
+            r.execute_command("mantis.complete", HEADER.pack(*header))
+
+    r.execute_command("mantis.config", "dispatch_policy", "round_robin")
+    for i in range(6):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert [r.llen(name) for name in queues] == [2, 2, 2]
+
+    # dp-q1 is slow, dp-q2 is fast and dp-q3 still has two queries queued.
+    complete_all("dp-q1", 1.0)
+    complete_all("dp-q2", 0.01)
+    r.execute_command("mantis.config", "dispatch_policy", "least_expected_work")
+    for i in range(3):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert [r.llen(name) for name in queues] == [0, 3, 2]
+
+    r.execute_command("mantis.config", "dispatch_policy", "join_shortest_queue")
+    r.execute_command("mantis.enqueue", "aaa", time.time(), 0)
+    r.execute_command("mantis.config", "dispatch_policy", "power_of_d", "power_of_d", 3)
+    r.execute_command("mantis.enqueue", "aaa", time.time(), 0)
+    assert [r.llen(name) for name in queues] == [2, 3, 2]
+
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["dispatch_policy"] == "power_of_d"
+    assert status["dispatch_counts"] == {
+        "round_robin": 6,
+        "join_shortest_queue": 1,
+        "power_of_d": 1,
+        "least_expected_work": 3,
+        "shared_queue": 0,
+    }
+
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.config", "dispatch_policy", "random")
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.config", "power_of_d", 0)
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.config", "heartbeat_slack_ms", 0)
+    r.execute_command("mantis.config", "power_of_d", 2)
+    config = json.loads(r.execute_command("mantis.config"))
+    assert config == {
+        "dispatch_policy": "power_of_d",
+        "power_of_d": 2,
+        "prefetch": 2,
+        "backend": "list",
+        "deadline_ms": 0,
+        "heartbeat_slack_ms": 5000,
+    }
+
+
+def test_shared_queue(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.config", "dispatch_policy", "shared_queue", "prefetch", 2)
+    r.execute_command("mantis.add_queue", "sq-q1")
+    r.execute_command("mantis.add_queue", "sq-q2")
+    for i in range(6):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert r.llen("sq-q1") == r.llen("sq-q2") == 2
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == [2, 2]
+    assert status["shared_queue_size"] == 2
+
+    # A completion pulls the oldest waiting query into the worker's queue.
+    r.execute_command("mantis.complete", r.lpop("sq-q1"))
+    r.lpop("sq-q1")
+    header = HEADER.unpack_from(r.lpop("sq-q1"))
+    assert header[0] == 4  # query_id
+    assert header[1].rstrip(b"\0") == b"sq-q1"
+
+    # A dropped worker gets nothing new, the remaining worker pulls the rest.
+    r.execute_command("mantis.drop_queue", "sq-q2")
+    r.execute_command("mantis.enqueue", "aaa", time.time(), 6)
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == [2]
+    assert status["dropped_queue_sizes"] == [2]
+    assert status["shared_queue_size"] == 2
+    assert status["dispatch_counts"]["shared_queue"] == 1
+
+    # Switching policy dispatches whatever still waits.
+    r.execute_command("mantis.config", "dispatch_policy", "power_of_d")
+    assert r.llen("shared_queue") == 0
+    assert r.llen("sq-q1") == 2
+
+
+def test_shared_queue_switch_without_queues(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.config", "dispatch_policy", "shared_queue")
+    for i in range(3):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert r.llen("shared_queue") == 3
+
+    # The waiting queries have nowhere to go, the policy stays as it is.
+    with pytest.raises(redis.ResponseError, match="no healthy queue"):
+        r.execute_command("mantis.config", "dispatch_policy", "power_of_d")
+    assert json.loads(r.execute_command("mantis.config"))["dispatch_policy"] == (
+        "shared_queue"
+    )
+    assert r.llen("shared_queue") == 3
+
+    # Once a worker registers it pulls its share, the switch dispatches the rest.
+    r.execute_command("mantis.add_queue", "sqs-q1")
+    assert r.llen("sqs-q1") == 2
+    r.execute_command("mantis.config", "dispatch_policy", "power_of_d")
+    assert r.llen("shared_queue") == 0
+    assert r.llen("sqs-q1") == 3
+
+
+def test_redistribute(redis_conn):
+    r = redis_conn
+
+    r.execute_command(
+        "mantis.config",
+        "dispatch_policy",
+        "round_robin",
+        "heartbeat_slack_ms",
+        HEARTBEAT_SLACK_MS,
+    )
+    r.execute_command("mantis.add_queue", "rd-q1")
+    r.execute_command("mantis.add_queue", "rd-q2")
+    for i in range(4):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert r.llen("rd-q1") == r.llen("rd-q2") == 2
+
+    assert r.execute_command("mantis.drop_queue", "rd-q1", "REDISTRIBUTE") == 2
+    assert r.llen("rd-q1") == 0
+    assert r.llen("rd-q2") == 4
+    queries = [HEADER.unpack_from(q) for q in r.lrange("rd-q2", 0, -1)]
+    assert [header[1].rstrip(b"\0") for header in queries] == [b"rd-q2"] * 4
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["dropped_queue_sizes"] == []
+    with pytest.raises(redis.ResponseError):
+        r.execute_command("mantis.drop_queue", "rd-q2", "NOW")
+
+    # Queries of a queue whose worker died move to the live ones.
+    r.execute_command("mantis.config", "dispatch_policy", "join_shortest_queue")
+    r.execute_command("mantis.add_queue", "rd-q3")
+    for i in range(2):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert r.llen("rd-q3") == 2
+    time.sleep(DEAD_AFTER_S)
+    r.execute_command("mantis.health", "rd-q2")
+    assert r.execute_command("mantis.rebalance") == 2
+    assert r.llen("rd-q3") == 0
+    assert r.llen("rd-q2") == 6
+    assert r.execute_command("mantis.rebalance") == 0
+
+
+def test_stream_backend(redis_conn):
+    r = redis_conn
+
+    r.execute_command(
+        "mantis.config",
+        "backend",
+        "stream",
+        "dispatch_policy",
+        "round_robin",
+        "heartbeat_slack_ms",
+        HEARTBEAT_SLACK_MS,
+    )
+    assert json.loads(r.execute_command("mantis.config"))["backend"] == "stream"
+    r.execute_command("mantis.add_queue", "xs-q1")
+    r.execute_command("mantis.add_queue", "xs-q2")
+    for i in range(4):
+        r.execute_command("mantis.enqueue", "aaa", time.time(), i)
+    assert r.xlen("xs-q1") == r.xlen("xs-q2") == 2
+
+    # The worker of xs-q1 pops a query and dies before completing it.
+    [[_, [(entry_id, fields)]]] = r.xreadgroup(
+        "mantis", "xs-q1", {"xs-q1": ">"}, count=1
+    )
+    assert HEADER.unpack_from(fields[b"query"])[1].rstrip(b"\0") == b"xs-q1"
+    time.sleep(DEAD_AFTER_S)
+    r.execute_command("mantis.health", "xs-q2")
+
+    # Both its popped and its waiting query move to xs-q2.
+    assert r.execute_command("mantis.reclaim", 60000) == 2
+    assert r.xlen("xs-q1") == 0
+    assert r.xlen("xs-q2") == 4
+    entries = r.xreadgroup("mantis", "xs-q2", {"xs-q2": ">"})[0][1]
+    assert [HEADER.unpack_from(f[b"query"])[0] for _, f in entries] == [1, 3, 0, 2]
+
+    # A live worker keeps the queries it is still within min_idle_ms of.
+    r.execute_command("mantis.health", "xs-q2")
+    assert r.execute_command("mantis.reclaim", 60000) == 0
+
+
+def test_reclaimed_completion_counted_once(redis_conn):
+    r = redis_conn
+
+    r.execute_command(
+        "mantis.config", "backend", "stream", "dispatch_policy", "round_robin"
+    )
+    r.execute_command("mantis.add_queue", "xs-q1")
+    r.execute_command("mantis.add_queue", "xs-q2")
+    handle = r.execute_command("mantis.put_payload", "aaa")
+    r.execute_command("mantis.enqueue", handle, time.time(), 1)
+
+    # The worker of xs-q1 is slow, its query is reclaimed while it serves it.
+    [[_, [(slow_id, fields)]]] = r.xreadgroup("mantis", "xs-q1", {"xs-q1": ">"})
+    slow_query = fields[b"query"]
+    assert r.execute_command("mantis.reclaim", 0) == 1
+    [[_, [(entry_id, fields)]]] = r.xreadgroup("mantis", "xs-q2", {"xs-q2": ">"})
+
+    # Only one of the two completions counts.
+    assert r.execute_command("mantis.complete", fields[b"query"], entry_id) == 1
+    assert r.execute_command("mantis.complete", slow_query, slow_id) == 0
+    assert r.llen("completion_queue") == 1
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["queue_sizes"] == [0, 0]
+
+    # And only one reference to the payload is released.
+    assert r.execute_command("mantis.get_payload", handle) == b"aaa"
+    r.execute_command("mantis.release_payload", handle)
+    assert r.execute_command("mantis.get_payload", handle) is None
+
+
+def test_deadlines(redis_conn):
+    r = redis_conn
+
+    r.execute_command("mantis.config", "dispatch_policy", "round_robin")
+    r.execute_command("mantis.add_queue", "dl-q1")
+    r.execute_command("mantis.add_queue", "dl-q2")
+    # Measure a service time of 40ms for dl-q1 and 10ms for dl-q2.
+    for i in range(2):
+        assert r.execute_command("mantis.enqueue", "aaa", time.time(), i) == 1
+    for name, service_time_s in [("dl-q1", 0.04), ("dl-q2", 0.01)]:
+        header = list(HEADER.unpack_from(r.lpop(name)))
+        header[6] = time.time() - service_time_s  # _3_dequeue_time
+        r.execute_command("mantis.complete", HEADER.pack(*header))
+    json.loads(r.execute_command("mantis.status"))
+
+    # dl-q1 can only take two queries within 100ms, its third one goes to dl-q2.
+    r.execute_command("mantis.config", "deadline_ms", 100)
+    for i in range(6):
+        assert r.execute_command("mantis.enqueue", "aaa", time.time(), i) == 1
+    assert r.llen("dl-q1") == 2
+    assert r.llen("dl-q2") == 4
+    deadline = HEADER.unpack_from(r.lindex("dl-q1", 0))[3]
+    assert deadline == pytest.approx(time.time() + 0.1, abs=0.05)
+
+    # Neither can make 10ms anymore.
+    r.execute_command("mantis.config", "deadline_ms", 10)
+    assert (
+        r.execute_command(
+            "mantis.enqueue_batch", "a", time.time(), 6, "b", time.time(), 7
+        )
+        == 0
+    )
+    assert r.llen("dl-q2") == 4
+
+    # A worker skips a query that expired while queued.
+    r.execute_command("mantis.expire", r.lpop("dl-q1"))
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["deadline_counts"] == {"diverted": 1, "rejected": 2, "expired": 1}
+    assert sorted(status["queue_sizes"]) == [1, 4]
+    assert r.llen("completion_queue") == 2
+
+    # An idle queue that is already the fastest takes the query, no diversion.
+    for name in ["dl-q1", "dl-q2"]:
+        while r.llen(name):
+            r.execute_command("mantis.expire", r.lpop(name))
+    r.execute_command(
+        "mantis.config", "dispatch_policy", "least_expected_work", "deadline_ms", 5
+    )
+    assert r.execute_command("mantis.enqueue", "aaa", time.time(), 8) == 1
+    assert r.llen("dl-q2") == 1
+    status = json.loads(r.execute_command("mantis.status"))
+    assert status["deadline_counts"] == {"diverted": 0, "rejected": 0, "expired": 5}